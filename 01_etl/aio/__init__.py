@@ -0,0 +1,5 @@
+"""Асинхронный рантайм etl на asyncpg, AsyncElasticsearch и redis.asyncio.
+
+Реализует те же контракты продьюсеров, обогатителей, загрузчиков и хранилищ состояний,
+что и синхронный рантайм, но позволяет одному процессу держать одновременно
+много запросов к бд и bulk-запросов к elasticsearch. Включается настройкой ETL_RUNTIME=async."""
@@ -0,0 +1,149 @@
+import asyncio
+import signal
+from dataclasses import dataclass
+from typing import Optional
+
+from elasticsearch import AsyncElasticsearch
+from redis import asyncio as aioredis
+
+import metrics
+import producers
+import retries
+import settings
+import transformers
+from aio import deadletters, enrichers, loaders, states
+from aio.db import DB
+from aio.pipelines import Pipeline
+from aio.producers import Producer
+from aio.utils import gather
+from log import logger
+
+
+@dataclass
+class App:
+    """Запускает асинхронные пайплайны с интервалом.
+
+    Все пайплайны выполняются одновременно в одном цикле событий.
+    Обеспечивает корректное завершение при получении сигналов SIGINT и SIGTERM."""
+    pipelines: list[Pipeline]
+    check_interval_sec: int
+    _stopped: Optional[asyncio.Event] = None
+
+    async def run(self):
+        self._stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+
+        while not self._stopped.is_set():
+            try:
+                await gather(*(pipeline.execute() for pipeline in self.pipelines))
+            except Exception as e:
+                if not self._stopped.is_set():
+                    raise
+                logger.info(f'Pipelines interrupted by stop: {e}')
+                return
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout=self.check_interval_sec)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        """Останавливает цикл после текущих пайплайнов и прерывает паузы их повторов."""
+        self._stopped.set()
+        retries.interrupt()
+
+
+def create_es_client() -> AsyncElasticsearch:
+    return AsyncElasticsearch(f'{settings.ES_SCHEMA}://{settings.ES_HOST}:{settings.ES_PORT}',
+                              max_retries=settings.ES_MAX_RETRIES,
+                              http_compress=settings.ES_HTTP_COMPRESS)
+
+
+def create_stages(db: DB, es_client: AsyncElasticsearch, dead_letters: deadletters.Base) -> dict:
+    """Создает обогатитель, преобразователь и загрузчик в зависимости от способа сборки документов.
+
+    :param db:
+    :param es_client:
+    :param dead_letters: очередь документов, отклоненных elasticsearch
+    :return:
+    """
+    if settings.DOCUMENT_MODE == 'validated':
+        return dict(
+            enricher=enrichers.Movie(db),
+            transformer=transformers.ElasticSearchMovie(),
+            loader=loaders.ElasticSearchMovie(client=es_client, index=settings.ES_MOVIE_INDEX_NAME,
+                                              dead_letters=dead_letters),
+        )
+    return dict(
+        enricher=enrichers.MovieDocument(db),
+        transformer=transformers.Passthrough(),
+        loader=loaders.ElasticSearchRawMovie(client=es_client,
+                                             index=settings.ES_MOVIE_INDEX_NAME,
+                                             concurrency=settings.ES_BULK_CONCURRENCY,
+                                             max_batch_docs=settings.ES_BULK_MAX_DOCS,
+                                             max_batch_bytes=settings.ES_BULK_MAX_BYTES,
+                                             dead_letters=dead_letters),
+    )
+
+
+def create_pipeline(name: str,
+                    producer_cls: type[producers.Base],
+                    db: DB,
+                    state: states.State,
+                    es_client: AsyncElasticsearch,
+                    dead_letters: deadletters.Base) -> Pipeline:
+    """Создает асинхронный пайплайн. Продьюсер использует запросы синхронного продьюсера producer_cls.
+
+    :param name: имя пайплайна, под ним хранится состояние
+    :param producer_cls: класс синхронного продьюсера
+    :param db:
+    :param state:
+    :param es_client:
+    :param dead_letters: очередь документов, отклоненных elasticsearch
+    :return:
+    """
+    return Pipeline(
+        name=name,
+        state=state,
+        producer=Producer(db, producer_cls(None, settings.CHUNK_SIZE)),
+        logger=logger,
+        in_flight=settings.ASYNC_CHUNKS_IN_FLIGHT,
+        **create_stages(db, es_client, dead_letters),
+    )
+
+
+async def run_app():
+    """Собирает асинхронный рантайм и запускает его.
+
+    Поддерживает оба источника изменений и оба способа сборки документов.
+    Уведомления postgres, пропуск неизменившихся документов и частичное обновление персон
+    есть только в синхронном рантайме: здесь персоны обрабатываются полной пересборкой их фильмов."""
+    if settings.METRICS_PORT:
+        metrics.start_server(settings.METRICS_PORT)
+    db = DB(dsn=settings.PG_DSN, max_size=settings.PG_POOL_MAX_SIZE)
+    redis_client = aioredis.Redis(**settings.REDIS_DSN)
+    es_client = create_es_client()
+    dead_letters = deadletters.RedisDeadLetters(redis=redis_client, name=settings.DEAD_LETTERS_KEY)
+    state = await states.State(states.RedisStorage(redis=redis_client, name=settings.STORAGE_STATE_KEY)).load()
+
+    if settings.SYNC_SOURCE == 'outbox':
+        sources = {'ChangeOutbox': producers.ChangeOutbox}
+    else:
+        sources = {
+            'PersonModified': producers.PersonModified,
+            'GenreModified': producers.GenreModified,
+            'FilmworkModified': producers.FilmworkModified,
+        }
+    pipelines = [create_pipeline(name, producer_cls, db, state, es_client, dead_letters)
+                 for name, producer_cls in sources.items()]
+    try:
+        await App(pipelines=pipelines, check_interval_sec=settings.CHECK_INTERVAL_SEC).run()
+    finally:
+        await es_client.close()
+        await redis_client.close()
+        await db.close()
+
+
+def init_app():
+    asyncio.run(run_app())
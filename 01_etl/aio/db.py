@@ -0,0 +1,86 @@
+import re
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional, Union
+
+import asyncpg
+
+# Плейсхолдеры psycopg2: именованные %(name)s и позиционные %s
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s')
+
+
+@dataclass
+class DB:
+    """Пул соединений asyncpg.
+
+    Принимает тот же словарь настроек подключения, что и синхронный пул."""
+    dsn: dict
+    min_size: int = 1
+    max_size: int = 10
+    _pool: Optional[asyncpg.Pool] = None
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[asyncpg.Connection]:
+        """Выдает соединение из пула на время блока.
+
+        :return:
+        """
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(
+                database=self.dsn['dbname'],
+                user=self.dsn['user'],
+                password=self.dsn['password'],
+                host=self.dsn['host'],
+                port=self.dsn['port'],
+                min_size=self.min_size,
+                max_size=self.max_size,
+                server_settings={'search_path': 'public,content'},
+            )
+        async with self._pool.acquire() as conn:
+            yield conn
+
+    async def fetch(self, sql: str, params: Union[dict, tuple]) -> list[asyncpg.Record]:
+        """Выполняет запрос в формате psycopg2 и возвращает все строки.
+
+        :param sql:
+        :param params:
+        :return:
+        """
+        query, args = to_asyncpg(sql, params)
+        async with self.connection() as conn:
+            return await conn.fetch(query, *args)
+
+    async def execute(self, sql: str, params: Union[dict, tuple]):
+        query, args = to_asyncpg(sql, params)
+        async with self.connection() as conn:
+            await conn.execute(query, *args)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+def to_asyncpg(sql: str, params: Union[dict, tuple]) -> tuple[str, list]:
+    """Переводит запрос с плейсхолдерами psycopg2 в запрос с нумерованными параметрами asyncpg.
+
+    Именованный параметр, встречающийся в запросе несколько раз, передается один раз.
+
+    :param sql:
+    :param params: словарь для именованных плейсхолдеров или кортеж для позиционных
+    :return: запрос и список аргументов
+    """
+    args = []
+    numbers = {}
+
+    def replace(match: re.Match) -> str:
+        name = match.group(1)
+        if name is None:
+            args.append(params[len(args)])
+            return f'${len(args)}'
+        if name not in numbers:
+            args.append(params[name])
+            numbers[name] = len(args)
+        return f'${numbers[name]}'
+
+    return _PLACEHOLDER.sub(replace, sql), args
@@ -0,0 +1,43 @@
+import json
+from abc import ABCMeta, abstractmethod
+from dataclasses import dataclass
+from typing import Any
+
+from redis import asyncio as aioredis
+
+import deadletters
+
+
+@dataclass
+class Base(metaclass=ABCMeta):
+    """Базовый класс асинхронной очереди отклоненных документов, повторяет метод add deadletters.Base.
+
+    Документы из очереди загружает заново replay.py."""
+
+    @abstractmethod
+    async def add(self, errors: dict[str, Any]) -> None:
+        """Добавляет документы в очередь. Повторно добавленный документ увеличивает счетчик попыток.
+
+        :param errors: ошибки elasticsearch по id документов
+        :return:
+        """
+        pass
+
+
+@dataclass
+class RedisDeadLetters(Base):
+    """Хранит отклоненные документы в redis. Использует тот же ключ и формат, что и deadletters.RedisDeadLetters."""
+
+    redis: aioredis.Redis
+    name: str
+
+    async def add(self, errors: dict[str, Any]) -> None:
+        if not errors:
+            return
+        ids = list(errors)
+        stored = await self.redis.hmget(self.name, ids)
+        await self.redis.hset(self.name, mapping={
+            doc_id: json.dumps(deadletters.entry(errors[doc_id], json.loads(old) if old is not None else None),
+                               default=str)
+            for doc_id, old in zip(ids, stored)
+        })
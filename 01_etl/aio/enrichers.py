@@ -0,0 +1,53 @@
+import json
+from abc import ABCMeta, abstractmethod
+from dataclasses import dataclass
+from typing import Any
+from uuid import UUID
+
+import documents
+import enrichers
+import models
+from aio.db import DB
+from aio.utils import backoff
+
+
+class Base(metaclass=ABCMeta):
+    """Базовый класс асинхронного обогатителя, повторяет контракт enrichers.Base."""
+
+    @abstractmethod
+    async def enrich(self, ids: list[UUID]) -> list[Any]:
+        pass
+
+
+@dataclass
+class Movie(Base):
+    """Получает из бд полные данные по фильму тем же запросом, что и enrichers.Movie."""
+    db: DB
+
+    @backoff()
+    async def enrich(self, ids: list[UUID]) -> list[models.Movie]:
+        """ Возвращает найденные модели фильмов по id.
+
+        asyncpg возвращает json строкой, поэтому персоны разбираются перед созданием модели.
+
+        :param ids:
+        :return:
+        """
+        rows = await self.db.fetch(enrichers.Movie._sql(), (ids,))
+        return [models.Movie(**dict(row, persons=json.loads(row['persons']))) for row in rows]
+
+
+@dataclass
+class MovieDocument(Base):
+    """Получает из бд готовые документы фильмов тем же запросом, что и enrichers.MovieDocument."""
+    db: DB
+
+    @backoff()
+    async def enrich(self, ids: list[UUID]) -> list[documents.RawMovie]:
+        """ Возвращает найденные документы фильмов по id.
+
+        :param ids:
+        :return:
+        """
+        rows = await self.db.fetch(enrichers.MovieDocument._sql(), (ids,))
+        return [documents.RawMovie(*row) for row in rows]
@@ -0,0 +1,129 @@
+import asyncio
+import itertools
+import time
+from abc import ABCMeta, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_bulk
+
+import documents
+import loaders
+import metrics
+import retries
+from aio import deadletters
+from aio.utils import backoff, gather, pause
+from log import logger
+
+
+@dataclass
+class Base(metaclass=ABCMeta):
+    """Базовый класс асинхронного загрузчика, повторяет контракт loaders.Base."""
+
+    @abstractmethod
+    async def load(self, items: list[Any]) -> int:
+        """Загружает документы в хранилище
+
+        :return:
+        """
+        pass
+
+
+@dataclass
+class ElasticSearchMovie(Base):
+    """Загрузчик фильмов в elasticsearch."""
+
+    client: AsyncElasticsearch
+    index: str
+    # Сколько раз повторять документы, отклоненные elasticsearch из-за перегрузки (429)
+    max_retries: int = 3
+    # Если задана, отклоненные elasticsearch документы попадают в нее, а не теряются
+    dead_letters: Optional[deadletters.Base] = None
+
+    @backoff()
+    async def load(self, items: list[documents.Movie]) -> int:
+        """Загружает документы в хранилище
+
+        :return:
+        """
+        actions = loaders.ElasticSearchMovie.generate_actions(items)
+        success, errors = await async_bulk(self.client, index=self.index, actions=actions,
+                                           max_retries=self.max_retries, raise_on_error=False)
+        _, failures = loaders.item_errors(errors)
+        if failures and self.dead_letters is not None:
+            await self.dead_letters.add(failures)
+        return success
+
+
+@dataclass
+class ElasticSearchRawMovie(Base):
+    """Загрузчик готовых json-документов фильмов в elasticsearch.
+
+    Пачка делится на bulk-запросы так же, как в loaders.ElasticSearchRawMovie,
+    и запросы отправляются одновременно, не больше concurrency за раз."""
+
+    client: AsyncElasticsearch
+    index: str
+    concurrency: int = 4
+    max_batch_docs: int = 500
+    max_batch_bytes: int = 10 * 1024 * 1024
+    # Если задана, отклоненные elasticsearch документы попадают в нее, а не теряются
+    dead_letters: Optional[deadletters.Base] = None
+    _semaphore: asyncio.Semaphore = None
+
+    async def load(self, items: list[documents.RawMovie]) -> int:
+        """Загружает документы в хранилище
+
+        :return: кол-во успешно загруженных документов
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        batches = loaders.build_bulk_batches(items, self.max_batch_docs, self.max_batch_bytes)
+        return sum(await gather(*(self._send(docs, body) for docs, body in batches)))
+
+    async def _send(self, docs: int, body: bytes) -> int:
+        """Отправляет один bulk-запрос.
+
+        Как и в loaders.ElasticSearchRawMovie, документы, отклоненные elasticsearch из-за перегрузки (429),
+        отправляются повторно отдельным запросом, остальные отклоненные документы попадают в очередь.
+
+        :param docs: кол-во документов в запросе
+        :param body: тело запроса в формате ndjson
+        :return: кол-во успешно загруженных документов
+        """
+        retry = retries.policy('elasticsearch')
+        loaded = 0
+        for attempt in itertools.count():
+            last = retry.max_tries is not None and attempt + 1 >= retry.max_tries
+            response = await self._bulk(docs, body)
+            failed, failures = loaders.item_errors(response['items'] if response['errors'] else [],
+                                                   retriable=() if last else (429,))
+            loaded += docs - failed
+            if failures and self.dead_letters is not None:
+                await self.dead_letters.add(failures)
+            docs, body = loaders.rejected_documents(body, response, 429)
+            if not docs or last:
+                return loaded
+
+            delay = retry.delay(attempt)
+            logger.info(f'Bulk request: {docs} docs rejected, retry #{attempt + 1} in {delay:.2f}s')
+            metrics.RETRIES.labels(f'aio.{type(self).__name__}._send').inc()
+            if await pause(delay):
+                raise retries.Interrupted(f'Bulk request: {docs} rejected docs not retried')
+
+    @backoff()
+    async def _bulk(self, docs: int, body: bytes) -> Any:
+        """Выполняет bulk-запрос, дождавшись свободного места среди одновременных запросов.
+
+        :param docs: кол-во документов в запросе
+        :param body: тело запроса в формате ndjson
+        :return: ответ elasticsearch
+        """
+        async with self._semaphore:
+            started = time.perf_counter()
+            response = await self.client.bulk(index=self.index, operations=body)
+            latency = time.perf_counter() - started
+        metrics.observe_bulk(f'aio.{type(self).__name__}', docs, len(body), latency)
+        logger.debug(f'Bulk request: {docs} docs, {len(body)} bytes, {latency:.3f}s')
+        return response
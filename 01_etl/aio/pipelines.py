@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any
+
+import metrics
+import producers
+import transformers
+from aio import enrichers, loaders, states
+from aio.producers import Producer
+from aio.utils import backoff
+
+
+@dataclass
+class Pipeline:
+    """Связывает асинхронные компоненты etl в единый пайплайн загрузки.
+
+    Обогащение и загрузка пачек выполняются одновременно, не больше in_flight пачек за раз.
+    Позиция сдвигается строго по порядку пачек: пачка фиксируется, только когда загружены она и все предыдущие."""
+
+    name: str
+    state: states.State
+    producer: Producer
+    enricher: enrichers.Base
+    transformer: transformers.Base
+    loader: loaders.Base
+    logger: logging.Logger
+    in_flight: int = 4
+
+    def __post_init__(self):
+        self.logger = self.logger.getChild(self.name)
+        watermark = self.watermark
+        if isinstance(watermark, producers.Watermark) and watermark != producers.Watermark.initial():
+            metrics.track_watermark(self.name, watermark.modified)
+
+    @property
+    def watermark(self) -> Any:
+        """Возвращает позицию, до которой данные уже загружены, из хранилища состояний.
+
+        :return:
+        """
+        return self.producer.load_watermark(self.state.retrieve_state(self.name))
+
+    @backoff()
+    async def execute(self):
+        """Выполняет загрузку данных из pg в elastic."""
+        total_loaded = 0
+        pending: deque[tuple[producers.Chunk, asyncio.Task]] = deque()
+
+        self.logger.debug('Execution started')
+        self.logger.debug(f'Watermark from state: {self.watermark}')
+        try:
+            num = 0
+            async for chunk in self.producer.produce(self.watermark):
+                num += 1
+                if len(pending) >= self.in_flight:
+                    total_loaded += await self._commit(*pending.popleft())
+                pending.append((chunk, asyncio.ensure_future(self._process(num, chunk))))
+            while pending:
+                total_loaded += await self._commit(*pending.popleft())
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+        self.logger.info(f'Total loaded: {total_loaded}')
+        self.logger.debug('Execution ended')
+
+    async def _process(self, num: int, chunk: producers.Chunk) -> int:
+        """Обогащает, преобразует и загружает пачку.
+
+        :param num: номер пачки
+        :param chunk:
+        :return: кол-во загруженных документов
+        """
+        self.logger.debug(f'#{num}: Chunk size: {len(chunk)}')
+        metrics.CHUNK_ROWS.labels(self.name).observe(len(chunk))
+        with metrics.STAGE_SECONDS.labels(self.name, 'enrich').time():
+            items = await self.enricher.enrich([row.film_work_id for row in chunk])
+        self.logger.debug(f'#{num}: Unique items enriched: {len(items)}')
+
+        with metrics.STAGE_SECONDS.labels(self.name, 'transform').time():
+            items = self.transformer.transform(items)
+        with metrics.STAGE_SECONDS.labels(self.name, 'load').time():
+            loaded = await self.loader.load(items)
+        self.logger.debug(f'#{num}: Items loaded: {loaded}')
+        metrics.DOCUMENTS_LOADED.labels(self.name).inc(loaded)
+        return loaded
+
+    async def _commit(self, chunk: producers.Chunk, task: asyncio.Task) -> int:
+        """Дожидается загрузки пачки и запоминает позицию ее последней строки.
+
+        :param chunk:
+        :param task:
+        :return: кол-во загруженных документов
+        """
+        loaded = await task
+        await self.state.save_state(self.name, self.producer.dump_watermark(self.producer.watermark(chunk)))
+        await self.producer.acknowledge(chunk)
+        metrics.track_watermark(self.name, chunk[-1].modified)
+        return loaded
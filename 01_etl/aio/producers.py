@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, Optional
+
+import producers
+from aio.db import DB
+from producers import Chunk, Row
+
+
+@dataclass
+class Producer:
+    """Асинхронная реализация контракта producers.Base поверх asyncpg.
+
+    Запрос, параметры и позиции в потоке изменений берутся у синхронного продьюсера query,
+    поэтому оба рантайма читают изменения одинаково и хранят позицию в одном формате.
+    Страницы запрашиваются по chunk_size строк, каждая пачка - отдельный запрос с LIMIT."""
+
+    db: DB
+    query: producers.Base
+
+    async def produce(self, watermark: Any) -> AsyncGenerator[Chunk, None]:
+        """Постранично получает из бд айдишники фильмов, в которых внесены изменения.
+
+        :param watermark: позиция, после которой нужно искать изменения
+        :return:
+        """
+        watermark = self.query.start(watermark)
+        while True:
+            params = {**self.query.params(watermark), 'limit': self.query.chunk_size}
+            rows = await self.db.fetch(self.query._sql(), params)
+            if rows:
+                chunk = Chunk([Row(*row) for row in rows])
+                yield chunk
+                watermark = self.watermark(chunk)
+            if len(rows) < self.query.chunk_size:
+                return
+
+    async def acknowledge(self, chunk: Chunk):
+        """Вызывается после того, как пачка загружена и ее позиция сохранена.
+
+        :param chunk:
+        :return:
+        """
+        sql = self.query._acknowledge_sql()
+        if sql is not None:
+            await self.db.execute(sql, ([row.id for row in chunk],))
+
+    def load_watermark(self, value: Optional[str]) -> Any:
+        return self.query.load_watermark(value)
+
+    def dump_watermark(self, watermark: Any) -> str:
+        return self.query.dump_watermark(watermark)
+
+    def watermark(self, chunk: Chunk) -> Any:
+        return self.query.watermark(chunk)
@@ -0,0 +1,90 @@
+import asyncio
+from abc import ABCMeta, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any
+
+from redis import asyncio as aioredis
+
+import states
+
+
+@dataclass
+class BaseStorage(metaclass=ABCMeta):
+    """Базовый класс асинхронного хранилища состояний, повторяет контракт states.BaseStorage."""
+
+    @abstractmethod
+    async def retrieve_state(self) -> dict:
+        """Возвращает сохраненное состояние.
+
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    async def save_state(self, state: dict) -> bool:
+        """Сохраняет переданные поля состояния, остальные поля не меняются.
+
+        :param state:
+        :return:
+        """
+        pass
+
+
+@dataclass
+class RedisStorage(BaseStorage):
+    """Обеспечивает хранение состояния в redis. Использует тот же ключ и формат, что и states.RedisStorage."""
+    redis: aioredis.Redis
+    name: str
+
+    async def retrieve_state(self) -> dict:
+        state = await self.redis.hgetall(self.name)
+        return states.RedisStorage.decode_redis(state)
+
+    async def save_state(self, state: dict) -> None:
+        if state:
+            await self.redis.hset(self.name, mapping=state)
+
+
+@dataclass
+class MemoryStorage(BaseStorage):
+    """Хранит состояние в памяти процесса, как states.MemoryStorage."""
+    state: dict = field(default_factory=dict)
+
+    async def retrieve_state(self) -> dict:
+        return dict(self.state)
+
+    async def save_state(self, state: dict) -> None:
+        self.state.update(state)
+
+
+@dataclass
+class State:
+    """Управляет состоянием. Перед использованием состояние нужно загрузить методом load."""
+
+    storage: BaseStorage
+    _state: dict[str, Any] = field(default_factory=dict)
+    _lock: asyncio.Lock = None
+
+    async def load(self) -> 'State':
+        self._lock = asyncio.Lock()
+        self._state = await self.storage.retrieve_state()
+        return self
+
+    def retrieve_state(self, key: str) -> Any:
+        """Возвращает сохраненное состояние по ключу.
+
+        :param key:
+        :return:
+        """
+        return self._state.get(key)
+
+    async def save_state(self, key: str, value: Any) -> bool:
+        """Сохраняет значение по ключу.
+
+        :param key:
+        :param value:
+        :return:
+        """
+        async with self._lock:
+            self._state[key] = value
+            return await self.storage.save_state({key: value})
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+from functools import wraps
+from typing import Optional
+
+import log
+import retries
+import settings
+from retries import RetryPolicy
+
+# Как часто проверять остановку etl во время паузы
+STOP_CHECK_INTERVAL_SEC = 0.1
+
+
+def backoff(start_sleep_time: float = 0.1,
+            factor: int = 2,
+            border_sleep_time: float = 10,
+            max_tries: Optional[int] = settings.RETRY_MAX_TRIES,
+            logger: logging.Logger = None):
+    """
+    Асинхронный вариант utils.backoff для корутин: повторяет корутину после ошибки по правилам retries.RetryPolicy,
+    ожидая через asyncio.sleep, чтобы не блокировать остальные задачи цикла событий.
+    При остановке etl пауза прерывается, и ошибка пробрасывается без повтора.
+
+    :param start_sleep_time: начальное время повтора
+    :param factor: во сколько раз нужно увеличить время ожидания
+    :param border_sleep_time: граничное время ожидания
+    :param max_tries: сколько всего попыток делать, None - без ограничения
+    :param logger: логгер для ошибок, если не передан, используется по умолчанию из пакета log
+    :return: результат выполнения корутины
+    """
+
+    if logger is None:
+        logger = log.logger
+
+    policy = RetryPolicy(start_sleep_time=start_sleep_time,
+                         factor=factor,
+                         border_sleep_time=border_sleep_time,
+                         max_tries=max_tries,
+                         logger=logger)
+
+    def func_wrapper(func):
+        @wraps(func)
+        async def inner(*args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    if await pause(policy.next_delay(e, attempt, func.__qualname__)):
+                        raise
+                    attempt += 1
+
+        return inner
+
+    return func_wrapper
+
+
+async def pause(seconds: float) -> bool:
+    """Асинхронный вариант retries.pause: ждет перед повтором, прерываясь при остановке etl.
+
+    :param seconds:
+    :return: True, если etl останавливается и повторять не нужно
+    """
+    deadline = time.monotonic() + seconds
+    while not retries.STOPPING.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(remaining, STOP_CHECK_INTERVAL_SEC))
+    return True
+
+
+async def gather(*aws) -> list:
+    """Дожидается всех корутин и при первой ошибке отменяет оставшиеся.
+
+    :param aws:
+    :return: результаты в порядке передачи
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
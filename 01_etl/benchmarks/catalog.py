@@ -0,0 +1,223 @@
+"""Генератор синтетического каталога фильмов для бенчмарков.
+
+Заполняет схему content отдельной бд случайными фильмами, персонами и жанрами.
+Распределения приближены к настоящему каталогу: размер состава фильма имеет тяжелый хвост,
+а небольшая доля популярных персон снимается в большой доле фильмов.
+Бенчмарки подключаются только к бд, явно переданной в --dsn или BENCH_PG_DSN,
+и отказываются работать с бд рабочего etl."""
+
+import argparse
+import bisect
+import io
+import itertools
+import os
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional, Sequence
+from uuid import UUID, uuid4
+
+from psycopg2.extensions import connection, parse_dsn
+
+import settings
+
+ROLES = ('actor', 'writer', 'director')
+
+# Схема на случай, если бенчмарк запускается на пустой бд без миграций django
+SCHEMA = '''
+    CREATE SCHEMA IF NOT EXISTS content;
+    CREATE TABLE IF NOT EXISTS content.film_work (
+        id uuid PRIMARY KEY,
+        title varchar(255) NOT NULL,
+        description text NOT NULL,
+        creation_date date,
+        rating double precision NOT NULL,
+        type varchar(60) NOT NULL,
+        created timestamp with time zone NOT NULL,
+        modified timestamp with time zone NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS content.person (
+        id uuid PRIMARY KEY,
+        full_name varchar(255) NOT NULL,
+        birth_date date,
+        created timestamp with time zone NOT NULL,
+        modified timestamp with time zone NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS content.genre (
+        id uuid PRIMARY KEY,
+        name varchar(255) NOT NULL,
+        description text NOT NULL,
+        created timestamp with time zone NOT NULL,
+        modified timestamp with time zone NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS content.genre_film_work (
+        id uuid PRIMARY KEY,
+        film_work_id uuid NOT NULL REFERENCES content.film_work (id) ON DELETE CASCADE,
+        genre_id uuid NOT NULL REFERENCES content.genre (id) ON DELETE CASCADE,
+        created timestamp with time zone NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS content.person_film_work (
+        id uuid PRIMARY KEY,
+        film_work_id uuid NOT NULL REFERENCES content.film_work (id) ON DELETE CASCADE,
+        person_id uuid NOT NULL REFERENCES content.person (id) ON DELETE CASCADE,
+        role varchar(255),
+        created timestamp with time zone NOT NULL,
+        UNIQUE (film_work_id, person_id)
+    );
+    CREATE INDEX IF NOT EXISTS person_film_work_film_work_id_idx ON content.person_film_work (film_work_id);
+    CREATE INDEX IF NOT EXISTS genre_film_work_film_work_id_idx ON content.genre_film_work (film_work_id);
+'''
+
+
+@dataclass
+class Catalog:
+    """Параметры синтетического каталога."""
+
+    films: int = 10000
+    persons: int = 5000
+    genres: int = 30
+    max_genres_per_film: int = 5
+    max_cast_size: int = 100
+    # Распределение размера состава: uniform - равномерное от 1 до max_cast_size,
+    # pareto - степенное с минимумом min_cast_size, большинство фильмов с небольшим составом
+    cast_distribution: str = 'uniform'
+    min_cast_size: int = 5
+    cast_alpha: float = 1.5
+    # Показатель закона Ципфа для популярности персон, 0 - все персоны равновероятны
+    person_skew: float = 0
+    # За сколько дней до генерации распределены даты изменения
+    modified_days: int = 365
+    seed: int = 0
+
+    def cast_size(self, rnd: random.Random) -> int:
+        """Возвращает размер состава фильма.
+
+        :param rnd:
+        :return:
+        """
+        if self.cast_distribution == 'pareto':
+            return min(int(self.min_cast_size * rnd.paretovariate(self.cast_alpha)), self.max_cast_size)
+        return rnd.randint(1, self.max_cast_size)
+
+    def person_weights(self) -> list[float]:
+        """Возвращает накопленные веса выбора персон, первая персона самая популярная.
+
+        :return:
+        """
+        return list(itertools.accumulate(1 / (rank ** self.person_skew) for rank in range(1, self.persons + 1)))
+
+
+def add_dsn_argument(parser: argparse.ArgumentParser):
+    """Добавляет аргумент с подключением к бд бенчмарка.
+
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_PG_DSN'),
+                        help='подключение к отдельной бд бенчмарка в формате libpq, по умолчанию BENCH_PG_DSN')
+
+
+def benchmark_dsn(parser: argparse.ArgumentParser, dsn: Optional[str]) -> dict:
+    """Возвращает параметры подключения к бд бенчмарка.
+
+    Завершает запуск, если бд не задана или совпадает с бд рабочего etl:
+    синтетический каталог и нагрузка бенчмарка не должны попасть в рабочую бд и ее уведомления.
+
+    :param parser:
+    :param dsn: строка подключения libpq
+    :return: параметры для psycopg2.connect и DB
+    """
+    if not dsn:
+        parser.error('benchmark database is required: pass --dsn or set BENCH_PG_DSN')
+    params = {**settings.PG_DSN, **parse_dsn(dsn)}
+    target = (params['host'], str(params['port']), params['dbname'])
+    if target == (settings.PG_DSN['host'], str(settings.PG_DSN['port']), settings.PG_DSN['dbname']):
+        parser.error(f'{target[2]} on {target[0]}:{target[1]} is the etl database, benchmarks need a separate one')
+    return params
+
+
+def generate(conn: connection, catalog: Catalog) -> list[UUID]:
+    """Создает схему, если ее нет, и заполняет ее синтетическим каталогом.
+
+    :param conn:
+    :param catalog:
+    :return: id созданных фильмов
+    """
+    rnd = random.Random(catalog.seed)
+    now = datetime.now(timezone.utc)
+
+    film_ids = [uuid4() for _ in range(catalog.films)]
+    person_ids = [uuid4() for _ in range(catalog.persons)]
+    genre_ids = [uuid4() for _ in range(catalog.genres)]
+    person_weights = catalog.person_weights()
+
+    def modified() -> str:
+        return (now - timedelta(seconds=rnd.uniform(0, catalog.modified_days * 86400))).isoformat()
+
+    with conn.cursor() as curs:
+        curs.execute(SCHEMA)
+        _copy(curs, 'content.genre', ('id', 'name', 'description', 'created', 'modified'),
+              ((genre_id, f'Genre {num}', '', now, modified()) for num, genre_id in enumerate(genre_ids)))
+        _copy(curs, 'content.person', ('id', 'full_name', 'created', 'modified'),
+              ((person_id, f'Person {num}', now, modified()) for num, person_id in enumerate(person_ids)))
+        _copy(curs, 'content.film_work',
+              ('id', 'title', 'description', 'rating', 'type', 'created', 'modified'),
+              ((film_id, f'Film {num}', f'Description of film {num}', round(rnd.uniform(0, 10), 1),
+                rnd.choice(('movie', 'tv_show')), now, modified())
+               for num, film_id in enumerate(film_ids)))
+        max_genres = min(catalog.max_genres_per_film, len(genre_ids))
+        _copy(curs, 'content.genre_film_work', ('id', 'film_work_id', 'genre_id', 'created'),
+              ((uuid4(), film_id, genre_id, now)
+               for film_id in film_ids
+               for genre_id in rnd.sample(genre_ids, rnd.randint(1, max_genres))))
+        _copy(curs, 'content.person_film_work', ('id', 'film_work_id', 'person_id', 'role', 'created'),
+              ((uuid4(), film_id, person_id, rnd.choice(ROLES), now)
+               for film_id in film_ids
+               for person_id in _sample(rnd, person_ids, person_weights, catalog.cast_size(rnd))))
+        curs.execute('ANALYZE')
+    conn.commit()
+    return film_ids
+
+
+def _sample(rnd: random.Random, items: Sequence, cum_weights: list[float], size: int) -> list:
+    """Выбирает size разных элементов с учетом весов.
+
+    :param rnd:
+    :param items:
+    :param cum_weights: накопленные веса элементов
+    :param size:
+    :return:
+    """
+    size = min(size, len(items))
+    if size * 2 > len(items):
+        return rnd.sample(items, size)
+    chosen = set()
+    while len(chosen) < size:
+        chosen.add(bisect.bisect(cum_weights, rnd.random() * cum_weights[-1]))
+    return [items[num] for num in chosen]
+
+
+def _copy(curs, table: str, columns: tuple[str, ...], rows: Iterable[tuple], batch_size: int = 100000):
+    """Загружает строки в таблицу через COPY порциями.
+
+    :param curs:
+    :param table:
+    :param columns:
+    :param rows:
+    :param batch_size: кол-во строк в одном COPY
+    :return:
+    """
+    buffer = io.StringIO()
+    for num, row in enumerate(rows, start=1):
+        buffer.write('\t'.join(str(value) for value in row))
+        buffer.write('\n')
+        if num % batch_size == 0:
+            _flush(curs, table, columns, buffer)
+    _flush(curs, table, columns, buffer)
+
+
+def _flush(curs, table: str, columns: tuple[str, ...], buffer: io.StringIO):
+    buffer.seek(0)
+    curs.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buffer)
+    buffer.seek(0)
+    buffer.truncate()
@@ -0,0 +1,120 @@
+"""Сравнивает запрос обогатителя фильмов с прежним запросом, соединявшим жанры и персоны в одном GROUP BY.
+
+Запуск из каталога 01_etl:
+    python benchmarks/enrich.py --dsn "dbname=movies_bench" --generate --films 20000 --max-cast-size 120
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+import psycopg2
+
+sys.path.append(
+    os.path.dirname(
+        os.path.dirname(os.path.realpath(__file__)),
+    ),
+)
+
+import enrichers  # noqa: E402
+import settings  # noqa: E402
+from benchmarks import catalog  # noqa: E402
+
+# Запрос обогатителя до перехода на lateral-подзапросы
+CARTESIAN_SQL = '''
+    SELECT
+        fw.id,
+        fw.title,
+        fw.description,
+        fw.rating,
+        COALESCE (
+            json_agg(
+               DISTINCT jsonb_build_object(
+                   'id', p.id,
+                   'role', pfw.role,
+                   'full_name', p.full_name
+               )
+           ) FILTER (WHERE p.id is not null),
+           '[]'
+        ) as persons,
+        array_agg(DISTINCT g.name) as genres
+    FROM content.film_work fw
+    LEFT JOIN content.genre_film_work gfw ON fw.id = gfw.film_work_id
+    LEFT JOIN genre g on g.id = gfw.genre_id
+    LEFT JOIN person_film_work pfw on fw.id = pfw.film_work_id
+    LEFT JOIN person p on p.id = pfw.person_id
+    WHERE fw.id = ANY(%s)
+    GROUP BY fw.id
+'''
+
+
+def measure(curs, sql: str, chunks: list[list]) -> list[float]:
+    """Выполняет запрос для каждой пачки id и возвращает время выполнения.
+
+    :param curs:
+    :param sql:
+    :param chunks:
+    :return:
+    """
+    timings = []
+    for chunk in chunks:
+        started = time.perf_counter()
+        curs.execute(sql, (chunk,))
+        curs.fetchall()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name: str, timings: list[float], rows: int):
+    timings = sorted(timings)
+    print(f'{name:>10}: total {sum(timings):8.3f}s  '
+          f'p50 {statistics.median(timings) * 1000:8.1f}ms  '
+          f'max {timings[-1] * 1000:8.1f}ms  '
+          f'{rows / sum(timings):10.0f} films/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    catalog.add_dsn_argument(parser)
+    parser.add_argument('--generate', action='store_true', help='заполнить бд синтетическим каталогом')
+    parser.add_argument('--films', type=int, default=catalog.Catalog.films)
+    parser.add_argument('--persons', type=int, default=catalog.Catalog.persons)
+    parser.add_argument('--genres', type=int, default=catalog.Catalog.genres)
+    parser.add_argument('--max-cast-size', type=int, default=catalog.Catalog.max_cast_size)
+    parser.add_argument('--chunk-size', type=int, default=settings.CHUNK_SIZE)
+    parser.add_argument('--chunks', type=int, default=10, help='кол-во пачек в замере')
+    args = parser.parse_args()
+    dsn = catalog.benchmark_dsn(parser, args.dsn)
+
+    with psycopg2.connect(**dsn) as conn:
+        if args.generate:
+            catalog.generate(conn, catalog.Catalog(films=args.films,
+                                                   persons=args.persons,
+                                                   genres=args.genres,
+                                                   max_cast_size=args.max_cast_size))
+
+        with conn.cursor() as curs:
+            curs.execute('SELECT id FROM content.film_work')
+            film_ids = [row[0] for row in curs.fetchall()]
+            random.Random(0).shuffle(film_ids)
+            chunks = [film_ids[start:start + args.chunk_size]
+                      for start in range(0, min(len(film_ids), args.chunk_size * args.chunks), args.chunk_size)]
+            rows = sum(len(chunk) for chunk in chunks)
+
+            # прогрев кэша, чтобы первый запрос не читал с диска за оба
+            measure(curs, enrichers.Movie._sql(), chunks[:1])
+
+            cartesian = measure(curs, CARTESIAN_SQL, chunks)
+            lateral = measure(curs, enrichers.Movie._sql(), chunks)
+
+    print(f'{len(chunks)} chunks of {args.chunk_size} films')
+    report('cartesian', cartesian, rows)
+    report('lateral', lateral, rows)
+    print(f'speedup: {sum(cartesian) / sum(lateral):.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Сравнивает пропускную способность синхронного и асинхронного рантаймов на одном синтетическом каталоге.
+
+Каждый рантайм загружает все фильмы каталога с начала потока изменений в отдельный индекс,
+позиции хранятся в памяти и не затрагивают состояние рабочего etl.
+
+Запуск из каталога 01_etl:
+    python benchmarks/runtimes.py --dsn "dbname=movies_bench" --generate --films 20000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import psycopg2
+from elasticsearch import Elasticsearch
+
+sys.path.append(
+    os.path.dirname(
+        os.path.dirname(os.path.realpath(__file__)),
+    ),
+)
+
+import enrichers  # noqa: E402
+import etl  # noqa: E402
+import loaders  # noqa: E402
+import producers  # noqa: E402
+import settings  # noqa: E402
+import states  # noqa: E402
+import transformers  # noqa: E402
+from aio import app as aio_app  # noqa: E402
+from aio import enrichers as aio_enrichers  # noqa: E402
+from aio import loaders as aio_loaders  # noqa: E402
+from aio import states as aio_states  # noqa: E402
+from aio.db import DB as AsyncDB  # noqa: E402
+from aio.pipelines import Pipeline as AsyncPipeline  # noqa: E402
+from aio.producers import Producer  # noqa: E402
+from benchmarks import catalog  # noqa: E402
+from db import DB  # noqa: E402
+from log import logger  # noqa: E402
+from pipelines import Pipeline  # noqa: E402
+
+INDEX = 'movies_benchmark'
+
+
+def recreate_index(es: Elasticsearch):
+    with open(os.path.join(os.path.dirname(settings.ES_SCHEMAS_PATH), 'movies.json')) as f:
+        schema = json.load(f)
+    es.indices.delete(index=INDEX, ignore_unavailable=True)
+    es.indices.create(index=INDEX, settings=schema['settings'], mappings=schema['mappings'])
+
+
+def run_sync(args, dsn: dict) -> float:
+    db = DB(dsn=dsn, max_size=2)
+    pipeline = Pipeline(
+        name='FilmworkModified',
+        state=states.State(states.MemoryStorage()),
+        producer=producers.FilmworkModified(db, args.chunk_size, settings.PRODUCER_PAGE_SIZE),
+        enricher=enrichers.MovieDocument(db),
+        transformer=transformers.Passthrough(),
+        loader=loaders.ElasticSearchRawMovie(client=etl.create_es_client(), index=INDEX,
+                                             thread_count=args.bulk_threads),
+        logger=logger,
+    )
+    started = time.perf_counter()
+    pipeline.execute()
+    elapsed = time.perf_counter() - started
+    db.close()
+    return elapsed
+
+
+async def run_async(args, dsn: dict) -> float:
+    db = AsyncDB(dsn=dsn, max_size=args.in_flight + 1)
+    es_client = aio_app.create_es_client()
+    pipeline = AsyncPipeline(
+        name='FilmworkModified',
+        state=await aio_states.State(aio_states.MemoryStorage()).load(),
+        producer=Producer(db, producers.FilmworkModified(None, args.chunk_size)),
+        enricher=aio_enrichers.MovieDocument(db),
+        transformer=transformers.Passthrough(),
+        loader=aio_loaders.ElasticSearchRawMovie(client=es_client, index=INDEX, concurrency=args.bulk_concurrency),
+        logger=logger,
+        in_flight=args.in_flight,
+    )
+    started = time.perf_counter()
+    try:
+        await pipeline.execute()
+        return time.perf_counter() - started
+    finally:
+        await es_client.close()
+        await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    catalog.add_dsn_argument(parser)
+    parser.add_argument('--generate', action='store_true', help='заполнить бд синтетическим каталогом')
+    parser.add_argument('--films', type=int, default=catalog.Catalog.films)
+    parser.add_argument('--persons', type=int, default=catalog.Catalog.persons)
+    parser.add_argument('--max-cast-size', type=int, default=catalog.Catalog.max_cast_size)
+    parser.add_argument('--chunk-size', type=int, default=settings.CHUNK_SIZE)
+    parser.add_argument('--bulk-threads', type=int, default=settings.ES_BULK_THREADS)
+    parser.add_argument('--bulk-concurrency', type=int, default=settings.ES_BULK_CONCURRENCY)
+    parser.add_argument('--in-flight', type=int, default=settings.ASYNC_CHUNKS_IN_FLIGHT,
+                        help='кол-во пачек, одновременно обрабатываемых асинхронным рантаймом')
+    args = parser.parse_args()
+    dsn = catalog.benchmark_dsn(parser, args.dsn)
+
+    if args.generate:
+        with psycopg2.connect(**dsn) as conn:
+            catalog.generate(conn, catalog.Catalog(films=args.films,
+                                                   persons=args.persons,
+                                                   max_cast_size=args.max_cast_size))
+
+    es = etl.create_es_client()
+    results = {}
+    for name, run in (('sync', run_sync), ('async', lambda a, d: asyncio.run(run_async(a, d)))):
+        recreate_index(es)
+        elapsed = run(args, dsn)
+        es.indices.refresh(index=INDEX)
+        results[name] = (es.count(index=INDEX)['count'], elapsed)
+    es.indices.delete(index=INDEX)
+
+    for name, (docs, elapsed) in results.items():
+        print(f'{name:>6}: {docs} docs in {elapsed:8.3f}s  {docs / elapsed:10.0f} docs/s')
+    print(f'speedup: {results["sync"][1] / results["async"][1]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
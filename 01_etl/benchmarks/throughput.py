@@ -0,0 +1,178 @@
+"""Замеряет пропускную способность etl от начала до конца: Pipeline.execute по всему каталогу.
+
+Загружает все фильмы с начала потока изменений в отдельный индекс или в заглушку bulk-api,
+позиции хранятся в памяти и не затрагивают состояние рабочего etl.
+Выводит документы в секунду, задержку обработки пачки p50/p99 и пиковое потребление памяти.
+
+Запуск из каталога 01_etl:
+    python benchmarks/throughput.py --dsn "dbname=movies_bench" --generate --films 1000000 --persons 300000 \\
+        --cast-distribution pareto --person-skew 1.1 --target stub
+"""
+
+import argparse
+import os
+import resource
+import statistics
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterable
+
+import psycopg2
+
+sys.path.append(
+    os.path.dirname(
+        os.path.dirname(os.path.realpath(__file__)),
+    ),
+)
+
+import chunking  # noqa: E402
+import enrichers  # noqa: E402
+import etl  # noqa: E402
+import loaders  # noqa: E402
+import producers  # noqa: E402
+import settings  # noqa: E402
+import states  # noqa: E402
+import transformers  # noqa: E402
+from benchmarks import catalog  # noqa: E402
+from benchmarks.runtimes import INDEX, recreate_index  # noqa: E402
+from db import DB  # noqa: E402
+from log import logger  # noqa: E402
+from pipelines import Pipeline, StagedPipeline  # noqa: E402
+
+
+@dataclass
+class StubClient:
+    """Заглушка bulk-api elasticsearch: принимает любые документы и отвечает без ошибок.
+
+    Позволяет замерить etl без elasticsearch, задержка ответа моделируется per_request_sec и per_mb_sec."""
+
+    per_request_sec: float = 0
+    per_mb_sec: float = 0
+
+    def bulk(self, index: str, operations: bytes, **kwargs) -> dict:
+        time.sleep(self.per_request_sec + len(operations) / 1024 / 1024 * self.per_mb_sec)
+        return {'errors': False, 'items': []}
+
+
+class ChunkTimer:
+    """Замеряет время от начала обогащения пачки до окончания ее загрузки и считает загруженные документы."""
+
+    latencies: list[float]
+    loaded: int
+    _started: dict[int, float]
+
+    def _enrich(self, num: int, chunk: producers.Chunk) -> Iterable[Any]:
+        self._started[num] = time.perf_counter()
+        return super()._enrich(num, chunk)
+
+    def _load(self, num: int, chunk: producers.Chunk, items: Iterable[Any]) -> int:
+        loaded = super()._load(num, chunk, items)
+        self.latencies.append(time.perf_counter() - self._started.pop(num))
+        self.loaded += loaded
+        return loaded
+
+
+@dataclass
+class TimedPipeline(ChunkTimer, Pipeline):
+    latencies: list[float] = field(default_factory=list)
+    loaded: int = 0
+    _started: dict[int, float] = field(default_factory=dict)
+
+
+@dataclass
+class TimedStagedPipeline(ChunkTimer, StagedPipeline):
+    latencies: list[float] = field(default_factory=list)
+    loaded: int = 0
+    _started: dict[int, float] = field(default_factory=dict)
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100)[q - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    catalog.add_dsn_argument(parser)
+    parser.add_argument('--generate', action='store_true', help='заполнить бд синтетическим каталогом')
+    parser.add_argument('--films', type=int, default=catalog.Catalog.films)
+    parser.add_argument('--persons', type=int, default=catalog.Catalog.persons)
+    parser.add_argument('--genres', type=int, default=catalog.Catalog.genres)
+    parser.add_argument('--max-cast-size', type=int, default=catalog.Catalog.max_cast_size)
+    parser.add_argument('--cast-distribution', choices=('uniform', 'pareto'), default='pareto')
+    parser.add_argument('--person-skew', type=float, default=1.1)
+    parser.add_argument('--target', choices=('es', 'stub'), default='stub',
+                        help='куда загружать документы: отдельный индекс elasticsearch или заглушка bulk-api')
+    parser.add_argument('--stub-request-ms', type=float, default=5, help='задержка ответа заглушки на запрос')
+    parser.add_argument('--stub-ms-per-mb', type=float, default=20, help='задержка ответа заглушки на мегабайт')
+    parser.add_argument('--mode', choices=('sequential', 'staged'), default=settings.PIPELINE_MODE)
+    parser.add_argument('--chunk-size', type=int, default=settings.CHUNK_SIZE)
+    parser.add_argument('--bulk-threads', type=int, default=settings.ES_BULK_THREADS)
+    parser.add_argument('--adaptive', action='store_true',
+                        help='подбирать размер пачек под --target-ms, начиная с --chunk-size')
+    parser.add_argument('--target-ms', type=float, default=settings.CHUNK_TARGET_SEC * 1000)
+    args = parser.parse_args()
+    dsn = catalog.benchmark_dsn(parser, args.dsn)
+
+    if args.generate:
+        with psycopg2.connect(**dsn) as conn:
+            catalog.generate(conn, catalog.Catalog(films=args.films,
+                                                   persons=args.persons,
+                                                   genres=args.genres,
+                                                   max_cast_size=args.max_cast_size,
+                                                   cast_distribution=args.cast_distribution,
+                                                   person_skew=args.person_skew))
+
+    if args.target == 'es':
+        client = etl.create_es_client()
+        recreate_index(client)
+    else:
+        client = StubClient(per_request_sec=args.stub_request_ms / 1000, per_mb_sec=args.stub_ms_per_mb / 1000)
+
+    db = DB(dsn=dsn, max_size=3)
+    pipeline_cls = TimedStagedPipeline if args.mode == 'staged' else TimedPipeline
+    pipeline = pipeline_cls(
+        name='FilmworkModified',
+        state=states.State(states.MemoryStorage()),
+        producer=producers.FilmworkModified(db, args.chunk_size, settings.PRODUCER_PAGE_SIZE),
+        enricher=enrichers.MovieDocument(db),
+        transformer=transformers.Passthrough(),
+        loader=loaders.ElasticSearchRawMovie(client=client,
+                                             index=INDEX,
+                                             thread_count=args.bulk_threads,
+                                             max_batch_docs=settings.ES_BULK_MAX_DOCS,
+                                             max_batch_bytes=settings.ES_BULK_MAX_BYTES),
+        logger=logger,
+    )
+    if args.adaptive:
+        pipeline.sizer = chunking.ChunkSizer(size=args.chunk_size,
+                                             min_size=settings.CHUNK_SIZE_MIN,
+                                             max_size=settings.CHUNK_SIZE_MAX,
+                                             target_seconds=args.target_ms / 1000,
+                                             target_bytes=settings.CHUNK_TARGET_BYTES or None)
+
+    started = time.perf_counter()
+    pipeline.execute()
+    elapsed = time.perf_counter() - started
+    db.close()
+
+    docs = pipeline.loaded
+    if args.target == 'es':
+        client.indices.delete(index=INDEX)
+
+    latencies = pipeline.latencies
+    chunks = f'adaptive chunks ending at {pipeline.sizer.size}' if args.adaptive else f'chunks of {args.chunk_size}'
+    print(f'{args.mode} pipeline, {args.target} target, {len(latencies)} {chunks}')
+    print(f'docs:        {docs}')
+    print(f'elapsed:     {elapsed:.3f}s')
+    print(f'throughput:  {docs / elapsed:.0f} docs/s')
+    print(f'chunk p50:   {percentile(latencies, 50) * 1000:.1f}ms')
+    print(f'chunk p99:   {percentile(latencies, 99) * 1000:.1f}ms')
+    # ru_maxrss в linux измеряется в килобайтах
+    print(f'peak rss:    {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional, TypeVar
+
+import documents
+
+T = TypeVar('T')
+
+
+@dataclass
+class ChunkSizer:
+    """Подбирает размер пачки под бюджет времени обработки и объема документов.
+
+    После каждой пачки уточняет среднее время обработки и средний объем документов на одну строку
+    и выбирает размер, при котором пачка укладывается в оба бюджета. Среднее сглаживается,
+    поэтому одна пачка с большими сериалами не обрушивает размер, а серия таких пачек уменьшает его.
+    За одну пачку размер меняется не больше чем в max_step раз и не выходит за min_size и max_size."""
+
+    size: int
+    min_size: int
+    max_size: int
+    # Сколько секунд должны занимать обогащение, преобразование и загрузка одной пачки
+    target_seconds: float
+    # Сколько байт документов должна давать одна пачка, None - объем не ограничивается
+    target_bytes: Optional[int] = None
+    # Вес последней пачки в скользящем среднем
+    smoothing: float = 0.3
+    max_step: float = 2
+    _seconds_per_row: Optional[float] = None
+    _bytes_per_row: Optional[float] = None
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self):
+        self.size = self._clamp(self.size)
+
+    def observe(self, rows: int, seconds: float, payload_bytes: Optional[int] = None) -> int:
+        """Учитывает обработанную пачку и пересчитывает размер следующих пачек.
+
+        :param rows: кол-во строк в пачке
+        :param seconds: время обработки пачки
+        :param payload_bytes: объем документов пачки, None - если неизвестен
+        :return: новый размер пачки
+        """
+        if rows <= 0:
+            return self.size
+        with self._lock:
+            self._seconds_per_row = self._average(self._seconds_per_row, seconds / rows)
+            if payload_bytes is not None:
+                self._bytes_per_row = self._average(self._bytes_per_row, payload_bytes / rows)
+
+            candidates = []
+            if self._seconds_per_row > 0:
+                candidates.append(self.target_seconds / self._seconds_per_row)
+            if self.target_bytes is not None and self._bytes_per_row:
+                candidates.append(self.target_bytes / self._bytes_per_row)
+            if candidates:
+                wanted = min(min(candidates), self.size * self.max_step)
+                self.size = self._clamp(int(max(wanted, self.size / self.max_step)))
+            return self.size
+
+    def _average(self, previous: Optional[float], value: float) -> float:
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    def _clamp(self, size: int) -> int:
+        return max(self.min_size, min(self.max_size, size))
+
+
+@dataclass
+class PayloadMeter:
+    """Считает примерный объем готовых json-документов, проходящих через поток.
+
+    Объем остается None, если документы еще не сериализованы."""
+
+    bytes: Optional[int] = None
+
+    def wrap(self, items: Iterable[T]) -> Iterator[T]:
+        """Отдает документы, добавляя их объем к счетчику.
+
+        :param items: документы пачки после преобразования
+        :return:
+        """
+        for item in items:
+            if isinstance(item, documents.RawMovie):
+                self.bytes = (self.bytes or 0) + len(item.source)
+            yield item
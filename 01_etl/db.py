@@ -1,45 +1,206 @@
+import logging
+import threading
+import time
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
+from uuid import uuid4
 
 import psycopg2
 from psycopg2.extensions import connection, cursor
+from psycopg2.pool import ThreadedConnectionPool
+
+import log
+import metrics
 
 
 @dataclass
 class DB:
-    """Оберта для работы с бд."""
+    """Оберта для работы с бд.
+
+    Держит пул постоянных соединений, общий для всех продьюсеров и обогатителей.
+    Поток, у которого уже открыт курсор, получает вложенные курсоры на том же соединении.
+    Ожидание соединений и занятость пула отдаются в метрики, по ним подбирается размер пула."""
     dsn: dict
-    _cursor_num: int = 0
-    _conn: Optional[connection] = None
+    min_size: int = 1
+    max_size: int = 4
+    # Как часто проверять простаивающее соединение перед выдачей
+    health_check_interval_sec: float = 30
+    # Ожидание соединения дольше этого времени попадает в лог
+    wait_warning_sec: float = 0.01
+    logger: logging.Logger = log.logger
+    _pool: Optional[ThreadedConnectionPool] = None
+    _slots: threading.BoundedSemaphore = field(init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _local: threading.local = field(default_factory=threading.local)
+    _checked_at: dict[int, float] = field(default_factory=dict)
+    # Отдельные соединения потоков для autocommit_cursor
+    _autocommit: list[connection] = field(default_factory=list)
+
+    def __post_init__(self):
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        metrics.PG_POOL_MAX_SIZE.set(self.max_size)
 
     def connected(self) -> bool:
-        return self._conn and self._conn.closed == 0
+        conn = getattr(self._local, 'conn', None)
+        return conn is not None and conn.closed == 0
 
     @contextmanager
-    def cursor(self) -> cursor:
-        """Возвращает курсор.
-        Если кол-во открытых курсоров равно 0, закрывает соединение с бд."""
+    def cursor(self, server_side: bool = False, itersize: Optional[int] = None) -> cursor:
+        """Возвращает курсор на соединении из пула.
+        Когда закрывается последний курсор потока, фиксирует транзакцию и возвращает соединение в пул.
+
+        :param server_side: создать именованный курсор, результат запроса остается на сервере
+            и передается клиенту порциями по мере чтения
+        :param itersize: размер порции, получаемой с сервера за раз при итерации по именованному курсору
+        """
+        conn = self._acquire()
+        curs = None
+        failed = False
         try:
-            if not self.connected():
-                self._connect()
-            self._cursor_num += 1
-            yield self._conn.cursor()
+            curs = conn.cursor(name=f'etl_{uuid4().hex}' if server_side else None)
+            if itersize:
+                curs.itersize = itersize
+            yield curs
+        except BaseException:
+            failed = True
+            raise
         finally:
-            self._cursor_num -= 1
-            if self._cursor_num == 0:
-                self._close()
+            if curs is not None and conn.closed == 0:
+                # noinspection PyBroadException
+                try:
+                    curs.close()
+                except Exception:
+                    pass
+            self._release(failed)
+
+    @contextmanager
+    def autocommit_cursor(self) -> cursor:
+        """Возвращает курсор, каждый запрос которого фиксируется сразу, независимо от транзакции курсоров потока.
+
+        Курсор открывается на отдельном соединении потока в режиме autocommit. Соединение не берется из пула:
+        поток, который уже занял соединение пула, не ждет второго, поэтому потоки не блокируют друг друга.
+        """
+        conn = getattr(self._local, 'autocommit', None)
+        if conn is None or conn.closed != 0:
+            conn = psycopg2.connect(**self.dsn)
+            conn.set_session(autocommit=True)
+            self._local.autocommit = conn
+            with self._lock:
+                self._autocommit = [other for other in self._autocommit if other.closed == 0] + [conn]
+        with conn.cursor() as curs:
+            yield curs
+
+    def close(self):
+        """Закрывает все соединения пула и отдельные соединения потоков."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            self._checked_at.clear()
+            for conn in self._autocommit:
+                if conn.closed == 0:
+                    conn.close()
+            self._autocommit.clear()
+
+    def _acquire(self) -> connection:
+        """Берет соединение из пула или возвращает уже занятое текущим потоком.
+
+        :return:
+        """
+        if getattr(self._local, 'depth', 0):
+            self._local.depth += 1
+            return self._local.conn
+
+        started = time.monotonic()
+        self._slots.acquire()
+        waited = time.monotonic() - started
+        try:
+            conn = self._checkout()
+        except BaseException:
+            self._slots.release()
+            raise
 
-    def _connect(self):
-        self._close()
-        self._conn = psycopg2.connect(**self.dsn)
+        self._record_wait(waited)
+        metrics.PG_POOL_IN_USE.inc()
+        self._local.conn = conn
+        self._local.depth = 1
+        return conn
 
-    def _close(self):
-        if self.connected():
-            # noinspection PyBroadException
+    def _release(self, failed: bool):
+        """Возвращает соединение в пул, когда закрыт последний курсор потока.
+
+        Сломанное соединение закрывается, вместо него пул откроет новое.
+
+        :param failed: при работе с курсором произошла ошибка, транзакцию нужно откатить
+        :return:
+        """
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+
+        conn = self._local.conn
+        self._local.conn = None
+        broken = conn.closed != 0
+        if not broken:
             try:
-                self._conn.close()
-            except Exception:
-                pass
+                if failed:
+                    conn.rollback()
+                else:
+                    conn.commit()
+            except psycopg2.Error:
+                broken = True
+
+        with self._lock:
+            if broken:
+                self._checked_at.pop(id(conn), None)
+            else:
+                self._checked_at[id(conn)] = time.monotonic()
+            if self._pool is not None:
+                self._pool.putconn(conn, close=broken)
+        self._slots.release()
+        metrics.PG_POOL_IN_USE.dec()
+
+    def _checkout(self) -> connection:
+        """Берет из пула живое соединение, при необходимости переподключаясь.
+
+        :return:
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(self.min_size, self.max_size, **self.dsn)
+            conn = self._pool.getconn()
+        if self._healthy(conn):
+            return conn
+
+        self.logger.info('Broken connection discarded, reconnecting')
+        with self._lock:
+            self._checked_at.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+            return self._pool.getconn()
+
+    def _healthy(self, conn: connection) -> bool:
+        """Проверяет соединение, простаивавшее дольше health_check_interval_sec.
+
+        :param conn:
+        :return:
+        """
+        if conn.closed != 0:
+            return False
+        checked_at = self._checked_at.get(id(conn))
+        if checked_at is not None and time.monotonic() - checked_at < self.health_check_interval_sec:
+            return True
+
+        try:
+            with conn.cursor() as curs:
+                curs.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        self._checked_at[id(conn)] = time.monotonic()
+        return True
 
-        self._conn = None
+    def _record_wait(self, waited: float):
+        metrics.PG_POOL_WAIT_SECONDS.observe(waited)
+        if waited >= self.wait_warning_sec:
+            self.logger.debug(f'Waited {waited:.3f}s for a db connection')
@@ -0,0 +1,112 @@
+import json
+from abc import ABCMeta, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any
+
+import redis
+
+import retries
+
+
+@dataclass
+class Base(metaclass=ABCMeta):
+    """Базовый класс для очереди документов, которые elasticsearch отклонил при загрузке."""
+
+    @abstractmethod
+    def add(self, errors: dict[str, Any]) -> None:
+        """Добавляет документы в очередь. Повторно добавленный документ увеличивает счетчик попыток.
+
+        :param errors: ошибки elasticsearch по id документов
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def retrieve(self, limit: int) -> dict[str, dict]:
+        """Возвращает документы из очереди.
+
+        :param limit: сколько документов вернуть
+        :return: запись об ошибке по id документов
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, ids: list[str]) -> None:
+        pass
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+
+@dataclass
+class RedisDeadLetters(Base):
+    """Хранит отклоненные документы в хэше redis: id документа - json с ошибкой, временем и кол-вом попыток."""
+
+    redis: redis.Redis
+    name: str
+
+    @retries.policy('redis')
+    def add(self, errors: dict[str, Any]) -> None:
+        if not errors:
+            return
+        ids = list(errors)
+        stored = self.redis.hmget(self.name, ids)
+        self.redis.hset(self.name, mapping={
+            doc_id: json.dumps(entry(errors[doc_id], json.loads(old) if old is not None else None), default=str)
+            for doc_id, old in zip(ids, stored)
+        })
+
+    @retries.policy('redis')
+    def retrieve(self, limit: int) -> dict[str, dict]:
+        entries = {}
+        for doc_id, value in self.redis.hscan_iter(self.name, count=limit):
+            entries[doc_id.decode()] = json.loads(value)
+            if len(entries) >= limit:
+                break
+        return entries
+
+    @retries.policy('redis')
+    def remove(self, ids: list[str]) -> None:
+        if ids:
+            self.redis.hdel(self.name, *ids)
+
+    @retries.policy('redis')
+    def count(self) -> int:
+        return self.redis.hlen(self.name)
+
+
+@dataclass
+class MemoryDeadLetters(Base):
+    """Хранит отклоненные документы в памяти процесса."""
+
+    entries: dict[str, dict] = field(default_factory=dict)
+
+    def add(self, errors: dict[str, Any]) -> None:
+        for doc_id, error in errors.items():
+            self.entries[doc_id] = entry(error, self.entries.get(doc_id))
+
+    def retrieve(self, limit: int) -> dict[str, dict]:
+        return dict(list(self.entries.items())[:limit])
+
+    def remove(self, ids: list[str]) -> None:
+        for doc_id in ids:
+            self.entries.pop(doc_id, None)
+
+    def count(self) -> int:
+        return len(self.entries)
+
+
+def entry(error: Any, previous: dict = None) -> dict:
+    """Создает запись об ошибке документа.
+
+    :param error: ошибка из ответа elasticsearch
+    :param previous: прежняя запись о том же документе
+    :return:
+    """
+    return dict(
+        error=error,
+        failed_at=datetime.now(timezone.utc).isoformat(),
+        attempts=(previous or {}).get('attempts', 0) + 1,
+    )
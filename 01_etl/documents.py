@@ -1,3 +1,4 @@
+from typing import NamedTuple
 from uuid import UUID
 
 from pydantic import BaseModel
@@ -19,3 +20,9 @@ class Movie(BaseModel):
     writers_names: list[str]
     actors: list[Person]
     writers: list[Person]
+
+
+class RawMovie(NamedTuple):
+    """Документ фильма, собранный в postgres и уже сериализованный в json."""
+    id: UUID
+    source: str
@@ -1,11 +1,12 @@
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Generator, Iterator
 from uuid import UUID
 
+import documents
 import models
+import retries
 from db import DB
-from utils import backoff
 
 
 class Base(metaclass=ABCMeta):
@@ -15,45 +16,168 @@ class Base(metaclass=ABCMeta):
     def enrich(self, ids: list[UUID]) -> list[Any]:
         pass
 
+    def stream(self, ids: list[UUID]) -> Iterator[Any]:
+        """Возвращает найденные данные по одному по мере чтения из бд.
+
+        Поток читается один раз, поэтому при ошибке бд не повторяется:
+        пайплайн загружает пачку заново с сохраненной позиции.
+
+        :param ids:
+        :return:
+        """
+        return iter(self.enrich(ids))
+
 
 @dataclass
 class Movie(Base):
-    """Получает из бд полные данные по фильму."""
+    """Получает из бд полные данные по фильму.
+
+    Жанры и персоны агрегируются в отдельных lateral-подзапросах, поэтому строки жанров
+    не перемножаются со строками персон.
+    В потоке фильмы читаются через серверный курсор порциями по itersize строк, поэтому в памяти
+    одновременно находятся не больше itersize фильмов, сколько бы фильмов ни было в пачке."""
     db: DB
+    itersize: int = 50
 
-    @backoff()
+    @retries.policy('postgres')
     def enrich(self, ids: list[UUID]) -> list[models.Movie]:
         """ Возвращает найденные модели фильмов по id.
 
         :param ids:
         :return:
         """
-        with self.db.cursor() as curs:
-            sql = '''
+        return list(self.stream(ids))
+
+    def stream(self, ids: list[UUID]) -> Generator[models.Movie, None, None]:
+        with self.db.cursor(server_side=True, itersize=self.itersize) as curs:
+            curs.execute(self._sql(), (ids,))
+            for row in curs:
+                yield models.Movie(**row)
+
+    @staticmethod
+    def _sql() -> str:
+        """Возвращает sql-запрос.
+
+        :return:
+        """
+        return '''
+            SELECT
+                fw.id,
+                fw.title,
+                fw.description,
+                fw.rating,
+                COALESCE(p.persons, '[]') as persons,
+                COALESCE(g.genres, '{}') as genres
+            FROM content.film_work fw
+            LEFT JOIN LATERAL (
+                SELECT json_agg(
+                    json_build_object(
+                        'id', p.id,
+                        'role', pfw.role,
+                        'full_name', p.full_name
+                    ) ORDER BY p.full_name, p.id
+                ) as persons
+                FROM content.person_film_work pfw
+                INNER JOIN content.person p ON p.id = pfw.person_id
+                WHERE pfw.film_work_id = fw.id
+            ) p ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT array_agg(DISTINCT g.name ORDER BY g.name) as genres
+                FROM content.genre_film_work gfw
+                INNER JOIN content.genre g ON g.id = gfw.genre_id
+                WHERE gfw.film_work_id = fw.id
+            ) g ON TRUE
+            WHERE fw.id = ANY(%s)
+        '''
+
+
+@dataclass
+class MovieDocument(Base):
+    """Получает из бд готовые документы фильмов для elasticsearch.
+
+    Документ целиком собирается в postgres и возвращается json-строкой,
+    которая передается в bulk-запрос без разбора и повторной сериализации.
+    В потоке документы читаются через серверный курсор порциями по itersize строк."""
+    db: DB
+    itersize: int = 50
+
+    @retries.policy('postgres')
+    def enrich(self, ids: list[UUID]) -> list[documents.RawMovie]:
+        """ Возвращает найденные документы фильмов по id.
+
+        :param ids:
+        :return:
+        """
+        return list(self.stream(ids))
+
+    def stream(self, ids: list[UUID]) -> Generator[documents.RawMovie, None, None]:
+        with self.db.cursor(server_side=True, itersize=self.itersize) as curs:
+            curs.execute(self._sql(), (ids,))
+            for row in curs:
+                yield documents.RawMovie(*row)
+
+    @staticmethod
+    def _sql() -> str:
+        """Возвращает sql-запрос.
+
+        Поля документа должны совпадать со схемой индекса schemas/movies.json.
+
+        :return:
+        """
+        return '''
+            SELECT
+                fw.id,
+                json_build_object(
+                    'id', fw.id,
+                    'imdb_rating', fw.rating,
+                    'genre', COALESCE(g.genre, '[]'),
+                    'title', fw.title,
+                    'description', fw.description,
+                    'director', COALESCE(p.director, '[]'),
+                    'actors_names', COALESCE(p.actors_names, '[]'),
+                    'writers_names', COALESCE(p.writers_names, '[]'),
+                    'actors', COALESCE(p.actors, '[]'),
+                    'writers', COALESCE(p.writers, '[]')
+                )::text as source
+            FROM content.film_work fw
+            LEFT JOIN LATERAL (
                 SELECT
-                    fw.id,
-                    fw.title,
-                    fw.description,
-                    fw.rating,
-                    COALESCE (
-                        json_agg(
-                           DISTINCT jsonb_build_object(
-                               'id', p.id,
-                               'role', pfw.role,
-                               'full_name', p.full_name
-                           )
-                       ) FILTER (WHERE p.id is not null),
-                       '[]'
-                    ) as persons,
-                    array_agg(DISTINCT g.name) as genres
-                FROM content.film_work fw
-                LEFT JOIN content.genre_film_work gfw ON fw.id = gfw.film_work_id
-                LEFT JOIN genre g on g.id = gfw.genre_id
-                LEFT JOIN person_film_work pfw on fw.id = pfw.film_work_id
-                LEFT JOIN person p on p.id = pfw.person_id
-                WHERE fw.id = ANY(%s)
-                GROUP BY fw.id
-            '''
-            curs.execute(sql, (ids,))
-            rows = curs.fetchall()
-            return [models.Movie(**row) for row in rows]
+                    json_agg(p.full_name ORDER BY p.full_name, p.id)
+                        FILTER (WHERE pfw.role = 'director') as director,
+                    json_agg(p.full_name ORDER BY p.full_name, p.id)
+                        FILTER (WHERE pfw.role = 'actor') as actors_names,
+                    json_agg(p.full_name ORDER BY p.full_name, p.id)
+                        FILTER (WHERE pfw.role = 'writer') as writers_names,
+                    json_agg(json_build_object('id', p.id, 'name', p.full_name) ORDER BY p.full_name, p.id)
+                        FILTER (WHERE pfw.role = 'actor') as actors,
+                    json_agg(json_build_object('id', p.id, 'name', p.full_name) ORDER BY p.full_name, p.id)
+                        FILTER (WHERE pfw.role = 'writer') as writers
+                FROM content.person_film_work pfw
+                INNER JOIN content.person p ON p.id = pfw.person_id
+                WHERE pfw.film_work_id = fw.id
+            ) p ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT json_agg(DISTINCT g.name ORDER BY g.name) as genre
+                FROM content.genre_film_work gfw
+                INNER JOIN content.genre g ON g.id = gfw.genre_id
+                WHERE gfw.film_work_id = fw.id
+            ) g ON TRUE
+            WHERE fw.id = ANY(%s)
+        '''
+
+
+@dataclass
+class PersonName(Base):
+    """Получает из бд актуальные имена персон."""
+    db: DB
+
+    @retries.policy('postgres')
+    def enrich(self, ids: list[UUID]) -> list[documents.Person]:
+        """ Возвращает id и имена найденных персон.
+
+        :param ids:
+        :return:
+        """
+        with self.db.cursor() as curs:
+            curs.execute('SELECT id, full_name FROM content.person WHERE id = ANY(%s)', (ids,))
+            return [documents.Person(id=person_id, name=full_name) for person_id, full_name in curs.fetchall()]
@@ -1,89 +1,400 @@
 import signal
-import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Optional, Union
 
 import redis
 from elasticsearch import Elasticsearch
 
+import chunking
+import deadletters
 import enrichers
+import fingerprints
 import loaders
+import metrics
 import producers
+import retries
 import settings
 import states
+import touched
 import transformers
 from db import DB
+from lanes import Lane
+from leases import Leases
 from log import logger
-from pipelines import Pipeline
+from notifications import Listener
+from pipelines import CoalescedPipeline, NotifiedPipeline, Pipeline, ShardedPipeline, StagedPipeline
+from scheduler import Job, ListenerTrigger, RedisTrigger, Scheduler, Trigger
 
 
 @dataclass
 class App:
-    """Запускает обреботку пайплайнов.
-    Обеспечивает корректное завершение при получении сигналов SIGINT и SIGTERM."""
-    pipelines: list[Pipeline]
-    check_interval_sec: int
-    _stopped: bool = False
+    """Запускает планировщик пайплайнов, источники пробуждений и полосы обработки.
+    Обеспечивает корректное завершение при получении сигналов SIGINT и SIGTERM: ожидание и паузы повторов
+    прерываются сразу, пайплайны останавливаются после текущей пачки и записывают накопленные позиции.
+    Пачка, загрузку которой прервала остановка во время недоступности зависимости, загрузится при следующем запуске.
+
+    Если задан слушатель уведомлений postgres, уведомления сразу будят пайплайн уведомлений,
+    а периодический опрос остается страховкой от пропущенных уведомлений.
+    Полосы lanes работают в своих потоках рядом с планировщиком, пока он не остановлен."""
+    scheduler: Scheduler
+    triggers: list[Trigger] = field(default_factory=list)
+    lanes: list[Lane] = field(default_factory=list)
+    # Сколько секунд ждать, пока полосы загрузят текущую пачку при остановке
+    stop_timeout_sec: float = 10
 
     def __post_init__(self):
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
     def exit_gracefully(self, *args):
-        self._stopped = True
+        logger.info('Stopping after current chunks')
+        retries.interrupt()
+        self.scheduler.stop()
 
     def run(self):
-        """Запускает пайплайны с инетрвалом."""
-        while not self._stopped:
-            for pipeline in self.pipelines:
-                pipeline.execute()
-            time.sleep(self.check_interval_sec)
+        """Запускает пайплайны по расписанию, пока приложение не остановлено."""
+        for trigger in self.triggers:
+            trigger.start()
+        for lane in self.lanes:
+            lane.start()
+        try:
+            self.scheduler.run()
+        finally:
+            retries.interrupt()
+            self.scheduler.stop()
+            for lane in self.lanes:
+                lane.stop(self.stop_timeout_sec)
+
+
+def create_es_client() -> Elasticsearch:
+    return Elasticsearch(f'{settings.ES_SCHEMA}://{settings.ES_HOST}:{settings.ES_PORT}',
+                         max_retries=settings.ES_MAX_RETRIES,
+                         http_compress=settings.ES_HTTP_COMPRESS)
+
+
+def create_sizer() -> Optional[chunking.ChunkSizer]:
+    """Создает подборщик размера пачек, если он включен в настройках.
+
+    :return:
+    """
+    if not settings.ADAPTIVE_CHUNKS:
+        return None
+    return chunking.ChunkSizer(size=settings.CHUNK_SIZE,
+                               min_size=settings.CHUNK_SIZE_MIN,
+                               max_size=settings.CHUNK_SIZE_MAX,
+                               target_seconds=settings.CHUNK_TARGET_SEC,
+                               target_bytes=settings.CHUNK_TARGET_BYTES or None)
+
+
+def create_stages(db: DB,
+                  fingerprint_storage: Optional[fingerprints.Base] = None,
+                  dead_letters: Optional[deadletters.Base] = None,
+                  refresh: Optional[str] = None,
+                  touched_ids: Optional[touched.RedisTouched] = None) -> dict:
+    """Создает обогатитель, преобразователь и загрузчик в зависимости от способа сборки документов.
+
+    :param db: пул соединений с бд
+    :param fingerprint_storage: хранилище хэшей документов, если задано, неизменившиеся документы не загружаются
+    :param dead_letters: очередь документов, отклоненных elasticsearch
+    :param refresh: параметр refresh bulk-запросов
+    :param touched_ids: если задано, id загружаемых фильмов запоминаются для идущей переиндексации
+    :return:
+    """
+    es_client = create_es_client()
+    if settings.DOCUMENT_MODE == 'validated':
+        stages = dict(
+            enricher=enrichers.Movie(db, itersize=settings.ENRICH_ITERSIZE),
+            transformer=transformers.ElasticSearchMovie(),
+            loader=loaders.ElasticSearchMovie(client=es_client,
+                                              index=settings.ES_MOVIE_INDEX_NAME,
+                                              max_batch_docs=settings.ES_BULK_MAX_DOCS,
+                                              max_batch_bytes=settings.ES_BULK_MAX_BYTES,
+                                              max_retries=settings.ES_MAX_RETRIES,
+                                              dead_letters=dead_letters,
+                                              refresh=refresh),
+        )
+    else:
+        stages = dict(
+            enricher=enrichers.MovieDocument(db, itersize=settings.ENRICH_ITERSIZE),
+            transformer=transformers.Passthrough(),
+            loader=loaders.ElasticSearchRawMovie(client=es_client,
+                                                 index=settings.ES_MOVIE_INDEX_NAME,
+                                                 thread_count=settings.ES_BULK_THREADS,
+                                                 max_batch_docs=settings.ES_BULK_MAX_DOCS,
+                                                 max_batch_bytes=settings.ES_BULK_MAX_BYTES,
+                                                 dead_letters=dead_letters,
+                                                 refresh=refresh),
+        )
+    if fingerprint_storage is not None:
+        stages['loader'] = loaders.SkipUnchanged(loader=stages['loader'], fingerprints=fingerprint_storage)
+    if touched_ids is not None:
+        stages['loader'] = loaders.TrackTouched(loader=stages['loader'], touched=touched_ids)
+    return stages
+
+
+def create_pipeline(name: str,
+                    producer_cls: type[producers.Base],
+                    db: DB,
+                    state: states.State,
+                    fingerprint_storage: Optional[fingerprints.Base] = None,
+                    shard: Optional[producers.Shard] = None,
+                    dead_letters: Optional[deadletters.Base] = None,
+                    touched_ids: Optional[touched.RedisTouched] = None) -> Pipeline:
+    """Создает пайплайн со своим загрузчиком. Соединения с бд берутся из общего пула.
+
+    :param name: имя пайплайна, под ним хранится состояние
+    :param producer_cls: класс продьюсера
+    :param db: пул соединений с бд
+    :param state:
+    :param fingerprint_storage: хранилище хэшей загруженных документов
+    :param shard: шард, строки которого обрабатывает пайплайн, None - все строки
+    :param dead_letters: очередь документов, отклоненных elasticsearch
+    :param touched_ids: id загруженных фильмов для идущей переиндексации
+    :return:
+    """
+    components = dict(
+        name=name,
+        state=state,
+        producer=producer_cls(db, settings.CHUNK_SIZE, settings.PRODUCER_PAGE_SIZE, shard=shard),
+        logger=logger,
+        sizer=create_sizer(),
+        **create_stages(db, fingerprint_storage, dead_letters, touched_ids=touched_ids),
+    )
+    if settings.PIPELINE_MODE == 'staged':
+        return StagedPipeline(**components, queue_size=settings.PIPELINE_QUEUE_SIZE)
+    return Pipeline(**components)
+
+
+def create_person_renamed_pipeline(db: DB,
+                                   state: states.State,
+                                   shard: Optional[producers.Shard] = None,
+                                   dead_letters: Optional[deadletters.Base] = None) -> Pipeline:
+    """Создает пайплайн частичного обновления имен актеров и сценаристов в документах фильмов.
+
+    При первом запуске начинает с позиции пайплайна PersonModified, чтобы не обновлять заново всех персон.
+
+    :param db: пул соединений с бд
+    :param state:
+    :param shard: шард персон, которых обрабатывает пайплайн, None - все персоны
+    :param dead_letters: очередь фильмов, в которых не удалось обновить имена
+    :return:
+    """
+    name = 'PersonRenamed'
+    if state.retrieve_state(name) is None and state.retrieve_state('PersonModified') is not None:
+        state.save_state(name, state.retrieve_state('PersonModified'))
+
+    return Pipeline(
+        name=name,
+        state=state,
+        producer=producers.PersonRenamed(db, settings.CHUNK_SIZE, settings.PRODUCER_PAGE_SIZE, shard=shard),
+        enricher=enrichers.PersonName(db),
+        transformer=transformers.Passthrough(),
+        loader=loaders.ElasticSearchPersonNames(client=create_es_client(),
+                                                index=settings.ES_MOVIE_INDEX_NAME,
+                                                dead_letters=dead_letters),
+        logger=logger,
+        sizer=create_sizer(),
+    )
+
+
+def create_pipelines(db: DB,
+                     state: states.State,
+                     fingerprint_storage: Optional[fingerprints.Base] = None,
+                     shard: Optional[producers.Shard] = None,
+                     dead_letters: Optional[deadletters.Base] = None,
+                     touched_ids: Optional[touched.RedisTouched] = None) -> list[Union[Pipeline, CoalescedPipeline]]:
+    """Создает пайплайны опроса бд для выбранного источника изменений.
+
+    :param db: пул соединений с бд
+    :param state:
+    :param fingerprint_storage: хранилище хэшей загруженных документов
+    :param shard: шард, строки которого обрабатывают пайплайны, None - все строки
+    :param dead_letters: очередь документов, отклоненных elasticsearch
+    :param touched_ids: id загруженных фильмов для идущей переиндексации
+    :return:
+    """
+    options = dict(fingerprint_storage=fingerprint_storage, shard=shard, dead_letters=dead_letters,
+                   touched_ids=touched_ids)
+    if settings.SYNC_SOURCE == 'outbox':
+        pipelines = [
+            create_pipeline('ChangeOutbox', producers.ChangeOutbox, db, state, **options),
+        ]
+    else:
+        person_producer = producers.DirectorModified if settings.PERSON_PARTIAL_UPDATES else producers.PersonModified
+        pipelines = [
+            create_pipeline('PersonModified', person_producer, db, state, **options),
+            create_pipeline('GenreModified', producers.GenreModified, db, state, **options),
+            create_pipeline('FilmworkModified', producers.FilmworkModified, db, state, **options),
+        ]
+    if settings.COALESCE:
+        pipelines = [
+            CoalescedPipeline(
+                name='Coalesced',
+                pipelines=pipelines,
+                chunk_size=settings.CHUNK_SIZE,
+                logger=logger,
+                sizer=create_sizer(),
+                round_size=settings.CHUNK_SIZE * settings.COALESCE_ROUND_CHUNKS,
+                **create_stages(db, fingerprint_storage, dead_letters, touched_ids=touched_ids),
+            ),
+        ]
+    if settings.SYNC_SOURCE != 'outbox' and settings.PERSON_PARTIAL_UPDATES:
+        pipelines.append(create_person_renamed_pipeline(db, state, shard, dead_letters))
+    return pipelines
+
+
+def create_hot_lane(db: DB,
+                    state: states.State,
+                    fingerprint_storage: Optional[fingerprints.Base] = None,
+                    dead_letters: Optional[deadletters.Base] = None,
+                    touched_ids: Optional[touched.RedisTouched] = None) -> Lane:
+    """Создает полосу свежих правок фильмов: маленькие пачки, частый опрос и обновление поиска после загрузки.
+
+    Правки, которые полоса уже загрузила, основной цикл загрузит повторно, при включенном
+    ETL_SKIP_UNCHANGED такие документы в elasticsearch не отправляются.
+
+    :param db: пул соединений с бд
+    :param state:
+    :param fingerprint_storage: хранилище хэшей загруженных документов
+    :param dead_letters: очередь документов, отклоненных elasticsearch
+    :param touched_ids: id загруженных фильмов для идущей переиндексации
+    :return:
+    """
+    pipeline = Pipeline(
+        name='FilmworkHot',
+        state=state,
+        producer=producers.FilmworkRecent(db,
+                                          settings.HOT_CHUNK_SIZE,
+                                          settings.HOT_PAGE_SIZE,
+                                          window_sec=settings.HOT_WINDOW_SEC),
+        logger=logger,
+        lane='hot',
+        **create_stages(db, fingerprint_storage, dead_letters, refresh=settings.HOT_REFRESH, touched_ids=touched_ids),
+    )
+    return Lane(name='hot', pipelines=[pipeline], interval_sec=settings.HOT_INTERVAL_SEC, logger=logger)
+
+
+def create_shard_state(redis_client: redis.Redis, shard: int, state: states.State) -> states.State:
+    """Создает состояние шарда в отдельном ключе redis.
+
+    Шард, которого еще нет в хранилище, начинает с позиций общего состояния,
+    которое вел etl до включения шардов, чтобы не загружать заново весь каталог.
+
+    :param redis_client:
+    :param shard:
+    :param state: общее состояние
+    :return:
+    """
+    storage = states.RedisStorage(redis=redis_client, name=f'{settings.STORAGE_STATE_KEY}:shard:{shard}')
+    if not storage.retrieve_state():
+        initial = state.storage.retrieve_state()
+        if initial:
+            storage.save_state(initial)
+    return create_state(storage)
+
+
+def create_state(storage: states.BaseStorage) -> states.State:
+    """Создает состояние с группировкой записей из настроек.
+
+    :param storage:
+    :return:
+    """
+    return states.State(storage,
+                        flush_every=settings.STATE_FLUSH_EVERY,
+                        flush_interval_sec=settings.STATE_FLUSH_INTERVAL_SEC,
+                        compare_and_set=settings.STATE_COMPARE_AND_SET,
+                        logger=logger)
 
 
 def init_app():
-    db = DB(dsn=settings.PG_DSN)
-    es_client = Elasticsearch(f'{settings.ES_SCHEMA}://{settings.ES_HOST}:{settings.ES_PORT}',
-                              max_retries=settings.ES_MAX_RETRIES)
+    if settings.METRICS_PORT:
+        metrics.start_server(settings.METRICS_PORT)
+    db = DB(dsn=settings.PG_DSN,
+            min_size=settings.PG_POOL_MIN_SIZE,
+            max_size=settings.PG_POOL_MAX_SIZE,
+            health_check_interval_sec=settings.PG_POOL_HEALTH_CHECK_INTERVAL_SEC)
     redis_client = redis.Redis(**settings.REDIS_DSN)
 
     storage = states.RedisStorage(redis=redis_client, name=settings.STORAGE_STATE_KEY)
-    state = states.State(storage)
-
-    enricher = enrichers.Movie(db)
-    transformer = transformers.ElasticSearchMovie()
-    loader = loaders.ElasticSearchMovie(client=es_client, index=settings.ES_MOVIE_INDEX_NAME)
-
-    pipelines = [
-        Pipeline(
-            name='PersonModified',
-            state=state,
-            producer=producers.PersonModified(db, settings.CHUNK_SIZE),
-            enricher=enricher,
-            transformer=transformer,
-            loader=loader,
-            logger=logger,
-        ),
-        Pipeline(
-            name='GenreModified',
-            state=state,
-            producer=producers.GenreModified(db, settings.CHUNK_SIZE),
-            enricher=enricher,
-            transformer=transformer,
-            loader=loader,
-            logger=logger,
-        ),
-        Pipeline(
-            name='FilmworkModified',
-            state=state,
-            producer=producers.FilmworkModified(db, settings.CHUNK_SIZE),
-            enricher=enricher,
-            transformer=transformer,
-            loader=loader,
-            logger=logger,
-        ),
-    ]
-
-    App(pipelines=pipelines, check_interval_sec=settings.CHECK_INTERVAL_SEC).run()
+    state = create_state(storage)
+    fingerprint_storage = None
+    if settings.SKIP_UNCHANGED:
+        fingerprint_storage = fingerprints.RedisFingerprints(redis=redis_client, name=settings.FINGERPRINTS_KEY)
+    dead_letters = deadletters.RedisDeadLetters(redis=redis_client, name=settings.DEAD_LETTERS_KEY)
+    touched_ids = touched.RedisTouched(redis=redis_client, name=settings.REINDEX_TOUCHED_KEY)
+
+    metrics.register_lane('bulk', settings.BULK_SLO_SEC)
+    listener = None
+    notified_pipeline = None
+    shard_leases = None
+    lanes = []
+    if settings.SHARDS:
+        # в режиме шардов уведомления не слушаются: каждый воркер загружал бы все уведомленные фильмы
+        shard_leases = Leases(redis=redis_client,
+                              shards=settings.SHARDS,
+                              worker_id=settings.WORKER_ID,
+                              ttl_sec=settings.SHARD_LEASE_TTL_SEC,
+                              logger=logger)
+        shard_leases.start()
+        pipelines = [
+            ShardedPipeline(
+                name='Sharded',
+                leases=shard_leases,
+                factory=lambda shard: create_pipelines(db,
+                                                       create_shard_state(redis_client, shard, state),
+                                                       fingerprint_storage,
+                                                       producers.Shard(shard, settings.SHARDS),
+                                                       dead_letters,
+                                                       touched_ids),
+                logger=logger,
+            ),
+        ]
+    else:
+        pipelines = create_pipelines(db, state, fingerprint_storage, dead_letters=dead_letters, touched_ids=touched_ids)
+        if settings.HOT_LANE:
+            metrics.register_lane('hot', settings.HOT_SLO_SEC)
+            # у полосы свое состояние: она записывает позиции каждые полсекунды и не должна записывать
+            # накопленные позиции основных пайплайнов
+            lanes.append(create_hot_lane(db, create_state(storage), fingerprint_storage, dead_letters, touched_ids))
+        if settings.LISTEN_ENABLED:
+            listener = Listener(dsn=settings.PG_DSN, channel=settings.LISTEN_CHANNEL, logger=logger,
+                                max_pending=settings.LISTEN_MAX_PENDING)
+            notified_pipeline = NotifiedPipeline(
+                name='Notified',
+                # позиций не сохраняет, общее состояние не записывает при каждом уведомлении
+                state=create_state(storage),
+                producer=producers.Notified(db, settings.CHUNK_SIZE, listener=listener,
+                                            directors_only=settings.PERSON_PARTIAL_UPDATES),
+                logger=logger,
+                **create_stages(db, fingerprint_storage, dead_letters, touched_ids=touched_ids),
+            )
+
+    # пока слушаются уведомления, опрос бд нужен только как страховка от пропущенных уведомлений
+    interval_sec = settings.LISTEN_FALLBACK_INTERVAL_SEC if listener is not None else settings.CHECK_INTERVAL_SEC
+    jobs = [Job(pipeline, settings.PIPELINE_INTERVALS_SEC.get(pipeline.name, interval_sec)) for pipeline in pipelines]
+    if notified_pipeline is not None:
+        jobs.append(Job(notified_pipeline, interval_sec=None))
+    scheduler = Scheduler(jobs=jobs, logger=logger, workers=settings.WORKERS)
+    triggers = []
+    if listener is not None:
+        # переименования актеров и сценаристов уведомленный пайплайн не загружает, их сразу подхватывает PersonRenamed
+        names = [notified_pipeline.name]
+        if settings.SYNC_SOURCE != 'outbox' and settings.PERSON_PARTIAL_UPDATES:
+            names.append('PersonRenamed')
+        triggers.append(ListenerTrigger(scheduler, logger, listener=listener, names=names))
+    if settings.WAKEUP_KEY:
+        triggers.append(RedisTrigger(scheduler, logger, redis=redis_client, key=settings.WAKEUP_KEY))
+
+    try:
+        App(scheduler=scheduler, triggers=triggers, lanes=lanes).run()
+    finally:
+        if shard_leases is not None:
+            shard_leases.release_all()
 
 
 if __name__ == '__main__':
-    init_app()
+    if settings.RUNTIME == 'async':
+        from aio.app import init_app as init_async_app
+        init_async_app()
+    else:
+        init_app()
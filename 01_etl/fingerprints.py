@@ -0,0 +1,76 @@
+import hashlib
+from abc import ABCMeta, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import redis
+from pydantic import BaseModel
+
+import documents
+import retries
+
+
+def digest(item: Any) -> str:
+    """Возвращает устойчивый хэш документа.
+
+    :param item: готовый json-документ или модель pydantic
+    :return:
+    """
+    if isinstance(item, documents.RawMovie):
+        data = item.source.encode()
+    elif isinstance(item, BaseModel):
+        data = item.json(sort_keys=True).encode()
+    else:
+        raise TypeError(f'Unsupported document type: {type(item)}')
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@dataclass
+class Base(metaclass=ABCMeta):
+    """Базовый класс для хранения хэшей загруженных документов."""
+
+    @abstractmethod
+    def retrieve(self, ids: list[str]) -> list[Optional[str]]:
+        """Возвращает сохраненные хэши документов, None - если хэша нет.
+
+        :param ids:
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def save(self, digests: dict[str, str]) -> None:
+        """Сохраняет хэши документов.
+
+        :param digests: хэши по id документов
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Удаляет все хэши, например, после пересоздания индекса."""
+        pass
+
+
+@dataclass
+class RedisFingerprints(Base):
+    """Хранит хэши загруженных документов в хэше redis рядом с состоянием etl."""
+
+    redis: redis.Redis
+    name: str
+
+    @retries.policy('redis')
+    def retrieve(self, ids: list[str]) -> list[Optional[str]]:
+        if not ids:
+            return []
+        return [value.decode() if value is not None else None for value in self.redis.hmget(self.name, ids)]
+
+    @retries.policy('redis')
+    def save(self, digests: dict[str, str]) -> None:
+        if digests:
+            self.redis.hset(self.name, mapping=digests)
+
+    @retries.policy('redis')
+    def clear(self) -> None:
+        self.redis.delete(self.name)
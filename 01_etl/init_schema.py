@@ -1,27 +1,39 @@
-import json
 import logging
 import os
 from glob import glob
 
+import redis
 from elasticsearch import Elasticsearch
 
+import fingerprints
 import settings
+from reindex import create_index, load_schema, versioned_name
 
 
 def init_schema():
+    """Создает первую версию каждого индекса из каталога схем и алиас на нее.
+
+    Если индекс или алиас с таким именем уже есть, он не изменяется: для пересоздания
+    существующего индекса используется reindex.py."""
     es = Elasticsearch(f'{settings.ES_SCHEMA}://{settings.ES_HOST}:{settings.ES_PORT}',
                        max_retries=settings.ES_MAX_RETRIES)
 
     for path in glob(settings.ES_SCHEMAS_PATH):
-        with open(path, 'r') as f:
-            try:
-                filename = os.path.basename(path)
-                index = filename.split('.')[0]
-                schema = json.load(f)
-                es.indices.create(index=index, settings=schema['settings'], mappings=schema['mappings'])
-                logging.info(f'{index} index configured')
-            except Exception as e:
-                logging.info(e)
+        try:
+            alias = os.path.basename(path).split('.')[0]
+            if es.indices.exists(index=alias):
+                logging.info(f'{alias} index already exists')
+                continue
+
+            index = versioned_name(alias, 1)
+            create_index(es, index, load_schema(alias), aliases={alias: {}})
+            logging.info(f'{index} index configured as {alias}')
+            if alias == settings.ES_MOVIE_INDEX_NAME:
+                # индекс создан заново, хэши ранее загруженных документов больше не актуальны
+                fingerprints.RedisFingerprints(redis=redis.Redis(**settings.REDIS_DSN),
+                                               name=settings.FINGERPRINTS_KEY).clear()
+        except Exception as e:
+            logging.info(e)
 
 
 if __name__ == '__main__':
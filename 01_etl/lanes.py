@@ -0,0 +1,60 @@
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class Lane:
+    """Выполняет свои пайплайны в отдельном потоке со своим интервалом опроса.
+
+    Позволяет обрабатывать свежие правки независимо от основного цикла: пока основной цикл
+    загружает большой объем изменений, полоса продолжает опрашивать бд каждые interval_sec секунд."""
+
+    name: str
+    pipelines: list
+    interval_sec: float
+    logger: logging.Logger
+    _stopped: threading.Event = field(default_factory=threading.Event)
+    _thread: Optional[threading.Thread] = None
+
+    def __post_init__(self):
+        self.logger = self.logger.getChild(self.name)
+
+    def start(self):
+        """Запускает поток полосы."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=f'lane-{self.name}', daemon=True)
+        self._thread.start()
+        self.logger.info(f'Lane started, interval {self.interval_sec}s')
+
+    def stop(self, timeout: Optional[float] = None):
+        """Останавливает поток полосы: выполняющийся пайплайн останавливается после текущей пачки.
+
+        :param timeout: сколько секунд ждать завершения потока
+        :return:
+        """
+        self._stopped.set()
+        for pipeline in self.pipelines:
+            pipeline.cancel()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        """Выполняет пайплайны полосы, пока ее не остановят.
+
+        Ошибка пайплайна не останавливает полосу: она пишется в лог, и пайплайн выполняется снова
+        на следующем круге, через interval_sec секунд."""
+        while not self._stopped.is_set():
+            for pipeline in self.pipelines:
+                if self._stopped.is_set():
+                    return
+                try:
+                    pipeline.execute()
+                except Exception as e:
+                    if self._stopped.is_set():
+                        self.logger.info(f'{pipeline.name} interrupted by stop: {e}')
+                        return
+                    self.logger.exception(f'{pipeline.name} failed, retry in {self.interval_sec}s: {e}')
+            self._stopped.wait(self.interval_sec)
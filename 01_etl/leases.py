@@ -0,0 +1,175 @@
+import logging
+import math
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import redis
+
+import log
+import retries
+
+# Продлевает аренду, только если она все еще принадлежит воркеру
+RENEW_SCRIPT = '''
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+'''
+
+# Снимает аренду, только если она все еще принадлежит воркеру
+RELEASE_SCRIPT = '''
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+'''
+
+
+@dataclass
+class Leases:
+    """Аренда шардов потока изменений в redis.
+
+    Шард принадлежит воркеру, пока жив ключ аренды с его id. Фоновый поток продлевает аренды
+    и отмечает воркер живым. Каждый воркер держит не больше своей доли шардов
+    от числа живых воркеров, лишние отпускает, чтобы их подобрали новые воркеры.
+    Если воркер умер, его аренды истекают через ttl_sec и их забирают остальные.
+    Потерянная аренда сразу передается подписчикам on_lost, в том числе когда redis недоступен
+    дольше ttl_sec: к этому времени шард уже может арендовать другой воркер."""
+
+    redis: redis.Redis
+    shards: int
+    worker_id: str
+    ttl_sec: float = 30
+    prefix: str = 'etl:lease'
+    logger: logging.Logger = log.logger
+    _owned: set[int] = field(default_factory=set)
+    _on_lost: list[Callable[[int], None]] = field(default_factory=list)
+    _renewed_at: float = field(default_factory=time.monotonic)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _stopped: threading.Event = field(default_factory=threading.Event)
+    _thread: Optional[threading.Thread] = None
+
+    def __post_init__(self):
+        self._renew_script = self.redis.register_script(RENEW_SCRIPT)
+        self._release_script = self.redis.register_script(RELEASE_SCRIPT)
+
+    def start(self):
+        """Запускает фоновое продление аренд.
+
+        :return:
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='leases', daemon=True)
+            self._thread.start()
+
+    def on_lost(self, callback: Callable[[int], None]):
+        """Подписывает на потерю аренды шарда.
+
+        :param callback: вызывается с номером шарда из потока продления
+        :return:
+        """
+        self._on_lost.append(callback)
+
+    @retries.policy('redis')
+    def claim(self) -> set[int]:
+        """Продлевает свои аренды, отпускает лишние и арендует свободные шарды до своей доли.
+
+        :return: арендованные шарды
+        """
+        self._heartbeat()
+        self._renew()
+        share = math.ceil(self.shards / max(self.redis.zcard(self._workers_key), 1))
+
+        with self._lock:
+            for shard in sorted(self._owned, reverse=True)[:max(len(self._owned) - share, 0)]:
+                self._release(shard)
+
+            # воркеры начинают поиск с разных шардов, чтобы реже бороться за одни и те же ключи
+            offset = zlib.crc32(self.worker_id.encode()) % self.shards
+            for num in range(self.shards):
+                if len(self._owned) >= share:
+                    break
+                shard = (offset + num) % self.shards
+                if shard not in self._owned and self.redis.set(self._key(shard), self.worker_id,
+                                                               nx=True, px=self._ttl_ms):
+                    self._owned.add(shard)
+                    self.logger.info(f'Shard {shard} claimed by {self.worker_id}')
+            return set(self._owned)
+
+    def owns(self, shard: int) -> bool:
+        with self._lock:
+            return shard in self._owned
+
+    def release_all(self):
+        """Останавливает продление и отпускает все аренды, чтобы шарды сразу забрали другие воркеры.
+
+        :return:
+        """
+        self._stopped.set()
+        with self._lock:
+            for shard in list(self._owned):
+                self._release(shard)
+        self.redis.zrem(self._workers_key, self.worker_id)
+
+    def _run(self):
+        while not self._stopped.wait(self.ttl_sec / 3):
+            try:
+                self._heartbeat()
+                self._renew()
+            except redis.RedisError as e:
+                self.logger.warning(f'Leases renewal failed: {e}')
+                if time.monotonic() - self._renewed_at >= self.ttl_sec:
+                    self._lose_all()
+
+    def _lose_all(self):
+        """Считает потерянными все аренды, которые не удалось продлить дольше ttl_sec."""
+        with self._lock:
+            lost = list(self._owned)
+            self._owned.clear()
+        for shard in lost:
+            self.logger.warning(f'Shard {shard} lease expired for {self.worker_id}')
+            self._notify_lost(shard)
+
+    def _notify_lost(self, shard: int):
+        for callback in self._on_lost:
+            callback(shard)
+
+    def _heartbeat(self):
+        """Отмечает воркер живым и удаляет из списка воркеры, не отмечавшиеся дольше ttl_sec.
+
+        :return:
+        """
+        now = time.time()
+        self.redis.zadd(self._workers_key, {self.worker_id: now})
+        self.redis.zremrangebyscore(self._workers_key, '-inf', now - self.ttl_sec)
+
+    def _renew(self):
+        lost = []
+        with self._lock:
+            for shard in list(self._owned):
+                if not self._renew_script(keys=[self._key(shard)], args=[self.worker_id, self._ttl_ms]):
+                    self._owned.discard(shard)
+                    lost.append(shard)
+                    self.logger.warning(f'Shard {shard} lease lost by {self.worker_id}')
+            self._renewed_at = time.monotonic()
+        for shard in lost:
+            self._notify_lost(shard)
+
+    def _release(self, shard: int):
+        self._release_script(keys=[self._key(shard)], args=[self.worker_id])
+        self._owned.discard(shard)
+        self.logger.info(f'Shard {shard} released by {self.worker_id}')
+
+    def _key(self, shard: int) -> str:
+        return f'{self.prefix}:{shard}'
+
+    @property
+    def _workers_key(self) -> str:
+        return f'{self.prefix}:workers'
+
+    @property
+    def _ttl_ms(self) -> int:
+        return int(self.ttl_sec * 1000)
@@ -1,12 +1,21 @@
+import itertools
+import time
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Generator
+from typing import Any, Generator, Iterable, Iterator, Optional
 
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import bulk, scan
 
+import deadletters
 import documents
-from utils import backoff
+import fingerprints
+import metrics
+import retries
+import touched
+from log import logger
 
 
 @dataclass
@@ -14,8 +23,10 @@ class Base(metaclass=ABCMeta):
     """Базовый класс для загрузчиков"""
 
     @abstractmethod
-    def load(self, items: list[Any]) -> int:
-        """Загружает документы в хранилище
+    def load(self, items: Iterable[Any]) -> int:
+        """Загружает документы в хранилище.
+
+        Документы могут передаваться потоком, который читается один раз.
 
         :return:
         """
@@ -24,22 +35,39 @@ class Base(metaclass=ABCMeta):
 
 @dataclass
 class ElasticSearchMovie(Base):
-    """Загрузчик фильмов в elasticsearch."""
+    """Загрузчик фильмов в elasticsearch.
+
+    Документы отправляются bulk-запросами по мере чтения, запрос ограничен и по кол-ву документов, и по размеру."""
 
     client: Elasticsearch
     index: str
+    max_batch_docs: int = 500
+    max_batch_bytes: int = 10 * 1024 * 1024
+    # Сколько раз повторять документы, отклоненные elasticsearch из-за перегрузки (429)
+    max_retries: int = 3
+    # Если задана, отклоненные elasticsearch документы попадают в нее, а не теряются
+    dead_letters: Optional[deadletters.Base] = None
+    # Параметр refresh bulk-запроса: true - документы видны в поиске сразу после загрузки
+    refresh: Optional[str] = None
+
+    def load(self, items: Iterable[documents.Movie]) -> int:
+        """Загружает документы в хранилище.
 
-    @backoff()
-    def load(self, items: list[documents.Movie]) -> int:
-        """Загружает документы в хранилище
+        Загрузка целиком не повторяется, потому что поток документов уже прочитан:
+        при временной ошибке elasticsearch пайплайн загружает пачку заново с сохраненной позиции.
 
         :return:
         """
-        success, failed = bulk(self.client, index=self.index, actions=self.generate_actions(items))
+        success, errors = bulk(self.client, index=self.index, actions=self.generate_actions(items),
+                               chunk_size=self.max_batch_docs, max_chunk_bytes=self.max_batch_bytes,
+                               max_retries=self.max_retries, raise_on_error=False, refresh=self.refresh)
+        _, failures = item_errors(errors)
+        if failures and self.dead_letters is not None:
+            self.dead_letters.add(failures)
         return success
 
     @staticmethod
-    def generate_actions(items: list[documents.Movie]) -> Generator[dict, None, None]:
+    def generate_actions(items: Iterable[documents.Movie]) -> Generator[dict, None, None]:
         """Генерирует объекты запроса для сохранения в elasticsearch.
 
         :param items:
@@ -50,3 +78,329 @@ class ElasticSearchMovie(Base):
                 _id=item.id,
                 _source=item.dict(),
             )
+
+
+@dataclass
+class ElasticSearchRawMovie(Base):
+    """Загрузчик готовых json-документов фильмов в elasticsearch.
+
+    Тело bulk-запроса собирается из байтов документов без разбора json.
+    Документы делятся на bulk-запросы, ограниченные и по кол-ву документов, и по размеру в байтах.
+    При thread_count больше 1 запросы отправляются параллельно, при этом в памяти
+    одновременно находится не больше 2 * thread_count собранных запросов."""
+
+    client: Elasticsearch
+    index: str
+    thread_count: int = 1
+    max_batch_docs: int = 500
+    max_batch_bytes: int = 10 * 1024 * 1024
+    # Если задана, отклоненные elasticsearch документы попадают в нее, а не теряются
+    dead_letters: Optional[deadletters.Base] = None
+    # Параметр refresh bulk-запроса: true - документы видны в поиске сразу после загрузки
+    refresh: Optional[str] = None
+    _executor: Optional[ThreadPoolExecutor] = None
+
+    def load(self, items: Iterable[documents.RawMovie]) -> int:
+        """Загружает документы в хранилище, собирая bulk-запросы по мере чтения документов
+
+        :return: кол-во успешно загруженных документов
+        """
+        if self.thread_count <= 1:
+            return sum(self._send(docs, body) for docs, body in self.build_batches(items))
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.thread_count, thread_name_prefix='bulk')
+        loaded = 0
+        in_flight = deque()
+        for docs, body in self.build_batches(items):
+            if len(in_flight) >= self.thread_count * 2:
+                loaded += in_flight.popleft().result()
+            in_flight.append(self._executor.submit(self._send, docs, body))
+        while in_flight:
+            loaded += in_flight.popleft().result()
+        return loaded
+
+    def _send(self, docs: int, body: bytes) -> int:
+        """Отправляет один bulk-запрос.
+
+        Документы, отклоненные elasticsearch из-за перегрузки (429), отправляются повторно
+        отдельным запросом, остальные документы запроса повторно не отправляются.
+
+        :param docs: кол-во документов в запросе
+        :param body: тело запроса в формате ndjson
+        :return: кол-во успешно загруженных документов
+        """
+        retry = retries.policy('elasticsearch')
+        loaded = 0
+        for attempt in itertools.count():
+            last = retry.max_tries is not None and attempt + 1 >= retry.max_tries
+            response = self._bulk(docs, body)
+            failed, failures = item_errors(response['items'] if response['errors'] else [],
+                                           retriable=() if last else (429,))
+            loaded += docs - failed
+            if failures and self.dead_letters is not None:
+                self.dead_letters.add(failures)
+            docs, body = rejected_documents(body, response, 429)
+            if not docs or last:
+                return loaded
+
+            delay = retry.delay(attempt)
+            logger.info(f'Bulk request: {docs} docs rejected, retry #{attempt + 1} in {delay:.2f}s')
+            metrics.RETRIES.labels(f'{type(self).__name__}._send').inc()
+            if retries.pause(delay):
+                raise retries.Interrupted(f'Bulk request: {docs} rejected docs not retried')
+
+    @retries.policy('elasticsearch')
+    def _bulk(self, docs: int, body: bytes) -> Any:
+        """Выполняет bulk-запрос. Запрос целиком повторяется при временных ошибках elasticsearch.
+
+        :param docs: кол-во документов в запросе
+        :param body: тело запроса в формате ndjson
+        :return: ответ elasticsearch
+        """
+        started = time.perf_counter()
+        response = self.client.bulk(index=self.index, operations=body, refresh=self.refresh)
+        latency = time.perf_counter() - started
+        metrics.observe_bulk(type(self).__name__, docs, len(body), latency)
+        logger.debug(f'Bulk request: {docs} docs, {len(body)} bytes, {latency:.3f}s')
+        return response
+
+    def build_batches(self, items: Iterable[documents.RawMovie]) -> Generator[tuple[int, bytes], None, None]:
+        """Собирает тела bulk-запросов в формате ndjson.
+
+        :param items:
+        :return: кол-во документов и тело запроса
+        """
+        return build_bulk_batches(items, self.max_batch_docs, self.max_batch_bytes)
+
+
+def build_bulk_batches(items: Iterable[documents.RawMovie],
+                       max_docs: int,
+                       max_bytes: int) -> Generator[tuple[int, bytes], None, None]:
+    """Собирает тела bulk-запросов в формате ndjson из готовых json-документов.
+
+    Запрос закрывается, когда в нем max_docs документов или следующий документ
+    не помещается в max_bytes. Документ больше max_bytes уходит отдельным запросом.
+
+    :param items:
+    :param max_docs:
+    :param max_bytes:
+    :return: кол-во документов и тело запроса
+    """
+    lines = []
+    size = 0
+    for item in items:
+        action = b'{"index":{"_id":"%s"}}\n' % str(item.id).encode()
+        source = item.source.encode() + b'\n'
+        doc_size = len(action) + len(source)
+        if lines and (len(lines) // 2 >= max_docs or size + doc_size > max_bytes):
+            yield len(lines) // 2, b''.join(lines)
+            lines = []
+            size = 0
+        lines += (action, source)
+        size += doc_size
+    if lines:
+        yield len(lines) // 2, b''.join(lines)
+
+
+def item_errors(items: Iterable[dict], retriable: tuple[int, ...] = ()) -> tuple[int, dict[str, Any]]:
+    """Разбирает результаты документов bulk-запроса и пишет в лог ошибки.
+
+    :param items: результаты документов из ответа bulk-запроса
+    :param retriable: коды ответа документов, которые будут отправлены повторно, их ошибки не пишутся в лог
+    :return: кол-во документов с ошибкой и ошибки документов, которые повторно не отправляются, по их id
+    """
+    failed = 0
+    failures = {}
+    for item in items:
+        result = next(iter(item.values()))
+        error = result.get('error')
+        if not error:
+            continue
+        failed += 1
+        if result.get('status') not in retriable:
+            logger.error(f'Document {result["_id"]} not loaded: {error}')
+            metrics.BULK_FAILED_DOCUMENTS.inc()
+            failures[result['_id']] = error
+    return failed, failures
+
+
+def rejected_documents(body: bytes, response: Any, status: int) -> tuple[int, bytes]:
+    """Собирает тело bulk-запроса из документов, отклоненных с переданным кодом ответа.
+
+    Каждый документ занимает в теле две строки, действие и источник,
+    а результаты в ответе идут в том же порядке, что и документы в запросе.
+
+    :param body: тело исходного запроса
+    :param response: ответ на исходный запрос
+    :param status:
+    :return: кол-во отклоненных документов и тело запроса из них
+    """
+    if not response['errors']:
+        return 0, b''
+    lines = body.split(b'\n')
+    rejected = [num for num, result in enumerate(response['items']) if result['index'].get('status') == status]
+    return len(rejected), b''.join(lines[num * 2] + b'\n' + lines[num * 2 + 1] + b'\n' for num in rejected)
+
+
+@dataclass
+class SkipUnchanged(Base):
+    """Пропускает документы, которые не изменились с прошлой загрузки.
+
+    Для каждого документа считается хэш и сравнивается с сохраненным, в загрузчик передаются
+    только изменившиеся документы. Хэши сравниваются порциями по batch_size документов по мере чтения потока.
+    Хэши сохраняются, только если загрузились все документы пачки,
+    иначе при следующей загрузке пачка будет отправлена целиком."""
+
+    loader: Base
+    fingerprints: fingerprints.Base
+    batch_size: int = 500
+
+    def load(self, items: Iterable[Any]) -> int:
+        """Загружает изменившиеся документы.
+
+        :return: кол-во загруженных документов
+        """
+        changed = {}
+        seen = itertools.count()
+        loaded = self.loader.load(self._changed(items, changed, seen))
+        total = next(seen)
+        logger.debug(f'Unchanged documents skipped: {total - len(changed)} of {total}')
+
+        if changed and loaded == len(changed):
+            self.fingerprints.save(changed)
+        return loaded
+
+    def _changed(self, items: Iterable[Any], changed: dict[str, str], seen: itertools.count) -> Iterator[Any]:
+        """Отдает изменившиеся документы.
+
+        :param items:
+        :param changed: сюда складываются хэши изменившихся документов по их id
+        :param seen: счетчик всех прочитанных документов
+        :return:
+        """
+        iterator = iter(items)
+        while batch := list(itertools.islice(iterator, self.batch_size)):
+            digests = {str(item.id): fingerprints.digest(item) for item in batch}
+            stored = self.fingerprints.retrieve(list(digests))
+            for item, old in zip(batch, stored):
+                next(seen)
+                if old != digests[str(item.id)]:
+                    changed[str(item.id)] = digests[str(item.id)]
+                    yield item
+
+
+@dataclass
+class TrackTouched(Base):
+    """Запоминает id загружаемых документов для переиндексации, которая идет одновременно с загрузкой.
+
+    Id порции из batch_size документов запоминаются до того, как порция передается в загрузчик,
+    поэтому документ, загруженный в старый индекс, всегда попадет в догрузку нового индекса."""
+
+    loader: Base
+    touched: touched.RedisTouched
+    batch_size: int = 500
+
+    def load(self, items: Iterable[Any]) -> int:
+        return self.loader.load(self._tracked(items))
+
+    def _tracked(self, items: Iterable[Any]) -> Iterator[Any]:
+        iterator = iter(items)
+        while batch := list(itertools.islice(iterator, self.batch_size)):
+            self.touched.add([str(item.id) for item in batch])
+            yield from batch
+
+
+@dataclass
+class ElasticSearchPersonNames(Base):
+    """Частично обновляет имена актеров и сценаристов в уже загруженных документах фильмов.
+
+    Вместо пересборки всех фильмов персоны выполняет update_by_query по вложенным полям
+    actors и writers и пересчитывает actors_names и writers_names.
+    Фильмы, измененные одновременно с запросом, пропускаются им с конфликтом версий, поэтому запрос
+    повторяется: уже обновленные фильмы скрипт не меняет. Если конфликты остались, все фильмы персон
+    пачки попадают в очередь отклоненных документов для полной пересборки."""
+
+    client: Elasticsearch
+    index: str
+    # Если задана, фильмы, которые не удалось обновить, попадают в нее для полной пересборки
+    dead_letters: Optional[deadletters.Base] = None
+    # Сколько раз повторять запрос, если часть фильмов обновить не удалось из-за конфликта версий
+    conflict_retries: int = 3
+
+    SCRIPT = '''
+        boolean changed = false;
+        for (String field : ['actors', 'writers']) {
+            List persons = ctx._source[field];
+            if (persons == null) {
+                continue;
+            }
+            List names = new ArrayList();
+            for (Map person : persons) {
+                String name = params.names.get(person.get('id'));
+                if (name != null && !name.equals(person.get('name'))) {
+                    person.put('name', name);
+                    changed = true;
+                }
+                names.add(person.get('name'));
+            }
+            ctx._source[field + '_names'] = names;
+        }
+        if (!changed) {
+            ctx.op = 'noop';
+        }
+    '''
+
+    def load(self, items: Iterable[documents.Person]) -> int:
+        """Обновляет имена персон во всех фильмах, где они указаны актерами или сценаристами.
+
+        :return: кол-во обновленных документов
+        """
+        # персоны пачки нужны одним запросом, а их документы занимают немного памяти
+        items = list(items)
+        if not items:
+            return 0
+        return self._update(items)
+
+    @retries.policy('elasticsearch')
+    def _update(self, items: list[documents.Person]) -> int:
+        """Выполняет update_by_query по персонам пачки.
+
+        :param items:
+        :return: кол-во обновленных документов
+        """
+        ids = [str(item.id) for item in items]
+        query = {'bool': {'should': [
+            {'nested': {'path': 'actors', 'query': {'terms': {'actors.id': ids}}}},
+            {'nested': {'path': 'writers', 'query': {'terms': {'writers.id': ids}}}},
+        ]}}
+        script = {
+            'source': self.SCRIPT,
+            'lang': 'painless',
+            'params': {'names': {str(item.id): item.name for item in items}},
+        }
+        updated = 0
+        for attempt in range(self.conflict_retries + 1):
+            response = self.client.update_by_query(index=self.index, query=query, script=script, conflicts='proceed')
+            updated += response['updated']
+            failures = {}
+            for failure in response.get('failures', []):
+                logger.error(f'Person names not updated: {failure}')
+                if 'id' in failure:
+                    failures[failure['id']] = failure.get('cause', failure)
+            if failures and self.dead_letters is not None:
+                self.dead_letters.add(failures)
+
+            conflicts = response.get('version_conflicts', 0)
+            if not conflicts:
+                return updated
+            logger.warning(f'Person names: {conflicts} films changed concurrently, attempt {attempt + 1}')
+            if attempt < self.conflict_retries:
+                # следующий запрос должен видеть версии, записанные одновременными изменениями
+                self.client.indices.refresh(index=self.index)
+
+        logger.error(f'Person names: {conflicts} films not updated because of version conflicts')
+        if self.dead_letters is not None:
+            films = scan(self.client, index=self.index, query={'query': query}, _source=False)
+            self.dead_letters.add({hit['_id']: 'version conflict on person names update' for hit in films})
+        return updated
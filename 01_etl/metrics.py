@@ -0,0 +1,235 @@
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional, TypeVar
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+T = TypeVar('T')
+
+STAGE_SECONDS = Histogram(
+    'etl_stage_seconds',
+    'Время обработки одной пачки этапом пайплайна',
+    ['pipeline', 'stage'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+CHUNK_ROWS = Histogram(
+    'etl_chunk_rows',
+    'Кол-во строк в пачке, полученной от продьюсера',
+    ['pipeline'],
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+CHUNK_SIZE = Gauge(
+    'etl_chunk_size',
+    'Размер пачки, подобранный по времени обработки и объему документов',
+    ['pipeline'],
+)
+DOCUMENTS_LOADED = Counter(
+    'etl_documents_loaded_total',
+    'Кол-во загруженных документов',
+    ['pipeline'],
+)
+BULK_FAILED_DOCUMENTS = Counter(
+    'etl_bulk_failed_documents_total',
+    'Кол-во документов, отклоненных elasticsearch в ответе bulk-запроса',
+)
+BULK_BATCH_SECONDS = Histogram(
+    'etl_bulk_batch_seconds',
+    'Время выполнения одного bulk-запроса',
+    ['loader'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+BULK_BATCH_DOCS = Histogram(
+    'etl_bulk_batch_docs',
+    'Кол-во документов в одном bulk-запросе',
+    ['loader'],
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+BULK_BATCH_BYTES = Histogram(
+    'etl_bulk_batch_bytes',
+    'Размер тела одного bulk-запроса в байтах',
+    ['loader'],
+    buckets=(1024, 16384, 131072, 524288, 1048576, 5242880, 10485760, 52428800, 104857600),
+)
+RETRIES = Counter(
+    'etl_retries_total',
+    'Кол-во повторов после ошибки в backoff',
+    ['function'],
+)
+WATERMARK_TIMESTAMP = Gauge(
+    'etl_watermark_timestamp_seconds',
+    'Дата изменения последней загруженной строки пайплайна',
+    ['pipeline'],
+)
+WATERMARK_LAG = Gauge(
+    'etl_watermark_lag_seconds',
+    'Сколько секунд прошло с даты изменения последней загруженной строки пайплайна. '
+    'Растет и без отставания, если в бд давно ничего не менялось',
+    ['pipeline'],
+)
+LANE_FRESHNESS = Histogram(
+    'etl_lane_freshness_seconds',
+    'Сколько секунд прошло от изменения в бд до загрузки пачки в полосе обработки, по самой старой строке пачки',
+    ['lane'],
+    buckets=(.25, .5, 1, 2, 5, 10, 30, 60, 300, 900, 3600),
+)
+LANE_SLO = Gauge(
+    'etl_lane_slo_seconds',
+    'Цель полосы обработки по времени от изменения в бд до загрузки',
+    ['lane'],
+)
+LANE_SLO_VIOLATIONS = Counter(
+    'etl_lane_slo_violations_total',
+    'Кол-во пачек, загруженных позже цели полосы обработки',
+    ['lane'],
+)
+
+PG_POOL_WAIT_SECONDS = Histogram(
+    'etl_pg_pool_wait_seconds',
+    'Сколько потоки ждали свободного соединения из пула postgres. '
+    'Если ожидания заметны при пуле меньше числа потоков, пул стоит увеличить',
+    buckets=(.0001, .001, .005, .01, .025, .05, .1, .25, .5, 1, 5),
+)
+PG_POOL_IN_USE = Gauge(
+    'etl_pg_pool_connections_in_use',
+    'Кол-во соединений пула postgres, выданных потокам',
+)
+PG_POOL_MAX_SIZE = Gauge(
+    'etl_pg_pool_max_size',
+    'Максимальный размер пула соединений postgres',
+)
+
+_watermarks: dict[str, float] = {}
+_slo: dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def start_server(port: int):
+    """Запускает http-сервер, отдающий метрики в формате prometheus на /metrics.
+
+    :param port:
+    :return:
+    """
+    start_http_server(port)
+
+
+def track_watermark(pipeline: str, modified: datetime):
+    """Запоминает дату изменения последней загруженной строки пайплайна.
+
+    Отставание считается в момент сбора метрик, поэтому растет и между циклами синхронизации.
+
+    :param pipeline:
+    :param modified:
+    :return:
+    """
+    timestamp = modified.timestamp()
+    with _lock:
+        if pipeline not in _watermarks:
+            WATERMARK_LAG.labels(pipeline).set_function(lambda: time.time() - _watermarks[pipeline])
+        _watermarks[pipeline] = timestamp
+    WATERMARK_TIMESTAMP.labels(pipeline).set(timestamp)
+
+
+def observe_bulk(loader: str, docs: int, size: int, seconds: float):
+    """Учитывает выполненный bulk-запрос.
+
+    :param loader: имя загрузчика
+    :param docs: кол-во документов в запросе
+    :param size: размер тела запроса в байтах
+    :param seconds: время выполнения запроса
+    :return:
+    """
+    BULK_BATCH_SECONDS.labels(loader).observe(seconds)
+    BULK_BATCH_DOCS.labels(loader).observe(docs)
+    BULK_BATCH_BYTES.labels(loader).observe(size)
+
+
+def register_lane(lane: str, slo_sec: float):
+    """Задает цель полосы обработки по времени от изменения в бд до загрузки.
+
+    :param lane:
+    :param slo_sec:
+    :return:
+    """
+    _slo[lane] = slo_sec
+    LANE_SLO.labels(lane).set(slo_sec)
+
+
+def observe_freshness(lane: str, modified: datetime):
+    """Учитывает загруженную пачку в метриках свежести полосы обработки.
+
+    :param lane:
+    :param modified: дата изменения самой старой строки пачки
+    :return:
+    """
+    freshness = (datetime.now(timezone.utc) - modified).total_seconds()
+    LANE_FRESHNESS.labels(lane).observe(freshness)
+    slo_sec = _slo.get(lane)
+    if slo_sec is not None and freshness > slo_sec:
+        LANE_SLO_VIOLATIONS.labels(lane).inc()
+
+
+def timed(items: Iterable[T], pipeline: str, stage: str) -> Iterator[T]:
+    """Отдает элементы итератора, замеряя, сколько времени ушло на получение каждого.
+
+    :param items:
+    :param pipeline:
+    :param stage:
+    :return:
+    """
+    histogram = STAGE_SECONDS.labels(pipeline, stage)
+    iterator = iter(items)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            histogram.observe(time.perf_counter() - started)
+            yield item
+    finally:
+        # закрывает генератор продьюсера вместе с его курсором, если обработку прервали
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+class StageTimer:
+    """Замеряет время этапа, через который документы пачки проходят потоком.
+
+    Считается только время внутри этапа: время предыдущего этапа upstream, из которого этап
+    читает документы, вычитается. Время пачки записывается в метрики, когда поток закончился."""
+
+    def __init__(self, pipeline: str, stage: str, upstream: Optional['StageTimer'] = None):
+        self.histogram = STAGE_SECONDS.labels(pipeline, stage)
+        self.upstream = upstream
+        self.seconds = 0.0
+        self.count = 0
+
+    def wrap(self, items: Iterable[T]) -> Iterator[T]:
+        """Отдает элементы этапа, замеряя время их получения.
+
+        :param items:
+        :return:
+        """
+        iterator = iter(items)
+        try:
+            while True:
+                started = time.perf_counter()
+                upstream = self.upstream.seconds if self.upstream is not None else 0
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.seconds += time.perf_counter() - started
+                    if self.upstream is not None:
+                        self.seconds -= self.upstream.seconds - upstream
+                self.count += 1
+                yield item
+        finally:
+            self.histogram.observe(self.seconds)
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
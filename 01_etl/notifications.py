@@ -0,0 +1,123 @@
+import json
+import logging
+import select
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from uuid import UUID
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import connection
+
+# Сущности, об изменении которых сообщают триггеры
+ENTITIES = ('film_work', 'person', 'genre')
+
+
+@dataclass
+class Listener:
+    """Слушает уведомления postgres об изменениях в контенте.
+
+    Триггеры на таблицах схемы content отправляют в канал id измененных фильмов, персон и жанров.
+    Полученные id копятся, пока их не заберет продьюсер, ждать уведомления и забирать id можно из разных потоков.
+    Забранные id хранятся до подтверждения загрузки: если загрузка не удалась, следующий drain вернет их снова.
+    Незабранных id копится не больше max_pending: при переполнении они отбрасываются, и слушатель сообщает
+    о переполнении, чтобы вместо загрузки по id изменения подобрал опрос бд."""
+
+    dsn: dict
+    channel: str
+    logger: logging.Logger
+    max_pending: int = 10000
+    _conn: Optional[connection] = None
+    _pending: dict[str, set[UUID]] = field(default_factory=lambda: {entity: set() for entity in ENTITIES})
+    # id, забранные drain, чья загрузка еще не подтверждена
+    _taken: dict[str, set[UUID]] = field(default_factory=lambda: {entity: set() for entity in ENTITIES})
+    # С последней проверки незабранные id были отброшены из-за переполнения
+    _overflowed: bool = False
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def wait(self, timeout: float) -> bool:
+        """Ждет уведомлений не дольше timeout секунд.
+
+        :param timeout:
+        :return: True, если есть полученные изменения, еще не забранные или забранные и не подтвержденные
+        """
+        try:
+            conn = self._connection()
+            if not conn.notifies and select.select([conn], [], [], timeout) != ([], [], []):
+                conn.poll()
+            self._collect(conn)
+        except (psycopg2.Error, OSError) as e:
+            self.logger.warning(f'Listening failed: {e}')
+            self._close()
+            time.sleep(timeout)
+        return self.pending()
+
+    def pending(self) -> bool:
+        with self._lock:
+            return any(self._pending.values()) or any(self._taken.values())
+
+    def drain(self) -> dict[str, list[UUID]]:
+        """Забирает накопленные id изменившихся сущностей вместе с забранными ранее и не подтвержденными.
+
+        :return: id по именам сущностей
+        """
+        with self._lock:
+            for entity, ids in self._pending.items():
+                self._taken[entity].update(ids)
+                ids.clear()
+            return {entity: list(ids) for entity, ids in self._taken.items()}
+
+    def overflowed(self) -> bool:
+        """Сообщает, отбрасывались ли id из-за переполнения с прошлой проверки, и сбрасывает признак.
+
+        :return:
+        """
+        with self._lock:
+            overflowed, self._overflowed = self._overflowed, False
+            return overflowed
+
+    def acknowledge(self):
+        """Подтверждает, что фильмы по забранным id загружены, после этого drain их больше не возвращает."""
+        with self._lock:
+            for ids in self._taken.values():
+                ids.clear()
+
+    def _collect(self, conn: connection):
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                payload = json.loads(notify.payload)
+                with self._lock:
+                    self._pending[payload['table']].add(UUID(payload['id']))
+                    if sum(len(ids) for ids in self._pending.values()) > self.max_pending:
+                        self._overflow()
+            except (ValueError, KeyError, TypeError):
+                self.logger.warning(f'Unexpected notification: {notify.payload}')
+
+    def _overflow(self):
+        """Отбрасывает незабранные id, когда их больше max_pending."""
+        if not self._overflowed:
+            self.logger.warning(f'More than {self.max_pending} changes pending, falling back to polling')
+        self._overflowed = True
+        for ids in self._pending.values():
+            ids.clear()
+
+    def _connection(self) -> connection:
+        if self._conn is None or self._conn.closed != 0:
+            self._conn = psycopg2.connect(**self.dsn)
+            self._conn.set_session(autocommit=True)
+            with self._conn.cursor() as curs:
+                curs.execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+            self.logger.info(f'Listening to {self.channel}')
+        return self._conn
+
+    def _close(self):
+        if self._conn is not None and self._conn.closed == 0:
+            # noinspection PyBroadException
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
@@ -1,18 +1,30 @@
 import logging
-from dataclasses import dataclass
-from datetime import datetime, timezone
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Optional
 
+import chunking
 import enrichers
+import leases
 import loaders
+import metrics
 import producers
 import states
 import transformers
 from utils import backoff
 
+# Маркер окончания потока данных между этапами
+_DONE = object()
+
 
 @dataclass
 class Pipeline:
-    """Связывает все компоненты etl в единый пайплайн загрузки."""
+    """Связывает все компоненты etl в единый пайплайн загрузки.
+
+    Документы пачки проходят обогащение, преобразование и загрузку потоком, поэтому в памяти
+    одновременно находится не вся пачка, а только документы, которые читает из бд курсор обогатителя."""
 
     name: str
     state: states.State
@@ -21,53 +33,535 @@ class Pipeline:
     transformer: transformers.Base
     loader: loaders.Base
     logger: logging.Logger
+    # Если задан, размер пачек продьюсера подбирается по времени обработки и объему документов
+    sizer: Optional[chunking.ChunkSizer] = None
+    # Полоса обработки, в метриках которой учитывается свежесть загруженных пачек
+    lane: str = 'bulk'
+    # Замеры этапов пачек по их номерам
+    _timers: dict[int, list[metrics.StageTimer]] = field(default_factory=dict)
+    _cancelled: threading.Event = field(default_factory=threading.Event)
 
     def __post_init__(self):
         self.logger = self.logger.getChild(self.name)
+        if self.sizer is not None:
+            self.producer.chunk_size = self.sizer.size
+        watermark = self.watermark
+        if isinstance(watermark, producers.Watermark) and watermark != producers.Watermark.initial():
+            metrics.track_watermark(self.name, watermark.modified)
 
     @property
-    def last_modified(self) -> datetime:
-        """Возвращает дату последнего изменения из хранилища состояний.
+    def watermark(self) -> producers.Watermark:
+        """Возвращает позицию, до которой данные уже загружены, из хранилища состояний.
 
-        Если не найдена, то вернет 0001-01-01 00:00:00.
+        Если не найдена, то вернет начало потока изменений.
 
         :return:
         """
-        modified = self.state.retrieve_state(self.name)
-        return datetime.fromisoformat(modified) if modified else datetime.min.replace(tzinfo=timezone.utc)
+        return self.producer.load_watermark(self.state.retrieve_state(self.name))
 
-    @last_modified.setter
-    def last_modified(self, modified: datetime):
-        """Запоминает дату последнего изменения, полученную из бд.
+    @watermark.setter
+    def watermark(self, watermark: producers.Watermark):
+        """Запоминает позицию последней загруженной строки.
 
-        :param modified:
+        :param watermark:
         :return:
         """
-        self.state.save_state(self.name, modified.isoformat())
+        self.state.save_state(self.name, self.producer.dump_watermark(watermark))
+
+    def cancel(self):
+        """Просит пайплайн остановиться после текущей пачки. Отмененный пайплайн больше не загружает пачки."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
 
     @backoff()
     def execute(self):
         """Выполняет загрузку данных из pg в elastic."""
-        num = 1
         total_loaded = 0
+        self._timers.clear()
 
         self.logger.debug('Execution started')
-        self.logger.debug(f'Last modified from state: {self.last_modified}')
-        chunks = self.producer.produce(self.last_modified)
-        for chunk in chunks:
-            self.logger.debug(f'#{num}: Chunk size: {len(chunk)}')
+        self.logger.debug(f'Watermark from state: {self.watermark}')
+        try:
+            for num, chunk in self._produce():
+                if self.cancelled:
+                    self.logger.info(f'Cancelled before chunk #{num}')
+                    break
+                items = self._enrich(num, chunk)
+                total_loaded += self._load(num, chunk, self._transform(num, chunk, items))
+        except states.Conflict as e:
+            self._superseded(e)
+        self.state.flush()
 
-            items = self.enricher.enrich([item_id for item_id, _ in chunk])
-            self.logger.debug(f'#{num}: Unique items enriched: {len(items)}')
+        # полоса свежих правок опрашивает бд несколько раз в секунду, пустые циклы в info не пишутся
+        self.logger.log(logging.INFO if total_loaded else logging.DEBUG, f'Total loaded: {total_loaded}')
+        self.logger.debug('Execution ended')
 
-            loaded = self.loader.load(self.transformer.transform(items))
-            self.logger.debug(f'#{num}: Items loaded: {loaded}')
+    def _superseded(self, conflict: states.Conflict):
+        """Завершает запуск, позицию которого сдвинул другой процесс.
 
-            new_last_modified = max([modified for _, modified in chunk])
-            self.last_modified = max(self.last_modified, new_last_modified)
+        Следующий запуск прочитает позицию из хранилища и продолжит с нее.
 
-            total_loaded += loaded
-            num += 1
+        :param conflict:
+        :return:
+        """
+        self.logger.warning(f'Run stopped, watermark was moved by another process to {conflict.current}')
+
+    def _produce(self) -> Iterable[tuple[int, producers.Chunk]]:
+        """Возвращает пронумерованные пачки изменений с последнего синка.
+
+        :return:
+        """
+        return enumerate(metrics.timed(self.producer.produce(self.watermark), self.name, 'produce'), start=1)
+
+    def _enrich(self, num: int, chunk: producers.Chunk) -> Iterable[Any]:
+        """Получает полные данные по пачке потоком.
+
+        :param num: номер пачки
+        :param chunk:
+        :return:
+        """
+        self.logger.debug(f'#{num}: Chunk size: {len(chunk)}')
+        metrics.CHUNK_ROWS.labels(self.name).observe(len(chunk))
+        timer = metrics.StageTimer(self.name, 'enrich')
+        self._timers[num] = [timer]
+        return timer.wrap(self.enricher.stream([row.film_work_id for row in chunk]))
+
+    def _transform(self, num: int, chunk: producers.Chunk, items: Iterable[Any]) -> Iterable[Any]:
+        """Преобразует данные пачки в документы для загрузки потоком.
+
+        :param num: номер пачки
+        :param chunk:
+        :param items:
+        :return:
+        """
+        timers = self._timers.setdefault(num, [])
+        timer = metrics.StageTimer(self.name, 'transform', upstream=timers[-1] if timers else None)
+        timers.append(timer)
+        return timer.wrap(self.transformer.stream(items))
+
+    def _load(self, num: int, chunk: producers.Chunk, items: Iterable[Any]) -> int:
+        """Загружает документы пачки и только после этого запоминает позицию ее последней строки.
+
+        Обогащение и преобразование выполняются по мере того, как загрузчик читает документы,
+        поэтому их время вычитается из времени загрузки.
+
+        :param num: номер пачки
+        :param chunk:
+        :param items:
+        :return: кол-во загруженных документов
+        """
+        timers = self._timers.pop(num, [])
+        meter = chunking.PayloadMeter()
+        upstream = sum(timer.seconds for timer in timers)
+        started = time.perf_counter()
+        loaded = self.loader.load(meter.wrap(items))
+        elapsed = time.perf_counter() - started
+        spent = sum(timer.seconds for timer in timers)
+        metrics.STAGE_SECONDS.labels(self.name, 'load').observe(elapsed - (spent - upstream))
+        if timers:
+            self.logger.debug(f'#{num}: Unique items enriched: {timers[0].count}')
+        self.logger.debug(f'#{num}: Items loaded: {loaded}')
+        metrics.DOCUMENTS_LOADED.labels(self.name).inc(loaded)
+
+        self._commit(chunk)
+        self._resize(num, chunk, upstream + elapsed, meter.bytes)
+        return loaded
+
+    def _resize(self, num: int, chunk: producers.Chunk, seconds: float, payload_bytes: Optional[int]):
+        """Пересчитывает размер следующих пачек продьюсера по времени обработки загруженной пачки.
+
+        :param num: номер пачки
+        :param chunk:
+        :param seconds: время обогащения, преобразования и загрузки пачки
+        :param payload_bytes: объем загруженных документов, None - если неизвестен
+        :return:
+        """
+        if self.sizer is None:
+            return
+        size = self.sizer.observe(len(chunk), seconds, payload_bytes)
+        if size != self.producer.chunk_size:
+            self.logger.debug(f'#{num}: Chunk size changed from {self.producer.chunk_size} to {size}')
+            self.producer.chunk_size = size
+        metrics.CHUNK_SIZE.labels(self.name).set(size)
+
+    def _commit(self, chunk: producers.Chunk):
+        """Запоминает позицию последней строки загруженной пачки.
+
+        :param chunk:
+        :return:
+        """
+        self.watermark = self.producer.watermark(chunk)
+        self.producer.acknowledge(chunk)
+        metrics.track_watermark(self.name, chunk[-1].modified)
+        metrics.observe_freshness(self.lane, min(row.modified for row in chunk))
+
+
+@dataclass
+class NotifiedPipeline(Pipeline):
+    """Загружает фильмы, о чьих изменениях сообщили уведомления postgres.
+
+    Позицию в хранилище состояний не читает и не сдвигает: пропущенные уведомления
+    подберут пайплайны, опрашивающие бд по дате изменения."""
+
+    def _produce(self) -> Iterable[tuple[int, producers.Chunk]]:
+        return enumerate(metrics.timed(self.producer.produce(), self.name, 'produce'), start=1)
+
+    def _commit(self, chunk: producers.Chunk):
+        pass
+
+
+@dataclass
+class StagedPipeline(Pipeline):
+    """Пайплайн, в котором этапы выполняются одновременно, каждый в своем потоке.
+
+    Этапы связаны очередями ограниченного размера, поэтому быстрый этап не убегает
+    вперед медленного больше, чем на queue_size пачек. Между потоками этапов передаются
+    готовые списки документов, поэтому пачка целиком находится в памяти."""
+
+    queue_size: int = 2
+
+    def _enrich(self, num: int, chunk: producers.Chunk) -> list[Any]:
+        return list(super()._enrich(num, chunk))
+
+    def _transform(self, num: int, chunk: producers.Chunk, items: Iterable[Any]) -> list[Any]:
+        return list(super()._transform(num, chunk, items))
+
+    @backoff()
+    def execute(self):
+        """Выполняет загрузку данных из pg в elastic."""
+        stopped = threading.Event()
+        errors: list[BaseException] = []
+        totals: list[int] = []
+        self._timers.clear()
+        to_enrich, to_transform, to_load = (queue.Queue(maxsize=self.queue_size) for _ in range(3))
+
+        self.logger.debug('Execution started')
+        self.logger.debug(f'Watermark from state: {self.watermark}')
+        stages = [
+            (self._produce_stage, (to_enrich, stopped)),
+            (self._stage, (self._enrich, to_enrich, to_transform, stopped)),
+            (self._stage, (self._transform, to_transform, to_load, stopped)),
+            (self._stage, (self._load, to_load, None, stopped, totals.append)),
+        ]
+        threads = [
+            threading.Thread(target=self._guard, args=(target, args, errors, stopped),
+                             name=f'{self.name}-{num}', daemon=True)
+            for num, (target, args) in enumerate(stages)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors and isinstance(errors[0], states.Conflict):
+            self._superseded(errors[0])
+        elif errors:
+            raise errors[0]
+        self.state.flush()
+
+        self.logger.info(f'Total loaded: {sum(totals)}')
+        self.logger.debug('Execution ended')
+
+    @staticmethod
+    def _guard(target: Callable, args: tuple, errors: list[BaseException], stopped: threading.Event):
+        """Выполняет этап и при ошибке останавливает все остальные этапы.
+
+        :param target:
+        :param args:
+        :param errors: список, в который складываются ошибки этапов
+        :param stopped:
+        :return:
+        """
+        try:
+            target(*args)
+        except BaseException as e:
+            errors.append(e)
+            stopped.set()
+
+    def _produce_stage(self, target: queue.Queue, stopped: threading.Event):
+        """Передает пачки от продьюсера на следующий этап.
+
+        :param target:
+        :param stopped:
+        :return:
+        """
+        for num, chunk in self._produce():
+            if self.cancelled:
+                # пачки, уже переданные дальше, загружаются до конца и сохраняют позиции
+                self.logger.info(f'Cancelled before chunk #{num}')
+                break
+            if not self._put(target, (num, chunk), stopped):
+                return
+        self._put(target, _DONE, stopped)
+
+    def _stage(self,
+               func: Callable,
+               source: queue.Queue,
+               target: Optional[queue.Queue],
+               stopped: threading.Event,
+               on_result: Optional[Callable] = None):
+        """Обрабатывает пачки из очереди source и передает результат в очередь target.
+
+        :param func: обработчик пачки
+        :param source:
+        :param target: очередь следующего этапа, None для последнего этапа
+        :param stopped:
+        :param on_result: вызывается с результатом обработки, если задан
+        :return:
+        """
+        while True:
+            task = self._get(source, stopped)
+            if task is None:
+                return
+            if task is _DONE:
+                break
+
+            num, chunk, *args = task
+            result = func(num, chunk, *args)
+            if on_result is not None:
+                on_result(result)
+            if target is not None and not self._put(target, (num, chunk, result), stopped):
+                return
+
+        if target is not None:
+            self._put(target, _DONE, stopped)
+
+    @staticmethod
+    def _put(target: queue.Queue, item: Any, stopped: threading.Event) -> bool:
+        """Кладет элемент в очередь, ожидая свободного места, пока пайплайн не остановлен.
+
+        :return: False, если пайплайн остановлен
+        """
+        while not stopped.is_set():
+            try:
+                target.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(source: queue.Queue, stopped: threading.Event) -> Any:
+        """Берет элемент из очереди, пока пайплайн не остановлен.
+
+        :return: None, если пайплайн остановлен
+        """
+        while not stopped.is_set():
+            try:
+                return source.get(timeout=1)
+            except queue.Empty:
+                continue
+        return None
+
+
+@dataclass
+class CoalescedPipeline:
+    """Объединяет изменения всех пайплайнов в общий набор фильмов.
+
+    Фильм, найденный несколькими продьюсерами, обогащается и загружается один раз.
+    Изменения собираются раундами не больше чем по round_size фильмов: продьюсеры отдают пачки по очереди,
+    после загрузки раунда каждый пайплайн сдвигает свою позицию в хранилище состояний, и следующий
+    раунд продолжает с нее. Поэтому память ограничена раундом, а после остановки загрузка продолжается
+    с последнего загруженного раунда."""
+
+    name: str
+    pipelines: list[Pipeline]
+    enricher: enrichers.Base
+    transformer: transformers.Base
+    loader: loaders.Base
+    chunk_size: int
+    logger: logging.Logger
+    # Если задан, размер пачек на обогащение подбирается по времени обработки и объему документов
+    sizer: Optional[chunking.ChunkSizer] = None
+    # Сколько уникальных фильмов собирать за раунд
+    round_size: int = 10000
+    _cancelled: threading.Event = field(default_factory=threading.Event)
+
+    def __post_init__(self):
+        self.logger = self.logger.getChild(self.name)
+
+    def cancel(self):
+        """Просит пайплайн остановиться после текущей пачки.
+
+        Позиции сдвигаются только после загрузки всех фильмов раунда, поэтому после отмены
+        позиции текущего раунда не сохраняются и следующий запуск начнет этот раунд заново."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @backoff()
+    def execute(self):
+        """Выполняет загрузку данных из pg в elastic."""
+        total_loaded = 0
+        num = 0
+        active = list(self.pipelines)
+
+        self.logger.debug('Execution started')
+        while active and not self.cancelled:
+            ids, produced, active = self._collect(active)
+            loaded = self._load(ids, num)
+            if loaded is None:
+                self.logger.info('Cancelled, watermarks of the current round are not moved')
+                break
+            num += len(loaded)
+            total_loaded += sum(loaded)
+            superseded = self._commit(produced)
+            active = [pipeline for pipeline in active if pipeline.name not in superseded]
+        for state in {id(pipeline.state): pipeline.state for pipeline in self.pipelines}.values():
+            state.flush()
 
         self.logger.info(f'Total loaded: {total_loaded}')
         self.logger.debug('Execution ended')
+
+    def _collect(self, active: list[Pipeline]) -> tuple[list, dict[str, list[producers.Chunk]], list[Pipeline]]:
+        """Собирает id фильмов раунда без повторов, забирая у продьюсеров по одной пачке по очереди.
+
+        :param active: пайплайны, у продьюсеров которых еще могут быть изменения
+        :return: список id фильмов, полученные пачки по пайплайнам и пайплайны, чьи изменения собраны не полностью
+        """
+        ids = {}
+        produced = {}
+        total = 0
+        streams = {
+            pipeline.name: (pipeline, metrics.timed(pipeline.producer.produce(pipeline.watermark),
+                                                    pipeline.name, 'produce'))
+            for pipeline in active
+        }
+        remaining = []
+        try:
+            while streams and len(ids) < self.round_size and not self.cancelled:
+                for name, (pipeline, stream) in list(streams.items()):
+                    chunk = next(stream, None)
+                    if chunk is None:
+                        del streams[name]
+                        continue
+                    total += len(chunk)
+                    ids.update((row.film_work_id, None) for row in chunk)
+                    produced.setdefault(name, []).append(chunk)
+                    if len(ids) >= self.round_size:
+                        break
+        finally:
+            for pipeline, stream in streams.values():
+                stream.close()
+                remaining.append(pipeline)
+
+        self.logger.debug(f'Produced: {total}, unique: {len(ids)}')
+        return list(ids), produced, remaining
+
+    def _load(self, ids: list, num: int) -> Optional[list[int]]:
+        """Загружает фильмы раунда пачками.
+
+        :param ids: id фильмов раунда
+        :param num: кол-во пачек, загруженных в предыдущих раундах
+        :return: кол-во загруженных документов по пачкам, None - если загрузку отменили
+        """
+        loaded = []
+        start = 0
+        while start < len(ids):
+            if self.cancelled:
+                return None
+            num += 1
+            chunk_size = self.sizer.size if self.sizer is not None else self.chunk_size
+            chunk = ids[start:start + chunk_size]
+            start += len(chunk)
+            metrics.CHUNK_ROWS.labels(self.name).observe(len(chunk))
+            enriched = metrics.StageTimer(self.name, 'enrich')
+            transformed = metrics.StageTimer(self.name, 'transform', upstream=enriched)
+            meter = chunking.PayloadMeter()
+            items = transformed.wrap(self.transformer.stream(enriched.wrap(self.enricher.stream(chunk))))
+            started = time.perf_counter()
+            chunk_loaded = self.loader.load(meter.wrap(items))
+            elapsed = time.perf_counter() - started
+            metrics.STAGE_SECONDS.labels(self.name, 'load').observe(elapsed - enriched.seconds - transformed.seconds)
+            self.logger.debug(f'#{num}: Unique items enriched: {enriched.count}')
+            self.logger.debug(f'#{num}: Items loaded: {chunk_loaded}')
+            metrics.DOCUMENTS_LOADED.labels(self.name).inc(chunk_loaded)
+            loaded.append(chunk_loaded)
+            if self.sizer is not None:
+                size = self.sizer.observe(len(chunk), elapsed, meter.bytes)
+                metrics.CHUNK_SIZE.labels(self.name).set(size)
+        return loaded
+
+    def _commit(self, produced: dict[str, list[producers.Chunk]]) -> set[str]:
+        """Сдвигает позиции пайплайнов на последние пачки загруженного раунда.
+
+        :param produced: полученные пачки по пайплайнам
+        :return: имена пайплайнов, чьи позиции сдвинул другой процесс: в этом запуске их изменения больше не собираются
+        """
+        superseded = set()
+        for pipeline in self.pipelines:
+            chunks = produced.get(pipeline.name)
+            if chunks:
+                try:
+                    pipeline.watermark = pipeline.producer.watermark(chunks[-1])
+                except states.Conflict as e:
+                    pipeline._superseded(e)
+                    superseded.add(pipeline.name)
+                    continue
+                for chunk in chunks:
+                    pipeline.producer.acknowledge(chunk)
+                    metrics.observe_freshness(pipeline.lane, min(row.modified for row in chunk))
+                metrics.track_watermark(pipeline.name, chunks[-1][-1].modified)
+        return superseded
+
+
+@dataclass
+class ShardedPipeline:
+    """Выполняет пайплайны только тех шардов, которые воркер арендовал в redis.
+
+    Пайплайны шарда создаются factory при первой аренде шарда. Когда аренда потеряна, пайплайны шарда
+    отменяются и останавливаются после текущей пачки, чтобы шард не загружали одновременно два воркера,
+    при повторной аренде шарда создаются новые пайплайны."""
+
+    name: str
+    leases: leases.Leases
+    factory: Callable[[int], list]
+    logger: logging.Logger
+    _pipelines: dict[int, list] = field(default_factory=dict)
+    _cancelled: threading.Event = field(default_factory=threading.Event)
+
+    def __post_init__(self):
+        self.logger = self.logger.getChild(self.name)
+        self.leases.on_lost(self._lost)
+
+    def cancel(self):
+        """Просит пайплайны шардов остановиться после текущей пачки."""
+        self._cancelled.set()
+        for pipelines in list(self._pipelines.values()):
+            for pipeline in pipelines:
+                pipeline.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @backoff()
+    def execute(self):
+        """Арендует шарды и выполняет их пайплайны."""
+        owned = self.leases.claim()
+        for shard in set(self._pipelines) - owned:
+            self._lost(shard)
+        self.logger.debug(f'Owned shards: {sorted(owned)}')
+
+        for shard in sorted(owned):
+            pipelines = self._pipelines.get(shard)
+            if pipelines is None:
+                pipelines = self._pipelines[shard] = self.factory(shard)
+            for pipeline in pipelines:
+                if self.cancelled or pipeline.cancelled or not self.leases.owns(shard):
+                    break
+                pipeline.execute()
+
+    def _lost(self, shard: int):
+        """Останавливает пайплайны шарда, чья аренда потеряна.
+
+        :param shard:
+        :return:
+        """
+        for pipeline in self._pipelines.pop(shard, []):
+            pipeline.cancel()
@@ -1,13 +1,67 @@
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Generator, NewType
+from datetime import datetime, timezone
+from typing import Generator, NamedTuple, NewType, Optional
 from uuid import UUID
 
+import retries
 from db import DB
-from utils import backoff
+from notifications import Listener
 
-Chunk = NewType('Chunk', list[tuple[UUID, datetime]])
+
+class Row(NamedTuple):
+    """Изменение, найденное продьюсером: id фильма и позиция строки в потоке изменений.
+
+    Для outbox позицией служит seq, а вместо даты изменения - дата записи в outbox."""
+    film_work_id: UUID
+    modified: datetime
+    id: UUID
+
+
+class Watermark(NamedTuple):
+    """Позиция в потоке изменений, до которой данные уже загружены.
+
+    Строки упорядочены по паре (modified, id), поэтому строки с одинаковой датой изменения не теряются."""
+    modified: datetime
+    id: UUID
+
+    @classmethod
+    def initial(cls) -> 'Watermark':
+        """Возвращает позицию начала потока.
+
+        :return:
+        """
+        return cls(datetime.min.replace(tzinfo=timezone.utc), UUID(int=0))
+
+    @classmethod
+    def loads(cls, value: Optional[str]) -> 'Watermark':
+        """Восстанавливает позицию из строки хранилища состояний.
+
+        Поддерживает старый формат, в котором хранилась только дата изменения.
+
+        :param value:
+        :return:
+        """
+        if not value:
+            return cls.initial()
+        modified, _, row_id = value.partition('|')
+        return cls(datetime.fromisoformat(modified), UUID(row_id) if row_id else UUID(int=0))
+
+    def dumps(self) -> str:
+        """Сериализует позицию для хранилища состояний.
+
+        :return:
+        """
+        return f'{self.modified.isoformat()}|{self.id}'
+
+
+Chunk = NewType('Chunk', list[Row])
+
+
+class Shard(NamedTuple):
+    """Шард потока изменений: строки, у которых хэш id фильма по модулю count равен index."""
+    index: int
+    count: int
 
 
 @dataclass
@@ -16,29 +70,153 @@ class Base(metaclass=ABCMeta):
 
     db: DB
     chunk_size: int
+    page_size: int = 10000
+    # Если задан, продьюсер возвращает только строки своего шарда
+    shard: Optional[Shard] = None
+
+    def produce(self, watermark: Watermark) -> Generator[Chunk, None, None]:
+        """ Постранично получает из бд айдишники фильмов, в которых внесены изменения.
+
+        Каждая страница запрашивается отдельным запросом с LIMIT, начиная с позиции последней строки
+        предыдущей страницы, поэтому после перезапуска чтение продолжается ровно с места остановки.
+        Страница читается через серверный курсор пачками по chunk_size строк,
+        поэтому в памяти одновременно находится не больше одной пачки.
+        После временной ошибки postgres чтение продолжается с последней отданной пачки, а не с начала.
+
+        :param watermark: позиция, после которой нужно искать изменения
+        :return:
+        """
+        watermark = self.start(watermark)
+        retry = retries.policy('postgres')
+        attempt = 0
+        while True:
+            fetched = 0
+            try:
+                if retry.breaker is not None:
+                    retry.breaker.before_call()
+                for chunk in self._fetch(watermark):
+                    retry.succeeded()
+                    attempt = 0
+                    fetched += len(chunk)
+                    yield chunk
+                    watermark = self.watermark(chunk)
+            except Exception as e:
+                # страница запрашивается заново с позиции последней отданной пачки
+                retry.failed(e, attempt, f'{type(self).__name__}.produce')
+                attempt += 1
+                continue
+            retry.succeeded()
+            if fetched < self.page_size:
+                return
 
-    @backoff()
-    def produce(self, last_modified: datetime) -> Generator[Chunk, None, None]:
-        """ Выполняет запрос к бд на получение айдишников фильмов, в которых внесены изменения
+    def _fetch(self, watermark: Watermark) -> Generator[Chunk, None, None]:
+        """Читает одну страницу изменений после переданной позиции.
 
-        :param last_modified:
+        :param watermark:
         :return:
         """
-        with self.db.cursor() as curs:
-            curs.execute(self._sql(), (last_modified,))
+        with self.db.cursor(server_side=True, itersize=self.chunk_size) as curs:
+            curs.execute(self._sql(), self.params(watermark))
+            while rows := curs.fetchmany(self.chunk_size):
+                yield Chunk([Row(*row) for row in rows])
 
-            has_rows = True
-            while has_rows:
-                rows = curs.fetchmany(self.chunk_size)
-                if rows:
-                    yield rows
-                else:
-                    has_rows = False
+    def params(self, watermark: Watermark) -> dict:
+        """Возвращает все параметры запроса страницы, включая параметры шарда.
+
+        :param watermark:
+        :return:
+        """
+        params = self._params(watermark)
+        if self.shard is not None:
+            params.update(shard_index=self.shard.index, shard_count=self.shard.count)
+        return params
+
+    def _shard_condition(self, column: str) -> str:
+        """Возвращает условие отбора строк шарда по колонке с id или пустую строку, если шард не задан.
+
+        :param column: колонка, по хэшу которой строки делятся на шарды
+        :return:
+        """
+        if self.shard is None:
+            return ''
+        return f'AND mod(hashtext({column}::text) & 2147483647, %(shard_count)s) = %(shard_index)s'
+
+    def start(self, watermark: Watermark) -> Watermark:
+        """Возвращает позицию, с которой начинается чтение.
+
+        :param watermark: сохраненная позиция
+        :return:
+        """
+        return watermark
+
+    def _params(self, watermark: Watermark) -> dict:
+        """Возвращает параметры запроса страницы после переданной позиции.
+
+        :param watermark:
+        :return:
+        """
+        return dict(modified=watermark.modified, id=watermark.id, limit=self.page_size)
+
+    def acknowledge(self, chunk: Chunk):
+        """Вызывается после того, как пачка загружена и ее позиция сохранена.
+
+        Подтверждение фиксируется сразу, а не вместе с транзакцией курсора, который еще читает следующие пачки:
+        иначе при ошибке или отмене оно откатится и строки придут снова.
+
+        :param chunk:
+        :return:
+        """
+        sql = self._acknowledge_sql()
+        if sql is not None:
+            retries.policy('postgres').call(self._execute, sql, ([row.id for row in chunk],))
+
+    def _execute(self, sql: str, params: tuple):
+        with self.db.autocommit_cursor() as curs:
+            curs.execute(sql, params)
+
+    def _acknowledge_sql(self) -> Optional[str]:
+        """Возвращает sql-запрос, подтверждающий загрузку пачки по id ее строк, или None, если подтверждать нечего.
+
+        :return:
+        """
+        return None
+
+    @staticmethod
+    def load_watermark(value: Optional[str]) -> Watermark:
+        """Восстанавливает позицию из хранилища состояний.
+
+        :param value:
+        :return:
+        """
+        return Watermark.loads(value)
+
+    @staticmethod
+    def dump_watermark(watermark: Watermark) -> str:
+        """Сериализует позицию для хранилища состояний.
+
+        :param watermark:
+        :return:
+        """
+        return watermark.dumps()
+
+    @staticmethod
+    def watermark(chunk: Chunk) -> Watermark:
+        """Возвращает позицию последней строки пачки.
+
+        :param chunk:
+        :return:
+        """
+        last = chunk[-1]
+        return Watermark(last.modified, last.id)
 
     @abstractmethod
     def _sql(self) -> str:
         """Возвращает sql-запрос.
 
+        Запрос должен возвращать id фильма, дату изменения и id строки,
+        упорядочивать строки по (дата изменения, id строки) и ограничиваться LIMIT.
+        Чтобы продьюсер поддерживал шарды, запрос должен включать условие _shard_condition.
+
         :return:
         """
         pass
@@ -52,11 +230,58 @@ class PersonModified(Base):
 
         :return:
         """
-        return '''
-            SELECT pfw.film_work_id, p.modified FROM content.person p 
+        return f'''
+            SELECT pfw.film_work_id, p.modified, pfw.id FROM content.person p
+            INNER JOIN content.person_film_work pfw ON pfw.person_id = p.id
+            WHERE p.modified >= %(modified)s AND (p.modified, pfw.id) > (%(modified)s, %(id)s)
+                {self._shard_condition('pfw.film_work_id')}
+            ORDER BY p.modified, pfw.id
+            LIMIT %(limit)s
+        '''
+
+
+class DirectorModified(Base):
+    """Находит фильмы, в которых режиссерами выступили персоны, чьи данные изменились с последнего синка.
+
+    Режиссеры хранятся в документе только именами, без id, поэтому их переименование
+    требует полной пересборки документа. Актеров и сценаристов обновляет PersonRenamed."""
+
+    def _sql(self) -> str:
+        """Возвращает sql.
+
+        :return:
+        """
+        return f'''
+            SELECT pfw.film_work_id, p.modified, pfw.id FROM content.person p
             INNER JOIN content.person_film_work pfw ON pfw.person_id = p.id
-            WHERE p.modified > %s 
-            ORDER BY p.modified DESC
+            WHERE p.modified >= %(modified)s AND (p.modified, pfw.id) > (%(modified)s, %(id)s)
+                AND pfw.role = 'director' {self._shard_condition('pfw.film_work_id')}
+            ORDER BY p.modified, pfw.id
+            LIMIT %(limit)s
+        '''
+
+
+class PersonRenamed(Base):
+    """Находит актеров и сценаристов, чьи данные изменились с последнего синка.
+
+    В строках вместо id фильма возвращается id персоны: документы обновляются
+    частично по вложенным полям, без поиска и пересборки всех фильмов персоны."""
+
+    def _sql(self) -> str:
+        """Возвращает sql.
+
+        :return:
+        """
+        return f'''
+            SELECT p.id, p.modified, p.id FROM content.person p
+            WHERE (p.modified, p.id) > (%(modified)s, %(id)s)
+                AND EXISTS (
+                    SELECT 1 FROM content.person_film_work pfw
+                    WHERE pfw.person_id = p.id AND pfw.role IN ('actor', 'writer')
+                )
+                {self._shard_condition('p.id')}
+            ORDER BY p.modified, p.id
+            LIMIT %(limit)s
         '''
 
 
@@ -68,11 +293,13 @@ class GenreModified(Base):
 
         :return:
         """
-        return '''
-            SELECT gfw.film_work_id, g.modified FROM content.genre g 
+        return f'''
+            SELECT gfw.film_work_id, g.modified, gfw.id FROM content.genre g
             INNER JOIN content.genre_film_work gfw ON gfw.genre_id = g.id
-            WHERE g.modified > %s 
-            ORDER BY g.modified DESC
+            WHERE g.modified >= %(modified)s AND (g.modified, gfw.id) > (%(modified)s, %(id)s)
+                {self._shard_condition('gfw.film_work_id')}
+            ORDER BY g.modified, gfw.id
+            LIMIT %(limit)s
         '''
 
 
@@ -84,8 +311,141 @@ class FilmworkModified(Base):
 
         :return: str
         """
-        return '''
-            SELECT id, modified FROM content.film_work
-            WHERE modified > %s 
-            ORDER BY modified DESC
+        return f'''
+            SELECT id, modified, id FROM content.film_work
+            WHERE (modified, id) > (%(modified)s, %(id)s) {self._shard_condition('id')}
+            ORDER BY modified, id
+            LIMIT %(limit)s
+        '''
+
+
+@dataclass
+class FilmworkRecent(FilmworkModified):
+    """Находит фильмы, измененные за последние window_sec секунд.
+
+    Более ранние изменения пропускает: их загрузят пайплайны, опрашивающие весь поток изменений."""
+
+    window_sec: float = 300
+
+    def _params(self, watermark: Watermark) -> dict:
+        return dict(super()._params(watermark), window_sec=self.window_sec)
+
+    def _sql(self) -> str:
+        """Возвращает sql-запрос.
+
+        :return: str
+        """
+        return f'''
+            SELECT id, modified, id FROM content.film_work
+            WHERE (modified, id) > (%(modified)s, %(id)s)
+                AND modified > now() - make_interval(secs => %(window_sec)s) {self._shard_condition('id')}
+            ORDER BY modified, id
+            LIMIT %(limit)s
+        '''
+
+
+class ChangeOutbox(Base):
+    """Вычитывает фильмы из таблицы change_outbox, которую заполняют триггеры.
+
+    Триггеры пишут id фильма при изменении самого фильма, его связей с жанрами и персонами,
+    а также связанных с ним жанров и персон. Строки читаются по возрастанию seq
+    и удаляются после загрузки. Сохраненная позиция при чтении не используется:
+    транзакции фиксируются не в порядке выдачи seq, и строка с меньшим seq может появиться позже."""
+
+    def start(self, watermark: Optional[int]) -> int:
+        """Вычитывает все оставшиеся в outbox строки, начиная с меньшего seq.
+
+        :param watermark: не используется
+        :return:
+        """
+        return 0
+
+    def _params(self, watermark: int) -> dict:
+        return dict(seq=watermark, limit=self.page_size)
+
+    def _acknowledge_sql(self) -> str:
+        """Удаляет из outbox строки загруженной пачки.
+
+        :return:
+        """
+        return 'DELETE FROM content.change_outbox WHERE seq = ANY(%s)'
+
+    @staticmethod
+    def load_watermark(value: Optional[str]) -> int:
+        return int(value) if value else 0
+
+    @staticmethod
+    def dump_watermark(watermark: int) -> str:
+        return str(watermark)
+
+    @staticmethod
+    def watermark(chunk: Chunk) -> int:
+        """Возвращает seq последней строки пачки.
+
+        :param chunk:
+        :return:
+        """
+        return chunk[-1].id
+
+    def _sql(self) -> str:
+        """Возвращает sql-запрос.
+
+        :return:
+        """
+        return f'''
+            SELECT film_work_id, created, seq FROM content.change_outbox
+            WHERE seq > %(seq)s {self._shard_condition('film_work_id')}
+            ORDER BY seq
+            LIMIT %(limit)s
+        '''
+
+
+@dataclass
+class Notified(Base):
+    """Находит фильмы, о чьих изменениях сообщили уведомления postgres.
+
+    Позицию в потоке изменений не использует: обрабатывает только накопленные слушателем id.
+    Если включен directors_only, по изменившимся персонам находятся только фильмы, где они режиссеры:
+    имена актеров и сценаристов обновляет PersonRenamed без пересборки документов."""
+
+    listener: Optional[Listener] = None
+    directors_only: bool = False
+
+    def produce(self, watermark: Optional[Watermark] = None) -> Generator[Chunk, None, None]:
+        """Забирает id из слушателя и находит по ним фильмы.
+
+        Пайплайн запрашивает следующую пачку только после загрузки предыдущей, поэтому забранные id
+        подтверждаются, когда после последней пачки пайплайн запросил следующую. Если загрузка упала
+        или пайплайн отменили, id не подтверждаются и следующий запуск загрузит их фильмы заново.
+
+        :param watermark: не используется
+        :return:
+        """
+        changed = self.listener.drain()
+        if not any(changed.values()):
+            return
+
+        with self.db.cursor(server_side=True, itersize=self.chunk_size) as curs:
+            curs.execute(self._sql(), changed)
+            while rows := curs.fetchmany(self.chunk_size):
+                yield Chunk([Row(*row) for row in rows])
+        self.listener.acknowledge()
+
+    def _sql(self) -> str:
+        """Возвращает sql-запрос.
+
+        :return:
+        """
+        role_condition = "AND pfw.role = 'director'" if self.directors_only else ''
+        return f'''
+            SELECT id, modified, id FROM content.film_work
+            WHERE id = ANY(%(film_work)s)
+            UNION
+            SELECT fw.id, fw.modified, fw.id FROM content.film_work fw
+            INNER JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+            WHERE pfw.person_id = ANY(%(person)s) {role_condition}
+            UNION
+            SELECT fw.id, fw.modified, fw.id FROM content.film_work fw
+            INNER JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+            WHERE gfw.genre_id = ANY(%(genre)s)
         '''
@@ -0,0 +1,251 @@
+"""Полная переиндексация фильмов без простоя поиска.
+
+Каталог загружается в новый индекс movies_vN, пока рабочий etl продолжает обновлять
+индекс, на который указывает алиас movies. После загрузки алиас атомарно переключается на новый индекс.
+Фильмы, которые рабочий etl загрузил в старый индекс за время переиндексации, загружаются в новый индекс заново.
+
+Запуск из каталога 01_etl:
+    python reindex.py
+"""
+
+import argparse
+import json
+import os
+from datetime import datetime, timedelta
+from uuid import UUID
+
+import redis
+from elasticsearch import Elasticsearch, NotFoundError
+
+import enrichers
+import loaders
+import producers
+import settings
+import states
+import touched
+import transformers
+from db import DB
+from etl import create_es_client
+from log import logger
+from pipelines import Pipeline
+
+
+def load_schema(name: str) -> dict:
+    """Читает схему индекса из каталога схем.
+
+    :param name: имя индекса без версии
+    :return:
+    """
+    with open(os.path.join(os.path.dirname(settings.ES_SCHEMAS_PATH), f'{name}.json'), 'r') as f:
+        return json.load(f)
+
+
+def versioned_name(alias: str, version: int) -> str:
+    return f'{alias}_v{version}'
+
+
+def next_version(es: Elasticsearch, alias: str) -> int:
+    """Возвращает номер следующей версии индекса.
+
+    :param es:
+    :param alias:
+    :return:
+    """
+    versions = [0]
+    for index in es.indices.get(index=f'{alias}_v*'):
+        suffix = index[len(alias) + 2:]
+        if suffix.isdigit():
+            versions.append(int(suffix))
+    return max(versions) + 1
+
+
+def create_index(es: Elasticsearch, index: str, schema: dict, bulk: bool = False, aliases: dict = None):
+    """Создает индекс по схеме.
+
+    :param es:
+    :param index:
+    :param schema:
+    :param bulk: создать индекс для массовой загрузки: без обновления поиска и без реплик
+    :param aliases: алиасы, которые сразу указывают на индекс
+    :return:
+    """
+    index_settings = dict(schema['settings'])
+    if bulk:
+        index_settings.update(refresh_interval='-1', number_of_replicas=0)
+    es.indices.create(index=index, settings=index_settings, mappings=schema['mappings'], aliases=aliases)
+
+
+def finish_bulk(es: Elasticsearch, index: str, schema: dict):
+    """Возвращает индексу настройки из схемы и сливает сегменты.
+
+    :param es:
+    :param index:
+    :param schema:
+    :return:
+    """
+    # None сбрасывает настройку к значению elasticsearch по умолчанию
+    es.indices.put_settings(index=index, settings={'index': {
+        'refresh_interval': schema['settings'].get('refresh_interval'),
+        'number_of_replicas': schema['settings'].get('number_of_replicas'),
+    }})
+    es.indices.refresh(index=index)
+    es.options(request_timeout=3600).indices.forcemerge(index=index, max_num_segments=1)
+    es.cluster.health(index=index, wait_for_status='yellow', timeout='5m')
+
+
+def swap_alias(es: Elasticsearch, alias: str, index: str) -> list[str]:
+    """Атомарно переключает алиас на индекс.
+
+    Если вместо алиаса существует обычный индекс с таким именем, он удаляется в том же запросе.
+
+    :param es:
+    :param alias:
+    :param index:
+    :return: индексы, на которые алиас указывал раньше
+    """
+    try:
+        previous = list(es.indices.get_alias(name=alias))
+        actions = [{'remove': {'index': name, 'alias': alias}} for name in previous]
+    except NotFoundError:
+        previous = []
+        actions = []
+        if es.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index, 'alias': alias}})
+    es.indices.update_aliases(actions=actions)
+    return previous
+
+
+def load(db: DB, es: Elasticsearch, index: str, sources: dict[str, type[producers.Base]], since: datetime,
+         bulk_threads: int) -> None:
+    """Загружает в индекс фильмы, найденные продьюсерами начиная с переданной даты изменения.
+
+    Позиции хранятся в памяти и не затрагивают состояние рабочего etl.
+
+    :param db:
+    :param es:
+    :param index:
+    :param sources: классы продьюсеров по именам пайплайнов
+    :param since: дата изменения, с которой читать изменения
+    :param bulk_threads: кол-во потоков, параллельно отправляющих bulk-запросы
+    :return:
+    """
+    watermark = producers.Watermark(since, UUID(int=0))
+    state = states.State(states.MemoryStorage({name: watermark.dumps() for name in sources}))
+    for name, producer_cls in sources.items():
+        Pipeline(
+            name=f'Reindex{name}',
+            state=state,
+            producer=producer_cls(db, settings.CHUNK_SIZE, settings.PRODUCER_PAGE_SIZE),
+            enricher=enrichers.MovieDocument(db),
+            transformer=transformers.Passthrough(),
+            loader=loaders.ElasticSearchRawMovie(client=es,
+                                                 index=index,
+                                                 thread_count=bulk_threads,
+                                                 max_batch_docs=settings.ES_BULK_MAX_DOCS,
+                                                 max_batch_bytes=settings.ES_BULK_MAX_BYTES),
+            logger=logger,
+        ).execute()
+
+
+def reload(db: DB, es: Elasticsearch, index: str, ids: list[str], bulk_threads: int) -> int:
+    """Загружает в индекс фильмы по id в их текущем состоянии.
+
+    :param db:
+    :param es:
+    :param index:
+    :param ids:
+    :param bulk_threads: кол-во потоков, параллельно отправляющих bulk-запросы
+    :return: кол-во загруженных документов
+    """
+    enricher = enrichers.MovieDocument(db, itersize=settings.ENRICH_ITERSIZE)
+    loader = loaders.ElasticSearchRawMovie(client=es,
+                                           index=index,
+                                           thread_count=bulk_threads,
+                                           max_batch_docs=settings.ES_BULK_MAX_DOCS,
+                                           max_batch_bytes=settings.ES_BULK_MAX_BYTES)
+    loaded = 0
+    for start in range(0, len(ids), settings.CHUNK_SIZE):
+        loaded += loader.load(enricher.stream([UUID(film_id) for film_id in ids[start:start + settings.CHUNK_SIZE]]))
+    return loaded
+
+
+def db_now(db: DB) -> datetime:
+    with db.cursor() as curs:
+        curs.execute('SELECT now()')
+        return curs.fetchone()[0]
+
+
+def reindex(db: DB, es: Elasticsearch, alias: str, bulk_threads: int, margin: timedelta, delete_previous: bool,
+            touched_ids: touched.RedisTouched):
+    """Загружает каталог в новую версию индекса и переключает на нее алиас.
+
+    Изменения, внесенные за время загрузки, догружаются по дате изменения с запасом margin
+    на транзакции, зафиксированные позже своей даты изменения: перед переключением - за время
+    полной загрузки, после переключения - за время догрузки, пока рабочий etl писал в старый индекс.
+    Изменения без даты изменения, например связей фильмов из outbox, догружаются по id фильмов,
+    которые рабочий etl запомнил в touched_ids до переключения алиаса.
+
+    :param db:
+    :param es:
+    :param alias:
+    :param bulk_threads:
+    :param margin:
+    :param delete_previous: удалить индексы, на которые указывал алиас
+    :param touched_ids: id фильмов, загруженных рабочим etl за время переиндексации
+    :return:
+    """
+    schema = load_schema(alias)
+    index = versioned_name(alias, next_version(es, alias))
+    create_index(es, index, schema, bulk=True)
+    logger.info(f'{index} created')
+
+    catch_up = {
+        'PersonModified': producers.PersonModified,
+        'GenreModified': producers.GenreModified,
+        'FilmworkModified': producers.FilmworkModified,
+    }
+    touched_ids.start(settings.REINDEX_TOUCHED_TTL_SEC)
+    started = db_now(db)
+    load(db, es, index, {'FilmworkModified': producers.FilmworkModified}, producers.Watermark.initial().modified,
+         bulk_threads)
+    logger.info(f'{index} loaded')
+
+    finish_bulk(es, index, schema)
+    logger.info(f'{index} settings restored and segments merged')
+
+    caught_up = db_now(db)
+    load(db, es, index, catch_up, started - margin, bulk_threads)
+    previous = swap_alias(es, alias, index)
+    logger.info(f'{alias} alias moved from {previous or "-"} to {index}')
+
+    load(db, es, index, catch_up, caught_up - margin, bulk_threads)
+    # фильмы, загруженные после переключения, рабочий etl уже пишет в новый индекс
+    ids = touched_ids.drain()
+    loaded = reload(db, es, index, ids, bulk_threads)
+    logger.info(f'{index} caught up, {loaded} of {len(ids)} films loaded by the etl meanwhile reloaded')
+
+    if delete_previous and previous:
+        es.indices.delete(index=','.join(previous))
+        logger.info(f'{", ".join(previous)} deleted')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bulk-threads', type=int, default=max(settings.ES_BULK_THREADS, 4))
+    parser.add_argument('--margin-sec', type=float, default=settings.REINDEX_CATCH_UP_MARGIN_SEC,
+                        help='на сколько секунд раньше начала загрузки искать изменения при догрузке')
+    parser.add_argument('--delete-previous', action='store_true', help='удалить прежний индекс после переключения')
+    args = parser.parse_args()
+
+    db = DB(dsn=settings.PG_DSN)
+    try:
+        touched_ids = touched.RedisTouched(redis=redis.Redis(**settings.REDIS_DSN), name=settings.REINDEX_TOUCHED_KEY)
+        reindex(db, create_es_client(), settings.ES_MOVIE_INDEX_NAME, args.bulk_threads,
+                timedelta(seconds=args.margin_sec), args.delete_previous, touched_ids)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Повторная загрузка документов, которые elasticsearch отклонил при загрузке.
+
+Документы собираются из бд заново, поэтому в индекс попадает их актуальное состояние.
+Загруженные документы и документы, удаленные из бд, убираются из очереди,
+снова отклоненные остаются в ней с увеличенным счетчиком попыток.
+
+Запуск из каталога 01_etl:
+    python replay.py
+"""
+
+import argparse
+from uuid import UUID
+
+import redis
+
+import deadletters
+import settings
+from db import DB
+from etl import create_stages
+from log import logger
+
+
+def replay(db: DB, dead_letters: deadletters.Base, batch_size: int, max_attempts: int = None) -> tuple[int, int]:
+    """Загружает заново документы из очереди.
+
+    Очередь читается один раз, поэтому снова отклоненные документы не загружаются повторно в том же запуске.
+
+    :param db:
+    :param dead_letters: очередь отклоненных документов
+    :param batch_size: сколько документов загружать за раз
+    :param max_attempts: пропускать документы, отклоненные столько раз и больше, None - загружать все
+    :return: кол-во загруженных документов и кол-во документов, оставшихся в очереди после этого запуска
+    """
+    entries = dead_letters.retrieve(dead_letters.count())
+    ids = [doc_id for doc_id, entry in entries.items() if max_attempts is None or entry['attempts'] < max_attempts]
+    logger.info(f'{len(ids)} of {len(entries)} dead letters to replay')
+
+    rejected = deadletters.MemoryDeadLetters()
+    stages = create_stages(db, dead_letters=rejected)
+    total_loaded = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        rejected.entries.clear()
+        items = stages['enricher'].enrich([UUID(doc_id) for doc_id in batch])
+        total_loaded += stages['loader'].load(stages['transformer'].transform(items))
+        failures = {doc_id: rejected.entries[doc_id]['error'] for doc_id in batch if doc_id in rejected.entries}
+        dead_letters.add(failures)
+        dead_letters.remove([doc_id for doc_id in batch if doc_id not in failures])
+        logger.info(f'Replayed {len(batch) - len(failures)} of {len(batch)}')
+    return total_loaded, dead_letters.count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=settings.CHUNK_SIZE)
+    parser.add_argument('--max-attempts', type=int, default=None,
+                        help='не загружать документы, отклоненные столько раз и больше')
+    args = parser.parse_args()
+
+    db = DB(dsn=settings.PG_DSN)
+    try:
+        dead_letters = deadletters.RedisDeadLetters(redis=redis.Redis(**settings.REDIS_DSN),
+                                                    name=settings.DEAD_LETTERS_KEY)
+        loaded, left = replay(db, dead_letters, args.batch_size, args.max_attempts)
+        logger.info(f'Total loaded: {loaded}, left in queue: {left}')
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import wraps
+from typing import Callable, Optional
+
+import psycopg2
+import redis
+from elasticsearch import ApiError, TransportError
+
+import log
+import metrics
+import settings
+
+# Коды ответов elasticsearch, после которых запрос имеет смысл повторить
+RETRIABLE_STATUSES = (429, 502, 503, 504)
+
+# Остановка etl: паузы перед повторами прерываются сразу, новые повторы не выполняются
+STOPPING = threading.Event()
+
+
+class CircuitOpenError(Exception):
+    """Зависимость недоступна: предохранитель разомкнут, запросы к ней не отправляются."""
+
+    def __init__(self, breaker: 'CircuitBreaker', remaining_sec: float):
+        super().__init__(f'Circuit {breaker.name} is open for {remaining_sec:.1f}s')
+        self.remaining_sec = remaining_sec
+
+
+@dataclass
+class CircuitBreaker:
+    """Предохранитель для одной внешней зависимости.
+
+    После failure_threshold ошибок подряд размыкается на reset_timeout_sec: все вызовы сразу получают
+    CircuitOpenError и не нагружают упавший сервис. По истечении времени пропускает один пробный вызов,
+    при успехе замыкается, при ошибке снова размыкается."""
+
+    name: str
+    failure_threshold: int = 5
+    reset_timeout_sec: float = 30
+    logger: logging.Logger = log.logger
+    _failures: int = 0
+    _opened_at: Optional[float] = None
+    _probing: bool = False
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def before_call(self):
+        """Проверяет, можно ли обращаться к зависимости.
+
+        :raises CircuitOpenError: если предохранитель разомкнут
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_timeout_sec - time.monotonic()
+            if remaining > 0 or self._probing:
+                raise CircuitOpenError(self, max(remaining, 0))
+            self._probing = True
+
+    def on_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                self.logger.info(f'Circuit {self.name} closed')
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    self.logger.warning(f'Circuit {self.name} opened after {self._failures} failures')
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class Interrupted(Exception):
+    """Повтор отменен, потому что etl останавливается."""
+
+
+def interrupt():
+    """Прерывает паузы всех повторов и запрещает новые повторы. Вызывается при остановке etl."""
+    STOPPING.set()
+
+
+def pause(seconds: float) -> bool:
+    """Ждет перед повтором, прерываясь при остановке etl.
+
+    :param seconds:
+    :return: True, если etl останавливается и повторять не нужно
+    """
+    return STOPPING.wait(seconds)
+
+
+def is_transient_postgres(e: BaseException) -> bool:
+    return isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+def is_transient_elasticsearch(e: BaseException) -> bool:
+    if isinstance(e, ApiError):
+        return e.meta.status in RETRIABLE_STATUSES
+    return isinstance(e, TransportError)
+
+
+def is_transient_redis(e: BaseException) -> bool:
+    return isinstance(e, (redis.ConnectionError, redis.TimeoutError))
+
+
+@dataclass
+class RetryPolicy:
+    """Повторяет вызов после ошибки с экспоненциально растущей паузой со случайным разбросом.
+
+    Пауза перед n-м повтором выбирается случайно от 0 до min(start_sleep_time * factor^n, border_sleep_time),
+    чтобы воркеры, упавшие одновременно, не возвращались к сервису одновременно.
+    Повторяются только ошибки, для которых retry_on возвращает True, остальные пробрасываются сразу.
+    Если задан предохранитель, пока он разомкнут, вызов не выполняется, а пауза длится до его проверки.
+    При остановке etl пауза прерывается, и ошибка пробрасывается без повтора."""
+
+    start_sleep_time: float = 0.1
+    factor: float = 2
+    border_sleep_time: float = 10
+    # Сколько всего попыток делать, None - без ограничения
+    max_tries: Optional[int] = None
+    retry_on: Callable[[BaseException], bool] = lambda e: isinstance(e, Exception)
+    breaker: Optional[CircuitBreaker] = None
+    logger: logging.Logger = log.logger
+
+    def __call__(self, func: Callable) -> Callable:
+        @wraps(func)
+        def inner(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+
+        return inner
+
+    def call(self, func: Callable, *args, **kwargs):
+        """Вызывает функцию, повторяя ее после ошибок по правилам политики.
+
+        :param func:
+        :return: результат функции
+        """
+        attempt = 0
+        while True:
+            try:
+                if self.breaker is not None:
+                    self.breaker.before_call()
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self.failed(e, attempt, getattr(func, '__qualname__', repr(func)))
+                attempt += 1
+                continue
+            self.succeeded()
+            return result
+
+    def succeeded(self):
+        if self.breaker is not None:
+            self.breaker.on_success()
+
+    def failed(self, error: Exception, attempt: int, name: str):
+        """Обрабатывает ошибку попытки: пробрасывает ее, если повторять нельзя, иначе ждет перед повтором.
+
+        :param error:
+        :param attempt: номер неудачной попытки, начиная с 0
+        :param name: имя повторяемой операции для лога и метрик
+        :return:
+        """
+        if pause(self.next_delay(error, attempt, name)):
+            raise error
+
+    def next_delay(self, error: Exception, attempt: int, name: str) -> float:
+        """Решает, повторять ли вызов после ошибки попытки: пробрасывает ошибку, если повторять нельзя.
+
+        :param error:
+        :param attempt: номер неудачной попытки, начиная с 0
+        :param name: имя повторяемой операции для лога и метрик
+        :return: пауза перед повтором
+        """
+        if isinstance(error, CircuitOpenError):
+            if self.max_tries is not None and attempt + 1 >= self.max_tries:
+                raise error
+            self.logger.info(error)
+            return max(error.remaining_sec, self.delay(attempt))
+
+        if not self.retry_on(error):
+            # зависимость ответила, ошибка не в ее доступности
+            self.succeeded()
+            raise error
+        if self.breaker is not None:
+            self.breaker.on_failure()
+        if self.max_tries is not None and attempt + 1 >= self.max_tries:
+            raise error
+
+        metrics.RETRIES.labels(name).inc()
+        delay = self.delay(attempt)
+        self.logger.info(f'{name} failed, retry #{attempt + 1} in {delay:.2f}s: {error}')
+        return delay
+
+    def delay(self, attempt: int) -> float:
+        """Возвращает паузу перед повтором.
+
+        :param attempt: номер неудачной попытки, начиная с 0
+        :return:
+        """
+        return random.uniform(0, min(self.start_sleep_time * self.factor ** attempt, self.border_sleep_time))
+
+
+BREAKERS = {
+    dependency: CircuitBreaker(dependency,
+                               failure_threshold=settings.BREAKER_FAILURE_THRESHOLD,
+                               reset_timeout_sec=settings.BREAKER_RESET_TIMEOUT_SEC)
+    for dependency in ('postgres', 'elasticsearch', 'redis')
+}
+
+TRANSIENT_ERRORS = {
+    'postgres': is_transient_postgres,
+    'elasticsearch': is_transient_elasticsearch,
+    'redis': is_transient_redis,
+}
+
+
+def policy(dependency: str, max_tries: Optional[int] = settings.RETRY_MAX_TRIES) -> RetryPolicy:
+    """Возвращает политику повторов для обращений к зависимости.
+
+    Повторяются только временные ошибки зависимости, через ее общий предохранитель.
+
+    :param dependency: postgres, elasticsearch или redis
+    :param max_tries: сколько всего попыток делать, None - без ограничения
+    :return:
+    """
+    return RetryPolicy(max_tries=max_tries, retry_on=TRANSIENT_ERRORS[dependency], breaker=BREAKERS[dependency])
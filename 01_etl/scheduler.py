@@ -0,0 +1,226 @@
+import logging
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Optional
+
+import redis
+
+from notifications import Listener
+
+
+@dataclass
+class Job:
+    """Пайплайн с интервалом запуска."""
+
+    pipeline: Any
+    # Через сколько секунд после завершения запускать пайплайн снова, None - только по пробуждению
+    interval_sec: Optional[float]
+    next_run: float = 0
+
+    @property
+    def name(self) -> str:
+        return self.pipeline.name
+
+
+@dataclass
+class Scheduler:
+    """Запускает пайплайны по их интервалам и сразу после пробуждения внешним событием.
+
+    При workers больше 1 каждый пайплайн выполняется в пуле потоков независимо от остальных:
+    закончившийся пайплайн планируется заново по своему интервалу, не дожидаясь долгой загрузки соседей.
+    Иначе пайплайны, чей срок подошел, выполняются друг за другом. Между запусками планировщик ждет
+    ближайшего срока, пробуждения или завершения пайплайна.
+    Остановка прерывает ожидание сразу, а выполняющиеся пайплайны - после текущей пачки."""
+
+    jobs: list[Job]
+    logger: logging.Logger
+    workers: int = 1
+    _woken: set[str] = field(default_factory=set)
+    _wakeup: threading.Event = field(default_factory=threading.Event)
+    _stopped: threading.Event = field(default_factory=threading.Event)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def wake(self, names: Optional[Iterable[str]] = None):
+        """Запускает пайплайны, не дожидаясь их срока.
+
+        :param names: имена пайплайнов, None - все пайплайны
+        :return:
+        """
+        with self._lock:
+            self._woken.update(names if names is not None else (job.name for job in self.jobs))
+        self._wakeup.set()
+
+    def stop(self):
+        """Останавливает планировщик и просит выполняющиеся пайплайны остановиться после текущей пачки."""
+        self._stopped.set()
+        self._wakeup.set()
+        for job in self.jobs:
+            job.pipeline.cancel()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped.is_set()
+
+    def run(self):
+        """Выполняет пайплайны, пока планировщик не остановлен."""
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pipeline') as executor:
+                self._run_concurrently(executor)
+        else:
+            self._run_sequentially()
+
+    def _run_sequentially(self):
+        while not self.stopped:
+            due = self._due()
+            if not due:
+                self._wait()
+                continue
+            for job in due:
+                if self.stopped:
+                    return
+                try:
+                    job.pipeline.execute()
+                except Exception as e:
+                    self._failed(job, e)
+                    return
+                self._schedule(job)
+
+    def _run_concurrently(self, executor: ThreadPoolExecutor):
+        """Держит по одному выполнению каждого пайплайна в пуле.
+
+        :param executor:
+        :return:
+        """
+        running: dict[str, tuple[Job, Future]] = {}
+        try:
+            while not self.stopped:
+                for job in self._due(running):
+                    future = executor.submit(job.pipeline.execute)
+                    future.add_done_callback(lambda _: self._wakeup.set())
+                    running[job.name] = job, future
+
+                for name, (job, future) in list(running.items()):
+                    if future.done():
+                        del running[name]
+                        self._schedule(job)
+                        if future.exception() is not None:
+                            self._failed(job, future.exception())
+
+                if not self.stopped:
+                    self._wait(running)
+        finally:
+            wait([future for _, future in running.values()])
+
+    def _failed(self, job: Job, error: Exception):
+        """Пробрасывает ошибку пайплайна, если только его не прервала остановка.
+
+        :param job:
+        :param error:
+        :return:
+        """
+        if not self.stopped:
+            raise error
+        self.logger.info(f'{job.name} interrupted by stop: {error}')
+
+    def _schedule(self, job: Job):
+        """Назначает следующий запуск завершившегося пайплайна.
+
+        :param job:
+        :return:
+        """
+        job.next_run = time.monotonic() + job.interval_sec if job.interval_sec is not None else float('inf')
+
+    def _due(self, running: Iterable[str] = ()) -> list[Job]:
+        """Забирает пайплайны, чей срок подошел или которых разбудили.
+
+        Пробуждение выполняющегося пайплайна откладывается до его завершения.
+
+        :param running: имена выполняющихся пайплайнов
+        :return:
+        """
+        running = set(running)
+        now = time.monotonic()
+        with self._lock:
+            self._wakeup.clear()
+            woken = self._woken - running
+            self._woken &= running
+        return [job for job in self.jobs
+                if job.name not in running and (job.name in woken or job.next_run <= now)]
+
+    def _wait(self, running: Iterable[str] = ()):
+        """Ждет ближайшего срока, пробуждения, завершения пайплайна или остановки.
+
+        :param running: имена выполняющихся пайплайнов, их срок не учитывается
+        :return:
+        """
+        running = set(running)
+        next_run = min((job.next_run for job in self.jobs if job.name not in running), default=float('inf'))
+        timeout = next_run - time.monotonic()
+        self._wakeup.wait(None if timeout == float('inf') else max(timeout, 0))
+
+
+@dataclass
+class Trigger(metaclass=ABCMeta):
+    """Будит планировщик по внешнему событию, которое ожидается в отдельном потоке.
+
+    Поток завершается вместе с остановкой планировщика."""
+
+    scheduler: Scheduler
+    logger: logging.Logger
+
+    def start(self):
+        threading.Thread(target=self._run, name=type(self).__name__, daemon=True).start()
+
+    def _run(self):
+        while not self.scheduler.stopped:
+            try:
+                self._listen()
+            except Exception as e:
+                self.logger.warning(f'{type(self).__name__} failed: {e}')
+                time.sleep(1)
+
+    @abstractmethod
+    def _listen(self):
+        """Ждет событие не дольше нескольких секунд и будит планировщик, если оно пришло."""
+        pass
+
+
+@dataclass
+class RedisTrigger(Trigger):
+    """Будит пайплайны по записи в список redis.
+
+    Элемент списка - имя пайплайна или пустая строка, чтобы разбудить все пайплайны, например:
+        LPUSH etl:wakeup FilmworkModified"""
+
+    redis: redis.Redis
+    key: str
+    timeout_sec: int = 1
+
+    def _listen(self):
+        item = self.redis.blpop([self.key], timeout=self.timeout_sec)
+        if item is not None:
+            name = item[1].decode()
+            self.logger.debug(f'Woken by {self.key}: {name or "all"}')
+            self.scheduler.wake([name] if name else None)
+
+
+@dataclass
+class ListenerTrigger(Trigger):
+    """Будит пайплайн уведомлений, как только слушатель получил уведомления postgres.
+
+    Если уведомлений пришло больше, чем слушатель копит, будит все пайплайны: изменения подберет опрос бд."""
+
+    listener: Listener
+    names: list[str]
+    timeout_sec: float = 1
+
+    def _listen(self):
+        pending = self.listener.wait(self.timeout_sec)
+        if self.listener.overflowed():
+            self.logger.debug('Woken by listener overflow: all')
+            self.scheduler.wake(None)
+        elif pending:
+            self.scheduler.wake(self.names)
@@ -1,15 +1,87 @@
 import logging
 import os
+import socket
 
 from psycopg2.extras import DictCursor, register_uuid
 
 register_uuid()
 
 # Частота проверки обновлений
-CHECK_INTERVAL_SEC = os.environ.get('CHECK_INTERVAL_SEC', 10)
+CHECK_INTERVAL_SEC = int(os.environ.get('CHECK_INTERVAL_SEC', 10))
+# Интервалы опроса отдельных пайплайнов вместо CHECK_INTERVAL_SEC, например FilmworkModified=5,GenreModified=60
+PIPELINE_INTERVALS_SEC = {
+    name.strip(): float(interval)
+    for name, _, interval in (item.partition('=') for item in os.environ.get('ETL_PIPELINE_INTERVALS', '').split(','))
+    if name.strip()
+}
+# Список redis, запись в который сразу запускает пайплайн: LPUSH etl:wakeup FilmworkModified,
+# пустая строка запускает все пайплайны. Пустое имя ключа отключает пробуждение через redis
+WAKEUP_KEY = os.environ.get('ETL_WAKEUP_KEY', 'etl:wakeup')
 
-# Кол-во загружаемых записей за раз из бд
-CHUNK_SIZE = 1000
+# Кол-во загружаемых записей за раз из бд, при подборе размера пачек - начальное
+CHUNK_SIZE = int(os.environ.get('ETL_CHUNK_SIZE', 1000))
+
+# Подбирать размер пачек по времени обработки и объему документов, чтобы пачки фильмов
+# с большим составом не загружались намного дольше пачек с маленьким
+ADAPTIVE_CHUNKS = os.environ.get('ETL_ADAPTIVE_CHUNKS', 'false').lower() == 'true'
+# Границы подбираемого размера пачки
+CHUNK_SIZE_MIN = int(os.environ.get('ETL_CHUNK_SIZE_MIN', 100))
+CHUNK_SIZE_MAX = int(os.environ.get('ETL_CHUNK_SIZE_MAX', 5000))
+# Сколько секунд должны занимать обогащение, преобразование и загрузка одной пачки
+CHUNK_TARGET_SEC = float(os.environ.get('ETL_CHUNK_TARGET_SEC', 1))
+# Сколько байт готовых документов должна давать одна пачка, 0 - без ограничения.
+# Учитывается, только если документы собираются в postgres (ETL_DOCUMENT_MODE=raw)
+CHUNK_TARGET_BYTES = int(os.environ.get('ETL_CHUNK_TARGET_BYTES', 0))
+
+# Сколько фильмов обогатитель читает из бд за раз: пачка проходит обогащение, преобразование и загрузку потоком,
+# поэтому в памяти одновременно находятся только эти фильмы и одно тело bulk-запроса
+ENRICH_ITERSIZE = int(os.environ.get('ETL_ENRICH_ITERSIZE', 50))
+
+# Кол-во строк в одном запросе продьюсера, страница читается через серверный курсор пачками по CHUNK_SIZE
+PRODUCER_PAGE_SIZE = int(os.environ.get('ETL_PRODUCER_PAGE_SIZE', 10000))
+
+# Кол-во потоков для параллельного выполнения пайплайнов, 1 - последовательное выполнение
+WORKERS = int(os.environ.get('ETL_WORKERS', 1))
+
+# Режим выполнения пайплайна: sequential - этапы по очереди, staged - этапы одновременно в своих потоках
+PIPELINE_MODE = os.environ.get('ETL_PIPELINE_MODE', 'sequential')
+# Размер очередей между этапами в режиме staged
+PIPELINE_QUEUE_SIZE = int(os.environ.get('ETL_PIPELINE_QUEUE_SIZE', 2))
+
+# Рантайм etl: sync - потоки и синхронные клиенты, async - asyncio с asyncpg, AsyncElasticsearch и redis.asyncio
+RUNTIME = os.environ.get('ETL_RUNTIME', 'sync')
+# Кол-во пачек одного пайплайна, которые асинхронный рантайм обогащает и загружает одновременно
+ASYNC_CHUNKS_IN_FLIGHT = int(os.environ.get('ETL_ASYNC_CHUNKS_IN_FLIGHT', 4))
+
+# Полоса свежих правок фильмов: отдельный поток, который загружает недавно измененные фильмы маленькими
+# пачками и сразу обновляет поиск, не дожидаясь, пока основной цикл разберет большой объем изменений.
+# В режиме шардов не используется
+HOT_LANE = os.environ.get('ETL_HOT_LANE', 'false').lower() == 'true'
+# Как часто полоса опрашивает бд
+HOT_INTERVAL_SEC = float(os.environ.get('ETL_HOT_INTERVAL_SEC', 0.5))
+# Изменения старше стольких секунд полоса пропускает, их загрузит основной цикл
+HOT_WINDOW_SEC = float(os.environ.get('ETL_HOT_WINDOW_SEC', 300))
+# Размер пачки и кол-во строк, которые полоса читает за один запрос
+HOT_CHUNK_SIZE = int(os.environ.get('ETL_HOT_CHUNK_SIZE', 10))
+HOT_PAGE_SIZE = int(os.environ.get('ETL_HOT_PAGE_SIZE', 100))
+# Параметр refresh bulk-запросов полосы: true - обновить поиск сразу, wait_for - дождаться планового обновления
+HOT_REFRESH = os.environ.get('ETL_HOT_REFRESH', 'true')
+# Цели по времени от изменения в бд до загрузки для полосы свежих правок и основного цикла
+HOT_SLO_SEC = float(os.environ.get('ETL_HOT_SLO_SEC', 2))
+BULK_SLO_SEC = float(os.environ.get('ETL_BULK_SLO_SEC', 300))
+
+# Объединять изменения всех продьюсеров в один набор фильмов за цикл синхронизации
+COALESCE = os.environ.get('ETL_COALESCE', 'false').lower() == 'true'
+# Сколько пачек уникальных фильмов собирать за один раунд объединения, после раунда позиции сохраняются
+COALESCE_ROUND_CHUNKS = int(os.environ.get('ETL_COALESCE_ROUND_CHUNKS', 10))
+
+# Кол-во шардов, на которые делятся фильмы по хэшу id. 0 - шарды выключены и etl должен работать в одном экземпляре,
+# иначе каждый экземпляр арендует в redis свою долю шардов и хранит позиции каждого шарда отдельно
+SHARDS = int(os.environ.get('ETL_SHARDS', 0))
+# Время жизни аренды шарда: если воркер не продлил аренду за это время, шард забирают другие воркеры
+SHARD_LEASE_TTL_SEC = float(os.environ.get('ETL_SHARD_LEASE_TTL_SEC', 30))
+# Имя воркера в арендах, должно быть уникальным среди запущенных экземпляров
+WORKER_ID = os.environ.get('ETL_WORKER_ID', f'{socket.gethostname()}:{os.getpid()}')
 
 PG_DSN = dict(
     dbname=os.environ.get('DB_NAME'),
@@ -21,6 +93,36 @@ PG_DSN = dict(
     cursor_factory=DictCursor,
 )
 
+# Размер пула соединений с postgres. Каждому потоку пайплайна нужно свое соединение,
+# в режиме staged продьюсер и обогатитель работают в разных потоках, полосе свежих правок нужно еще одно
+PG_POOL_MIN_SIZE = int(os.environ.get('PG_POOL_MIN_SIZE', 1))
+PG_POOL_MAX_SIZE = int(os.environ.get('PG_POOL_MAX_SIZE', WORKERS * 2 + 1 + (1 if HOT_LANE else 0)))
+# Как часто проверять простаивающее соединение перед выдачей из пула
+PG_POOL_HEALTH_CHECK_INTERVAL_SEC = float(os.environ.get('PG_POOL_HEALTH_CHECK_INTERVAL_SEC', 30))
+
+# Источник изменений: modified - опрос таблиц по дате изменения, outbox - таблица change_outbox,
+# которую заполняют триггеры, в том числе при изменении связей фильма с жанрами и персонами
+SYNC_SOURCE = os.environ.get('ETL_SYNC_SOURCE', 'modified')
+
+# Обновлять имена актеров и сценаристов частично через update_by_query, не пересобирая их фильмы.
+# Полная пересборка остается для режиссеров, которые хранятся в документе без id
+PERSON_PARTIAL_UPDATES = os.environ.get('ETL_PERSON_PARTIAL_UPDATES', 'true').lower() == 'true'
+
+# Способ сборки документов: raw - документ собирается в postgres и передается в bulk готовой json-строкой,
+# validated - строки бд разбираются в модели pydantic и проверяются перед загрузкой
+DOCUMENT_MODE = os.environ.get('ETL_DOCUMENT_MODE', 'raw')
+
+# Слушать уведомления postgres об изменениях и загружать их сразу, не дожидаясь очередного опроса
+LISTEN_ENABLED = os.environ.get('ETL_LISTEN_ENABLED', 'true').lower() == 'true'
+# Канал, в который триггеры отправляют id изменившихся сущностей
+LISTEN_CHANNEL = 'content_changes'
+# Интервал страховочного опроса вместо CHECK_INTERVAL_SEC, пока уведомления слушаются: опрос только подбирает
+# пропущенные уведомления, поэтому простаивающий etl почти не нагружает бд. ETL_PIPELINE_INTERVALS важнее
+LISTEN_FALLBACK_INTERVAL_SEC = float(os.environ.get('ETL_LISTEN_FALLBACK_INTERVAL_SEC', 300))
+# Сколько id из уведомлений копить до загрузки. Массовое изменение присылает уведомление на каждую строку:
+# если id больше, они отбрасываются и вместо загрузки по ним сразу запускается опрос бд всеми пайплайнами
+LISTEN_MAX_PENDING = int(os.environ.get('ETL_LISTEN_MAX_PENDING', 10000))
+
 REDIS_DSN = dict(
     host=os.environ.get('REDIS_HOST', '127.0.0.1'),
     port=os.environ.get('REDIS_PORT', 6379),
@@ -29,12 +131,56 @@ REDIS_DSN = dict(
 
 # ключ, по которому будет храниться состояние в хранилище
 STORAGE_STATE_KEY = 'etl'
+# Сколько позиций пачек копить перед записью в redis. По умолчанию позиция записывается после каждой пачки,
+# и после падения etl продолжает ровно с последней загруженной пачки. Значение больше 1 сокращает запросы к redis
+# ценой повторной загрузки: после падения заново загрузится до стольких пачек каждого пайплайна
+# (или пачек за ETL_STATE_FLUSH_INTERVAL_SEC). В конце каждого цикла синхронизации позиции записываются всегда
+STATE_FLUSH_EVERY = int(os.environ.get('ETL_STATE_FLUSH_EVERY', 1))
+# Записывать накопленные позиции при очередном сохранении, если с прошлой записи прошло столько секунд
+STATE_FLUSH_INTERVAL_SEC = float(os.environ.get('ETL_STATE_FLUSH_INTERVAL_SEC', 5))
+# Записывать позицию, только если с последнего чтения ее не изменил другой процесс etl
+STATE_COMPARE_AND_SET = os.environ.get('ETL_STATE_COMPARE_AND_SET', 'true').lower() == 'true'
+
+# Не загружать документы, чей хэш не изменился с прошлой загрузки. Хэши хранятся в redis отдельно от индекса
+# и сбрасываются только при создании индекса через init_schema: если индекс удалили, восстановили или пересоздали
+# иначе, перед запуском нужно удалить ключ FINGERPRINTS_KEY, или неизменившиеся документы в индекс не попадут
+SKIP_UNCHANGED = os.environ.get('ETL_SKIP_UNCHANGED', 'false').lower() == 'true'
+# ключ, по которому хранятся хэши загруженных документов
+FINGERPRINTS_KEY = 'etl:fingerprints'
+# ключ, по которому хранятся документы, отклоненные elasticsearch, до повторной загрузки через replay.py
+DEAD_LETTERS_KEY = 'etl:dead_letters'
 
 ES_SCHEMA = os.environ.get('ES_SCHEMA', 'https')
 ES_HOST = os.environ.get('ES_HOST', '127.0.0.1')
 ES_PORT = os.environ.get('ES_PORT', 9200)
-ES_MAX_RETRIES = os.environ.get('ES_MAX_RETRIES', 3)
+ES_MAX_RETRIES = int(os.environ.get('ES_MAX_RETRIES', 3))
 ES_MOVIE_INDEX_NAME = 'movies'
+# Сжимать http-запросы к elasticsearch gzip
+ES_HTTP_COMPRESS = os.environ.get('ES_HTTP_COMPRESS', 'false').lower() == 'true'
+# Кол-во потоков, параллельно отправляющих bulk-запросы
+ES_BULK_THREADS = int(os.environ.get('ES_BULK_THREADS', 1))
+# Кол-во одновременных bulk-запросов одной пачки в асинхронном рантайме
+ES_BULK_CONCURRENCY = int(os.environ.get('ES_BULK_CONCURRENCY', 4))
+# Ограничения одного bulk-запроса по кол-ву документов и размеру тела в байтах
+ES_BULK_MAX_DOCS = int(os.environ.get('ES_BULK_MAX_DOCS', 500))
+ES_BULK_MAX_BYTES = int(os.environ.get('ES_BULK_MAX_BYTES', 10 * 1024 * 1024))
 ES_SCHEMAS_PATH = 'schemas/*.json'
+# Запас при догрузке изменений после полной переиндексации на транзакции,
+# зафиксированные позже своей даты изменения
+REINDEX_CATCH_UP_MARGIN_SEC = float(os.environ.get('REINDEX_CATCH_UP_MARGIN_SEC', 60))
+# Множество redis, в котором рабочий etl запоминает загруженные фильмы, пока идет переиндексация,
+# и через сколько секунд оно удаляется, если переиндексация упала
+REINDEX_TOUCHED_KEY = 'etl:reindex:touched'
+REINDEX_TOUCHED_TTL_SEC = int(os.environ.get('REINDEX_TOUCHED_TTL_SEC', 24 * 3600))
+
+# Сколько попыток делать при временных ошибках postgres, elasticsearch и redis, прежде чем
+# перезапустить пайплайн с сохраненной позиции
+RETRY_MAX_TRIES = int(os.environ.get('ETL_RETRY_MAX_TRIES', 5))
+# После скольких ошибок подряд зависимость считается недоступной и на сколько секунд запросы к ней прекращаются
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('ETL_BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT_SEC = float(os.environ.get('ETL_BREAKER_RESET_TIMEOUT_SEC', 30))
+
+# Порт http-сервера с метриками prometheus, 0 - метрики не публикуются
+METRICS_PORT = int(os.environ.get('ETL_METRICS_PORT', 8000))
 
 LOGGING_LEVEL = logging.DEBUG
@@ -1,9 +1,43 @@
+import logging
+import threading
+import time
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass, field
-from typing import Any
+from typing import Any, Optional
 
 import redis
 
+import log
+import retries
+
+# Записывает поля хэша, если их значение не изменилось с последнего чтения. ARGV - четверки
+# (поле, 1 если ожидаемое значение есть, ожидаемое значение, новое значение).
+# Поле, уже содержащее новое значение, не считается конфликтом: так повтор после потерянного ответа безопасен.
+# Возвращает пары (поле, текущее значение) для полей, которые изменил кто-то другой.
+COMPARE_AND_SET = """
+local conflicts = {}
+for i = 1, #ARGV, 4 do
+    local current = redis.call('HGET', KEYS[1], ARGV[i])
+    local expected = ARGV[i + 1] == '1' and ARGV[i + 2] or false
+    if current == expected or current == ARGV[i + 3] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 3])
+    else
+        table.insert(conflicts, ARGV[i])
+        table.insert(conflicts, current or '')
+    end
+end
+return conflicts
+"""
+
+
+class Conflict(Exception):
+    """Поле состояния изменил другой процесс: значение, вычисленное от старого значения, сохранять нельзя."""
+
+    def __init__(self, key: str, current: Optional[Any]):
+        super().__init__(f'State {key} was changed by another process to {current}')
+        self.key = key
+        self.current = current
+
 
 @dataclass
 class BaseStorage(metaclass=ABCMeta):
@@ -19,13 +53,30 @@ class BaseStorage(metaclass=ABCMeta):
 
     @abstractmethod
     def save_state(self, state: dict) -> bool:
-        """Сохраняет состояние.
+        """Сохраняет переданные поля состояния, остальные поля не меняются.
 
         :param state:
         :return:
         """
         pass
 
+    def retrieve_field(self, key: str) -> Optional[Any]:
+        """Возвращает сохраненное значение одного поля.
+
+        :param key:
+        :return:
+        """
+        return self.retrieve_state().get(key)
+
+    @abstractmethod
+    def compare_and_set(self, changes: dict[str, tuple[Optional[Any], Any]]) -> dict[str, Optional[Any]]:
+        """Сохраняет поля, чье значение в хранилище равно ожидаемому.
+
+        :param changes: ожидаемое и новое значение по полям, ожидаемое None - поля еще нет
+        :return: текущие значения полей, которые не были сохранены, потому что их изменил кто-то другой
+        """
+        pass
+
 
 @dataclass
 class RedisStorage(BaseStorage):
@@ -33,6 +84,10 @@ class RedisStorage(BaseStorage):
     redis: redis.Redis
     name: str
 
+    def __post_init__(self):
+        self._compare_and_set = self.redis.register_script(COMPARE_AND_SET)
+
+    @retries.policy('redis')
     def retrieve_state(self) -> Any:
         """Возвращает сохраненное состояние.
 
@@ -41,14 +96,36 @@ class RedisStorage(BaseStorage):
         state = self.redis.hgetall(self.name)
         return self.decode_redis(state)
 
+    @retries.policy('redis')
     def save_state(self, state: dict) -> None:
         """
-        Сохраняет состояние.
+        Сохраняет переданные поля состояния одной командой.
 
         :param state:
         :return:
         """
-        self.redis.hset(self.name, mapping=state)
+        if state:
+            self.redis.hset(self.name, mapping=state)
+
+    @retries.policy('redis')
+    def retrieve_field(self, key: str) -> Optional[Any]:
+        value = self.redis.hget(self.name, key)
+        return value.decode() if value is not None else None
+
+    @retries.policy('redis')
+    def compare_and_set(self, changes: dict[str, tuple[Optional[Any], Any]]) -> dict[str, Optional[Any]]:
+        """Сохраняет поля одним скриптом: все поля проверяются и записываются атомарно за один запрос.
+
+        :param changes:
+        :return:
+        """
+        if not changes:
+            return {}
+        args = []
+        for key, (expected, value) in changes.items():
+            args += [key, '0' if expected is None else '1', '' if expected is None else expected, value]
+        result = self.decode_redis(self._compare_and_set(keys=[self.name], args=args))
+        return {key: current or None for key, current in zip(result[::2], result[1::2])}
 
     @classmethod
     def decode_redis(cls, src):
@@ -73,15 +150,63 @@ class RedisStorage(BaseStorage):
             raise Exception("type not handled: " + type(src))
 
 
+@dataclass
+class MemoryStorage(BaseStorage):
+    """Хранит состояние в памяти процесса. Используется, когда позиции не должны пережить запуск
+    и не должны затрагивать состояние рабочего etl."""
+    state: dict = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def retrieve_state(self) -> dict:
+        return dict(self.state)
+
+    def save_state(self, state: dict) -> None:
+        self.state.update(state)
+
+    def compare_and_set(self, changes: dict[str, tuple[Optional[Any], Any]]) -> dict[str, Optional[Any]]:
+        conflicts = {}
+        with self._lock:
+            for key, (expected, value) in changes.items():
+                current = self.state.get(key)
+                if current == expected or current == value:
+                    self.state[key] = value
+                else:
+                    conflicts[key] = current
+        return conflicts
+
+
 @dataclass
 class State:
-    """Управляет состоянием."""
+    """Управляет состоянием.
+
+    Сохраненные значения копятся в памяти и записываются в хранилище только измененными полями:
+    каждые flush_every сохранений или не реже чем раз в flush_interval_sec при очередном сохранении,
+    а также при вызове flush. До записи retrieve_state возвращает несохраненное значение,
+    остальные значения читаются из хранилища, поэтому видны изменения, сделанные другими процессами.
+    Если включен compare_and_set, поле записывается, только если с последнего чтения его никто не изменил,
+    иначе несохраненное значение отбрасывается в пользу значения из хранилища, а следующее сохранение
+    этого поля бросает Conflict, пока поле не будет прочитано заново: иначе следующее значение, вычисленное
+    от отброшенного, прошло бы проверку и перезаписало значение другого процесса."""
 
     storage: BaseStorage
-    _state: dict[str, Any] = field(default_factory=dict)
+    # Сколько сохранений копить перед записью в хранилище, 1 - записывать каждое
+    flush_every: int = 1
+    # Как давно должна была быть последняя запись, чтобы очередное сохранение записалось сразу, 0 - не учитывать
+    flush_interval_sec: float = 0
+    compare_and_set: bool = False
+    logger: logging.Logger = log.logger
+    # Несохраненные значения
+    _pending: dict[str, Any] = field(default_factory=dict)
+    # Значения, которые были в хранилище при последнем чтении или записи этим процессом
+    _known: dict[str, Any] = field(default_factory=dict)
+    # Значения из хранилища для полей, которые изменил другой процесс, пока их не прочитали заново
+    _conflicts: dict[str, Any] = field(default_factory=dict)
+    _saves: int = 0
+    _flushed_at: float = field(default_factory=time.monotonic)
+    _lock: threading.RLock = field(default_factory=threading.RLock)
 
     def __post_init__(self):
-        self._state = self.storage.retrieve_state()
+        self._known = self.storage.retrieve_state()
 
     def retrieve_state(self, key: str) -> Any:
         """Возвращает сохраненное состояние по ключу.
@@ -89,14 +214,61 @@ class State:
         :param key:
         :return:
         """
-        return self._state.get(key)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            value = self.storage.retrieve_field(key)
+            self._known[key] = value
+            self._conflicts.pop(key, None)
+            return value
 
-    def save_state(self, key: str, value: Any) -> bool:
-        """Сохраняет значение по ключу.
+    def save_state(self, key: str, value: Any) -> None:
+        """Сохраняет значение по ключу, записывая его в хранилище по правилам группировки.
 
         :param key:
         :param value:
         :return:
+        :raises Conflict: если поле изменил другой процесс после того, как его прочитал этот
+        """
+        with self._lock:
+            self._raise_conflict(key)
+            self._pending[key] = value
+            self._saves += 1
+            if self._saves >= self.flush_every or (
+                    self.flush_interval_sec and time.monotonic() - self._flushed_at >= self.flush_interval_sec):
+                self.flush()
+                self._raise_conflict(key)
+
+    def _raise_conflict(self, key: str) -> None:
+        """Бросает Conflict, если поле изменил другой процесс, и забывает о конфликте.
+
+        :param key:
+        :return:
+        """
+        if key in self._conflicts:
+            raise Conflict(key, self._conflicts.pop(key))
+
+    def flush(self) -> dict[str, Any]:
+        """Записывает несохраненные значения в хранилище.
+
+        :return: значения из хранилища для полей, которые не были записаны из-за изменений другими процессами
         """
-        self._state[key] = value
-        return self.storage.save_state(self._state)
+        with self._lock:
+            pending = self._pending
+            conflicts = {}
+            if pending:
+                if self.compare_and_set:
+                    conflicts = self.storage.compare_and_set(
+                        {key: (self._known.get(key), value) for key, value in pending.items()})
+                else:
+                    self.storage.save_state(pending)
+                self._known.update(pending)
+                self._known.update(conflicts)
+                self._conflicts.update(conflicts)
+                for key, current in conflicts.items():
+                    self.logger.warning(f'State {key} was changed by another process to {current}, '
+                                        f'{pending[key]} discarded')
+            self._pending = {}
+            self._saves = 0
+            self._flushed_at = time.monotonic()
+            return conflicts
@@ -0,0 +1,67 @@
+from dataclasses import dataclass
+
+import redis
+
+import retries
+
+# Добавляет id в множество, только если оно существует: множество создает переиндексация
+# и удаляет, когда забрала из него id, поэтому после нее id больше не копятся
+ADD_IF_TRACKING = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('SADD', KEYS[1], unpack(ARGV))
+end
+return 0
+"""
+
+# Пустой элемент, с которым создается множество
+_MARKER = ''
+
+
+@dataclass
+class RedisTouched:
+    """Запоминает id фильмов, которые рабочий etl загружает, пока идет переиндексация.
+
+    Рабочий etl пишет в индекс, на который указывает алиас, то есть в старый индекс. Переиндексация
+    догружает изменения по дате изменения, но не видит изменений, прочитанных рабочим etl из outbox
+    и удаленных из него, поэтому после переключения алиаса загружает заново все запомненные фильмы."""
+
+    redis: redis.Redis
+    name: str
+
+    def __post_init__(self):
+        self._add = self.redis.register_script(ADD_IF_TRACKING)
+
+    @retries.policy('redis')
+    def start(self, ttl_sec: int):
+        """Начинает запоминать id. Если переиндексация упадет, множество удалится через ttl_sec.
+
+        :param ttl_sec:
+        :return:
+        """
+        with self.redis.pipeline() as pipe:
+            pipe.delete(self.name)
+            pipe.sadd(self.name, _MARKER)
+            pipe.expire(self.name, ttl_sec)
+            pipe.execute()
+
+    @retries.policy('redis')
+    def add(self, ids: list[str]) -> None:
+        """Запоминает id, если идет переиндексация.
+
+        :param ids:
+        :return:
+        """
+        if ids:
+            self._add(keys=[self.name], args=ids)
+
+    @retries.policy('redis')
+    def drain(self) -> list[str]:
+        """Забирает запомненные id и прекращает запоминать новые.
+
+        :return:
+        """
+        with self.redis.pipeline() as pipe:
+            pipe.smembers(self.name)
+            pipe.delete(self.name)
+            members, _ = pipe.execute()
+        return [member.decode() for member in members if member.decode() != _MARKER]
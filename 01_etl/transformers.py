@@ -1,5 +1,6 @@
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
+from typing import Any, Iterable, Iterator
 
 from pydantic import BaseModel
 
@@ -20,6 +21,15 @@ class Base(metaclass=ABCMeta):
         """
         pass
 
+    def stream(self, items: Iterable[Any]) -> Iterator[Any]:
+        """Преобразует данные по одному элементу по мере их поступления.
+
+        :param items:
+        :return:
+        """
+        for item in items:
+            yield from self.transform([item])
+
 
 @dataclass
 class ElasticSearchMovie(Base):
@@ -32,6 +42,9 @@ class ElasticSearchMovie(Base):
         """
         return [self.map(item) for item in items]
 
+    def stream(self, items: Iterable[models.Movie]) -> Iterator[documents.Movie]:
+        return map(self.map, items)
+
     def map(self, item: models.Movie) -> documents.Movie:
         """Преобразует модель бд в документ elasticsearch.
 
@@ -74,3 +87,19 @@ class ElasticSearchMovie(Base):
         return [documents.Person(id=person.id, name=person.full_name)
                 for person in persons
                 if person.role == role]
+
+
+@dataclass
+class Passthrough(Base):
+    """Передает документы дальше без изменений. Используется, когда документы уже собраны в бд."""
+
+    def transform(self, items: list[Any]) -> list[Any]:
+        """Возвращает документы как есть.
+
+        :param items:
+        :return:
+        """
+        return items
+
+    def stream(self, items: Iterable[Any]) -> Iterator[Any]:
+        return iter(items)
@@ -1,7 +1,7 @@
 import logging
-import time
 
 import log
+from retries import RetryPolicy
 
 
 def backoff(start_sleep_time: float = 0.1,
@@ -10,11 +10,12 @@ def backoff(start_sleep_time: float = 0.1,
             logger: logging.Logger = None):
     """
     Функция для повторного выполнения функции через некоторое время, если возникла ошибка.
-    Использует наивный экспоненциальный рост времени повтора (factor) до граничного времени ожидания (border_sleep_time)
+    Использует экспоненциальный рост времени повтора (factor) до граничного времени ожидания (border_sleep_time)
+    со случайным разбросом, повторяет любые ошибки без ограничения числа попыток.
 
     Формула:
-        t = start_sleep_time * 2^(n) if t < border_sleep_time
-        t = border_sleep_time if t >= border_sleep_time
+        t = random(0, start_sleep_time * factor^n) if t < border_sleep_time
+        t = random(0, border_sleep_time) if t >= border_sleep_time
     :param start_sleep_time: начальное время повтора
     :param factor: во сколько раз нужно увеличить время ожидания
     :param border_sleep_time: граничное время ожидания
@@ -25,21 +26,7 @@ def backoff(start_sleep_time: float = 0.1,
     if logger is None:
         logger = log.logger
 
-    def func_wrapper(func):
-        def inner(*args, **kwargs):
-            n = 0
-            while True:
-                try:
-                    return func(*args, **kwargs)
-                except BaseException as e:
-                    logger.info(e)
-
-                    t = start_sleep_time * (2 ^ n)
-                    if t < border_sleep_time:
-                        t = border_sleep_time
-                    time.sleep(t)
-                    n += factor
-
-        return inner
-
-    return func_wrapper
+    return RetryPolicy(start_sleep_time=start_sleep_time,
+                       factor=factor,
+                       border_sleep_time=border_sleep_time,
+                       logger=logger)
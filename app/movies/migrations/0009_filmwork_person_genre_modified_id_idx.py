@@ -0,0 +1,25 @@
+# Generated by Django 4.0.3 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0008_alter_filmwork_creation_date'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='filmwork',
+            index=models.Index(fields=['modified', 'id'], name='film_work_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(fields=['modified', 'id'], name='genre_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['modified', 'id'], name='person_modified_id_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+from django.db import migrations
+
+NOTIFY_CHANNEL = 'content_changes'
+
+TRIGGERS = (
+    # таблица, имя сущности в уведомлении, колонка с id сущности
+    ('film_work', 'film_work', 'id'),
+    ('person', 'person', 'id'),
+    ('genre', 'genre', 'id'),
+    ('person_film_work', 'film_work', 'film_work_id'),
+    ('genre_film_work', 'film_work', 'film_work_id'),
+)
+
+CREATE_FUNCTION = f'''
+    CREATE OR REPLACE FUNCTION content.notify_change() RETURNS trigger AS $$
+    DECLARE
+        rec record;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            rec := OLD;
+        ELSE
+            rec := NEW;
+        END IF;
+        PERFORM pg_notify(
+            '{NOTIFY_CHANNEL}',
+            json_build_object('table', TG_ARGV[0], 'id', to_jsonb(rec) ->> TG_ARGV[1])::text
+        );
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+CREATE_TRIGGER = '''
+    CREATE TRIGGER {table}_notify_change
+    AFTER INSERT OR UPDATE OR DELETE ON content.{table}
+    FOR EACH ROW EXECUTE FUNCTION content.notify_change('{entity}', '{column}');
+'''
+
+DROP_TRIGGER = 'DROP TRIGGER IF EXISTS {table}_notify_change ON content.{table};'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0009_filmwork_person_genre_modified_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=CREATE_FUNCTION,
+            reverse_sql='DROP FUNCTION IF EXISTS content.notify_change();',
+        ),
+        *[
+            migrations.RunSQL(
+                sql=CREATE_TRIGGER.format(table=table, entity=entity, column=column),
+                reverse_sql=DROP_TRIGGER.format(table=table),
+            )
+            for table, entity, column in TRIGGERS
+        ],
+    ]
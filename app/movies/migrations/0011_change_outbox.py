@@ -0,0 +1,85 @@
+from django.db import migrations
+
+CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS content.change_outbox (
+        seq bigserial PRIMARY KEY,
+        film_work_id uuid NOT NULL,
+        created timestamp with time zone NOT NULL DEFAULT now()
+    );
+'''
+
+# Изменение самого фильма или его связей с жанрами и персонами
+CREATE_FILM_WORK_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION content.outbox_film_work() RETURNS trigger AS $$
+    DECLARE
+        rec record;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            rec := OLD;
+        ELSE
+            rec := NEW;
+        END IF;
+        INSERT INTO content.change_outbox (film_work_id) VALUES ((to_jsonb(rec) ->> TG_ARGV[0])::uuid);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+# Изменение персоны или жанра затрагивает все связанные с ними фильмы
+CREATE_LINKED_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION content.outbox_linked_film_works() RETURNS trigger AS $$
+    BEGIN
+        EXECUTE format(
+            'INSERT INTO content.change_outbox (film_work_id) SELECT film_work_id FROM content.%I WHERE %I = $1',
+            TG_ARGV[0], TG_ARGV[1]
+        ) USING NEW.id;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+TRIGGERS = (
+    # таблица, события, функция, аргументы функции
+    ('film_work', 'INSERT OR UPDATE OR DELETE', 'outbox_film_work', "'id'"),
+    ('person_film_work', 'INSERT OR UPDATE OR DELETE', 'outbox_film_work', "'film_work_id'"),
+    ('genre_film_work', 'INSERT OR UPDATE OR DELETE', 'outbox_film_work', "'film_work_id'"),
+    ('person', 'UPDATE', 'outbox_linked_film_works', "'person_film_work', 'person_id'"),
+    ('genre', 'UPDATE', 'outbox_linked_film_works', "'genre_film_work', 'genre_id'"),
+)
+
+CREATE_TRIGGER = '''
+    CREATE TRIGGER {table}_change_outbox
+    AFTER {events} ON content.{table}
+    FOR EACH ROW EXECUTE FUNCTION content.{function}({args});
+'''
+
+DROP_TRIGGER = 'DROP TRIGGER IF EXISTS {table}_change_outbox ON content.{table};'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0010_content_change_notify_triggers'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=CREATE_TABLE,
+            reverse_sql='DROP TABLE IF EXISTS content.change_outbox;',
+        ),
+        migrations.RunSQL(
+            sql=CREATE_FILM_WORK_FUNCTION,
+            reverse_sql='DROP FUNCTION IF EXISTS content.outbox_film_work();',
+        ),
+        migrations.RunSQL(
+            sql=CREATE_LINKED_FUNCTION,
+            reverse_sql='DROP FUNCTION IF EXISTS content.outbox_linked_film_works();',
+        ),
+        *[
+            migrations.RunSQL(
+                sql=CREATE_TRIGGER.format(table=table, events=events, function=function, args=args),
+                reverse_sql=DROP_TRIGGER.format(table=table),
+            )
+            for table, events, function, args in TRIGGERS
+        ],
+    ]
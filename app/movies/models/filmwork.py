@@ -29,6 +29,9 @@ class Filmwork(UUIDMixin, TimeStampedMixin):
         db_table = 'content"."film_work'
         verbose_name = _('filmwork')
         verbose_name_plural = _('filmworks')
+        indexes = (
+            models.Index(fields=['modified', 'id'], name='film_work_modified_id_idx'),
+        )
 
     def __str__(self):
         return self.title
@@ -14,6 +14,9 @@ class Genre(UUIDMixin, TimeStampedMixin):
         db_table = 'content"."genre'
         verbose_name = _('genre')
         verbose_name_plural = _('genres')
+        indexes = (
+            models.Index(fields=['modified', 'id'], name='genre_modified_id_idx'),
+        )
 
     def __str__(self):
         return self.name
@@ -14,6 +14,9 @@ class Person(UUIDMixin, TimeStampedMixin):
         db_table = 'content"."person'
         verbose_name = _('person')
         verbose_name_plural = _('persons')
+        indexes = (
+            models.Index(fields=['modified', 'id'], name='person_modified_id_idx'),
+        )
 
     def __str__(self):
         return self.full_name